@@ -0,0 +1,185 @@
+"""Module for spreading Valhalla routing requests over multiple processes.
+
+A single valhalla.Actor handles one request at a time on a single core. The compressed graph
+(tiles.tar) built by routing.build_graph is memory-mapped by every actor, so several processes
+can share the same tile data at little extra memory cost.
+
+The ActorPool starts N worker processes which create one routing actor each and dispatches requests
+to them through a work queue. The number of pending requests is bounded, so callers submitting faster
+than the workers can answer are blocked (back-pressure) instead of queueing unbounded work.
+
+Classes:
+    ActorPool: A pool of worker processes holding one routing actor each.
+"""
+
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any
+from concurrent.futures import Future, ProcessPoolExecutor
+import multiprocessing as mp
+import threading
+import os
+import pharmalink.code.routing as routing
+
+if TYPE_CHECKING:
+    import pharmalink.code.area as area
+
+# Actor actions which can be dispatched to the workers
+ACTIONS = ("route", "matrix", "isochrone", "locate", "optimized_route", "status")
+
+# Routing actor of the current worker process, created once by _initialize_worker
+_actor = None
+
+
+def _initialize_worker(area: area.Area | None) -> None:
+    """Create the routing actor of a worker process."""
+
+    global _actor
+    _actor = routing.RoutingService.get_actor(area=area)
+
+
+def _dispatch(action: str, request: str) -> Any:
+    """Run a request on the routing actor of the current worker process."""
+
+    return getattr(_actor, action)(request)
+
+
+class ActorPool:
+    """A pool of worker processes holding one routing actor each.
+
+    The pool exposes the same request methods as a valhalla.Actor,
+    so it can be used in place of a single actor, e.g. in matrix.compute_matrix.
+
+    Attributes:
+        size (int): The number of worker processes.
+        area (area.Area | None): The area of the regional graph the workers route on, None for Germany.
+        max_pending (int): The maximum number of submitted but unfinished requests.
+
+    Methods:
+        submit:     Submit a request without waiting for its result.
+        route:      Compute a route.
+        matrix:     Compute a travel-time matrix.
+        isochrone:  Compute isochrones.
+        locate:     Locate coordinates on the graph.
+        close:      Shut down all worker processes.
+    """
+
+    __slots__ = ["size", "area", "max_pending", "_executor", "_slots"]
+
+    def __init__(
+        self,
+        size: int | None = None,
+        max_pending: int | None = None,
+        area: area.Area | None = None,
+    ) -> None:
+        """Initialize an ActorPool.
+
+        A missing Valhalla library or graph is bootstrapped in the calling process beforehand,
+        so the workers never trigger a build themselves.
+
+        Parameters:
+            size (int | None): The number of worker processes. Defaults to the number of CPU cores.
+            max_pending (int | None): The maximum number of pending requests. Defaults to twice the size.
+            area (area.Area | None): An optional area whose regional graph the workers route on.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        # Only bootstrap what is missing, an existing build is not checked stage by stage
+        if not routing.lib_dir.exists():
+            routing.build_valhalla()
+
+        directory = routing.get_data_dir(area)
+        if not (
+            directory.joinpath("valhalla.json").exists()
+            and directory.joinpath("tiles.tar").exists()
+        ):
+            routing.build_graph(area=area)
+
+        self.size = size or os.cpu_count()
+        self.area = area
+        self.max_pending = max_pending or 2 * self.size
+
+        # Spawned workers start from a clean interpreter, so no native state of the parent is inherited
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=mp.get_context("spawn"),
+            initializer=_initialize_worker,
+            initargs=(area,),
+        )
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def __repr__(self) -> str:
+        """Return all information about the ActorPool object."""
+
+        graph = "Germany" if self.area is None else self.area.regkey
+
+        return (
+            f"ActorPool (Workers: {self.size}, Graph: {graph}, "
+            f"Max. pending: {self.max_pending})"
+        )
+
+    def __enter__(self) -> ActorPool:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def submit(self, action: str, request: str) -> Future:
+        """Submit a request without waiting for its result.
+
+        Blocks while the maximum number of requests is pending.
+
+        Parameters:
+            action (str): The actor action, e.g. "route", "matrix" or "isochrone".
+            request (str): The request as a JSON string.
+
+        Returns:
+            future (Future): A future resolving to the JSON response string.
+
+        Raises:
+            ValueError: If the action is not supported.
+        """
+
+        if action not in ACTIONS:
+            raise ValueError(f"Action must be one of {ACTIONS}.")
+
+        self._slots.acquire()
+
+        try:
+            future = self._executor.submit(_dispatch, action, request)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+
+        return future
+
+    def route(self, request: str) -> str:
+        """Compute a route."""
+
+        return self.submit("route", request).result()
+
+    def matrix(self, request: str) -> str:
+        """Compute a travel-time matrix."""
+
+        return self.submit("matrix", request).result()
+
+    def isochrone(self, request: str) -> str:
+        """Compute isochrones."""
+
+        return self.submit("isochrone", request).result()
+
+    def locate(self, request: str) -> str:
+        """Locate coordinates on the graph."""
+
+        return self.submit("locate", request).result()
+
+    def close(self) -> None:
+        """Shut down all worker processes after finishing pending requests."""
+
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,313 @@
+"""Module for assigning customers to the pharmacy they are most likely to visit.
+
+Customers are assigned to their nearest pharmacy by straight-line distance in the metric CRS.
+The assignment works on raw coordinate arrays and the loaded-once pharmacy index, so it scales
+to millions of customers. Customer counts per pharmacy are aggregated with a single bincount.
+
+Optionally, a capacity per pharmacy can be given. Customers of overloaded pharmacies are then
+reassigned to their next-nearest pharmacy with spare capacity, farthest customers first.
+
+Classes:
+    PharmacyAssignment: The assignment of a collection of customers to pharmacies.
+
+Functions:
+    assign_nearest:     Assign customer coordinates to their nearest indexed point.
+    assign_by_travel_time: Assign customers to the pharmacy with the shortest travel time.
+    count_customers:    Count the customers assigned to every pharmacy.
+    rebalance:          Reassign customers of overloaded pharmacies under a capacity constraint.
+"""
+
+from __future__ import annotations
+from typing import Tuple
+import numpy as np
+import geopandas as gpd
+import pharmalink.code.customers as cust
+import pharmalink.code.sources as src
+import pharmalink.code.sparse as sparse
+import pharmalink.code.spatial as spatial
+
+
+class PharmacyAssignment:
+    """The assignment of a collection of customers to pharmacies.
+
+    Attributes:
+        customers (cust.Customers): The assigned customers.
+        pharmacy_ids (np.ndarray): The pharmacy id (row in Pharmacies.get_all_pharmacies) per customer.
+        distances (np.ndarray): The straight-line distance in metres per customer.
+        counts (np.ndarray): The number of assigned customers per pharmacy id.
+
+    Methods:
+        get_customers:  Get the customers with their assigned pharmacy.
+        get_pharmacies: Get all pharmacies with at least one customer and their customer count.
+    """
+
+    __slots__ = ["customers", "pharmacy_ids", "distances", "counts"]
+
+    def __init__(
+        self,
+        customers: cust.Customers,
+        capacity: int | np.ndarray | None = None,
+        candidates: int = 5,
+    ) -> None:
+        """Initialize an assignment of customers to pharmacies.
+
+        Parameters:
+            customers (cust.Customers): The customers to assign.
+            capacity (int | np.ndarray | None): Optional maximum number of customers per pharmacy,
+                either for all pharmacies or per pharmacy id.
+            candidates (int): The number of nearest pharmacies considered for a reassignment.
+
+        Returns:
+            None
+
+        Raises:
+            TypeError: If customers is not an instance of cust.Customers.
+        """
+
+        # check if Customers are valid
+        if not isinstance(customers, cust.Customers):
+            raise TypeError("customers must be an instance of customers.Customers.")
+
+        index = src.Pharmacies.get_index()
+        coordinates = spatial.get_coordinates(customers.customers)
+
+        pharmacy_ids, distances = assign_nearest(coordinates, index)
+
+        if capacity is not None:
+            pharmacy_ids, distances = rebalance(
+                coordinates, pharmacy_ids, distances, index, capacity, candidates
+            )
+
+        self.customers = customers
+        self.pharmacy_ids = pharmacy_ids
+        self.distances = distances
+        self.counts = count_customers(pharmacy_ids, len(index))
+
+    def __repr__(self) -> str:
+        """Return all information about the PharmacyAssignment object."""
+
+        return (
+            f"PharmacyAssignment (Customers: {len(self.pharmacy_ids)}, "
+            f"Pharmacies: {np.count_nonzero(self.counts)})"
+        )
+
+    def get_customers(self) -> gpd.GeoDataFrame:
+        """Get the customers with their assigned pharmacy.
+
+        Parameters:
+            None
+
+        Returns:
+            customers (gpd.GeoDataFrame): The customers with pharmacy_id and distance columns.
+
+        Raises:
+            None
+        """
+
+        customers = self.customers.customers.copy()
+        customers["pharmacy_id"] = self.pharmacy_ids
+        customers["distance"] = self.distances
+
+        return customers
+
+    def get_pharmacies(self) -> gpd.GeoDataFrame:
+        """Get all pharmacies with at least one customer and their customer count.
+
+        Parameters:
+            None
+
+        Returns:
+            pharmacies (gpd.GeoDataFrame): The pharmacies with a customers column.
+
+        Raises:
+            None
+        """
+
+        pharmacy_ids = np.flatnonzero(self.counts)
+
+        pharmacies = src.Pharmacies.get_index().data.iloc[pharmacy_ids].copy()
+        pharmacies["customers"] = self.counts[pharmacy_ids]
+
+        return pharmacies
+
+
+def assign_nearest(
+    coordinates: np.ndarray,
+    index: spatial.PointIndex,
+    chunk_size: int = spatial.CHUNK_SIZE,
+    workers: int = -1,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Assign customer coordinates to their nearest indexed point.
+
+    Parameters:
+        coordinates (np.ndarray): Customer coordinates in the metric CRS, shape (n, 2).
+        index (spatial.PointIndex): The index of the points to assign to.
+        chunk_size (int): The number of customers queried at once.
+        workers (int): The number of threads used by the KD-tree (-1 = all cores).
+
+    Returns:
+        ids (np.ndarray): The id of the nearest point per customer.
+        distances (np.ndarray): The distance to the nearest point in metres per customer.
+
+    Raises:
+        None
+    """
+
+    distances, ids = index.nearest(
+        coordinates, k=1, chunk_size=chunk_size, workers=workers
+    )
+
+    return ids[:, 0], distances[:, 0]
+
+
+def assign_by_travel_time(
+    durations: np.ndarray | sparse.SparseMatrix,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Assign customers to the pharmacy with the shortest travel time.
+
+    Parameters:
+        durations (np.ndarray | sparse.SparseMatrix): Customer x pharmacy travel times in seconds,
+            either dense (NaN = unreachable) or sparse.
+
+    Returns:
+        ids (np.ndarray): The column of the fastest pharmacy per customer, -1 if none is reachable.
+        durations (np.ndarray): The shortest travel time in seconds per customer, inf if none is reachable.
+
+    Raises:
+        None
+    """
+
+    if isinstance(durations, sparse.SparseMatrix):
+        return durations.row_min()
+
+    durations = np.where(np.isnan(durations), np.inf, durations)
+
+    ids = np.argmin(durations, axis=1)
+    minima = durations[np.arange(len(durations)), ids]
+    ids[~np.isfinite(minima)] = -1
+
+    return ids, minima
+
+
+def count_customers(pharmacy_ids: np.ndarray, num_pharmacies: int) -> np.ndarray:
+    """Count the customers assigned to every pharmacy.
+
+    Parameters:
+        pharmacy_ids (np.ndarray): The assigned pharmacy id per customer.
+        num_pharmacies (int): The total number of pharmacies.
+
+    Returns:
+        counts (np.ndarray): The number of customers per pharmacy id, shape (num_pharmacies,).
+
+    Raises:
+        None
+    """
+
+    return np.bincount(pharmacy_ids, minlength=num_pharmacies)
+
+
+def _rank_within_groups(groups: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Rank elements by ascending key within their group (0 = smallest key)."""
+
+    order = np.lexsort((keys, groups))
+    sorted_groups = groups[order]
+
+    # Position of the first element of each group in the sorted order
+    group_starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    group_lengths = np.diff(np.r_[group_starts, len(order)])
+
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.repeat(group_starts, group_lengths)
+
+    return ranks
+
+
+def rebalance(
+    coordinates: np.ndarray,
+    pharmacy_ids: np.ndarray,
+    distances: np.ndarray,
+    index: spatial.PointIndex,
+    capacity: int | np.ndarray,
+    candidates: int = 5,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Reassign customers of overloaded pharmacies under a capacity constraint.
+
+    In every round, the farthest customers exceeding the capacity of their pharmacy try their
+    next-nearest candidate pharmacy. A candidate accepts the closest of these customers up to its
+    spare capacity. Rounds continue until no pharmacy is overloaded or all candidates are exhausted,
+    so customers that cannot be moved remain at their current pharmacy.
+
+    Parameters:
+        coordinates (np.ndarray): Customer coordinates in the metric CRS, shape (n, 2).
+        pharmacy_ids (np.ndarray): The current pharmacy id per customer.
+        distances (np.ndarray): The current distance in metres per customer.
+        index (spatial.PointIndex): The pharmacy index.
+        capacity (int | np.ndarray): The maximum number of customers for all or per pharmacy.
+        candidates (int): The number of nearest pharmacies considered per customer.
+
+    Returns:
+        ids (np.ndarray): The rebalanced pharmacy id per customer.
+        distances (np.ndarray): The distance to the rebalanced pharmacy in metres per customer.
+
+    Raises:
+        ValueError: If candidates is smaller than 2.
+    """
+
+    if candidates < 2:
+        raise ValueError("At least two candidates are needed for a reassignment.")
+
+    capacity = np.broadcast_to(np.asarray(capacity, dtype=np.int64), (len(index),))
+    pharmacy_ids = pharmacy_ids.copy()
+    distances = distances.copy()
+
+    loads = count_customers(pharmacy_ids, len(index))
+
+    if not np.any(loads > capacity):
+        return pharmacy_ids, distances
+
+    # Candidate pharmacies for every customer of an overloaded pharmacy, nearest first
+    affected = np.flatnonzero(loads[pharmacy_ids] > capacity[pharmacy_ids])
+    candidate_distances, candidate_ids = index.nearest(
+        coordinates[affected], k=min(candidates, len(index))
+    )
+
+    # Position of the candidate that is tried next by each affected customer
+    attempts = np.ones(len(affected), dtype=np.int64)
+
+    while True:
+        current = pharmacy_ids[affected]
+        excess = np.maximum(loads - capacity, 0)
+
+        # Customers beyond capacity, farthest first, ranked only among those with a candidate left,
+        # so customers whose candidates are exhausted do not block nearer ones that can still move
+        movable = np.flatnonzero(attempts < candidate_ids.shape[1])
+        ranks = _rank_within_groups(current[movable], -distances[affected[movable]])
+        movers = movable[ranks < excess[current[movable]]]
+
+        if len(movers) == 0:
+            break
+
+        targets = candidate_ids[movers, attempts[movers]]
+        target_distances = candidate_distances[movers, attempts[movers]]
+        attempts[movers] += 1
+
+        # Every target accepts the closest movers up to its spare capacity
+        valid = targets >= 0
+        movers, targets, target_distances = (
+            movers[valid],
+            targets[valid],
+            target_distances[valid],
+        )
+        spare = np.maximum(capacity - loads, 0)
+        accepted = _rank_within_groups(targets, target_distances) < spare[targets]
+
+        movers, targets = movers[accepted], targets[accepted]
+        customers = affected[movers]
+
+        np.subtract.at(loads, pharmacy_ids[customers], 1)
+        np.add.at(loads, targets, 1)
+
+        pharmacy_ids[customers] = targets
+        distances[customers] = target_distances[accepted]
+
+    return pharmacy_ids, distances
@@ -0,0 +1,377 @@
+"""Module providing interchangeable routing backends for the pharmalink model.
+
+Building the Valhalla library and graph takes hours, so many runs (tests, quick what-if analyses) cannot route
+with Valhalla at all. All routing consumers therefore work against the RoutingBackend interface, which offers
+matrix and route queries on numpy coordinate arrays. Two implementations exist:
+
+- ValhallaBackend: exact network travel times from a Valhalla actor, actor pool or HTTP service client.
+- HaversineBackend: fast approximate travel times from great-circle distances, scaled by a detour factor
+  and divided by an average speed per mode of transport. Pure numpy, no graph needed.
+
+Classes:
+    RouteResult:        Duration and distance of a route and its legs.
+    RoutingBackend:     Interface of all routing backends.
+    ValhallaBackend:    Routing backend using the Valhalla routing engine.
+    HaversineBackend:   Approximate routing backend based on great-circle distances.
+
+Functions:
+    haversine:      Compute great-circle distances between coordinates.
+    create_backend: Create a routing backend by name.
+"""
+
+from __future__ import annotations
+from typing import Any
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+import contextlib
+import json
+import threading
+import numpy as np
+import pharmalink.code.actor_pool as actor_pool
+import pharmalink.code.http_client as http_client
+import pharmalink.code.matrix as matrix
+import pharmalink.code.routing as routing
+
+# Mean earth radius in kilometres
+EARTH_RADIUS = 6371.0088
+
+# Ratio of network distance to great-circle distance per mode of transport
+DETOUR_FACTORS = {"auto": 1.3, "bicycle": 1.25, "pedestrian": 1.2}
+
+# Average travel speeds in km/h per mode of transport (Valhalla defaults for bicycle and pedestrian costing)
+SPEEDS = {"auto": 45.0, "bicycle": 18.0, "pedestrian": 5.1}
+
+# Routers that answer concurrent requests. A plain valhalla.Actor is not thread-safe.
+CONCURRENT_ROUTERS = (actor_pool.ActorPool, http_client.ValhallaClient)
+
+# One lock per plain actor (by id), shared by all backends using it, e.g. the actor of routing.RoutingService
+_actor_locks = {}
+
+
+def haversine(
+    lon: np.ndarray, lat: np.ndarray, other_lon: np.ndarray, other_lat: np.ndarray
+) -> np.ndarray:
+    """Compute great-circle distances in kilometres between coordinates given in radians.
+
+    The inputs are broadcast against each other, so both pairwise and element-wise distances can be computed.
+    """
+
+    a = (
+        np.sin((other_lat - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(other_lat) * np.sin((other_lon - lon) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+@dataclass
+class RouteResult:
+    """Duration and distance of a route and its legs.
+
+    Attributes:
+        duration (float): The total travel time in seconds.
+        distance (float): The total travel distance in kilometres.
+        leg_durations (np.ndarray): The travel time of every leg in seconds.
+        leg_distances (np.ndarray): The travel distance of every leg in kilometres.
+    """
+
+    duration: float
+    distance: float
+    leg_durations: np.ndarray
+    leg_distances: np.ndarray
+
+
+class RoutingBackend(ABC):
+    """Interface of all routing backends.
+
+    Coordinates are numpy arrays of shape (n, 2) holding (longitude, latitude) pairs in EPSG:4326.
+
+    Methods:
+        matrix: Compute a travel-time matrix between sources and targets.
+        route:  Compute a route visiting the given locations in order.
+    """
+
+    @abstractmethod
+    def matrix(
+        self,
+        sources: np.ndarray,
+        targets: np.ndarray | None = None,
+        costing: str = "auto",
+    ) -> matrix.MatrixResult:
+        """Compute a travel-time matrix between sources and targets."""
+
+    @abstractmethod
+    def route(self, locations: np.ndarray, costing: str = "auto") -> RouteResult:
+        """Compute a route visiting the given locations in order."""
+
+
+class ValhallaBackend(RoutingBackend):
+    """Routing backend using the Valhalla routing engine.
+
+    Attributes:
+        router (Any): The routing actor, e.g. a valhalla.Actor or an actor_pool.ActorPool.
+        max_pairs (int): The maximum number of location pairs per matrix request.
+        max_workers (int): The number of matrix blocks requested concurrently.
+        cache (Any): An optional cache.TravelTimeCache in front of the router.
+    """
+
+    __slots__ = ["router", "max_pairs", "max_workers", "cache", "_lock"]
+
+    def __init__(
+        self,
+        router: Any = None,
+        max_pairs: int = matrix.MAX_LOCATION_PAIRS,
+        max_workers: int | None = None,
+        cache: Any = None,
+    ) -> None:
+        """Initialize a ValhallaBackend.
+
+        Calls to a plain valhalla.Actor are serialized by a lock, as the actor is not thread-safe
+        and may be shared by several threads (e.g. of the model service or the decomposition).
+
+        Parameters:
+            router (Any): The routing actor. Defaults to the warm actor of routing.RoutingService.
+            max_pairs (int): The maximum number of location pairs per matrix request.
+            max_workers (int | None): The number of matrix blocks requested concurrently.
+                Defaults to 4 for an ActorPool or ValhallaClient and to 1 for a plain actor.
+            cache (Any): An optional cache.TravelTimeCache.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        if router is None:
+            router = routing.RoutingService.get_actor()
+
+        concurrent = isinstance(router, CONCURRENT_ROUTERS)
+
+        self.router = router
+        self.max_pairs = max_pairs
+        self.max_workers = max_workers or (4 if concurrent else 1)
+        self.cache = cache
+        self._lock = (
+            contextlib.nullcontext()
+            if concurrent
+            else _actor_locks.setdefault(id(router), threading.Lock())
+        )
+
+    def matrix(
+        self,
+        sources: np.ndarray,
+        targets: np.ndarray | None = None,
+        costing: str = "auto",
+    ) -> matrix.MatrixResult:
+        """Compute a travel-time matrix between sources and targets.
+
+        Parameters:
+            sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+            targets (np.ndarray | None): Target (longitude, latitude) pairs, shape (m, 2). Defaults to sources.
+            costing (str): The costing model, one of "auto", "bicycle" or "pedestrian".
+
+        Returns:
+            result (matrix.MatrixResult): Durations and distances of shape (n, m).
+
+        Raises:
+            ValueError: If the costing is not supported.
+        """
+
+        with self._lock:
+            return matrix.compute_matrix(
+                self.router,
+                sources,
+                targets,
+                costing=costing,
+                max_pairs=self.max_pairs,
+                max_workers=self.max_workers,
+                cache=self.cache,
+            )
+
+    def route(self, locations: np.ndarray, costing: str = "auto") -> RouteResult:
+        """Compute a route visiting the given locations in order.
+
+        Parameters:
+            locations (np.ndarray): (longitude, latitude) pairs, shape (n, 2) with n >= 2.
+            costing (str): The costing model, one of "auto", "bicycle" or "pedestrian".
+
+        Returns:
+            result (RouteResult): The duration and distance of the route and its legs.
+
+        Raises:
+            ValueError: If the costing is not supported.
+        """
+
+        if costing not in matrix.COSTINGS:
+            raise ValueError(f"Costing must be one of {matrix.COSTINGS}.")
+
+        request = {
+            "locations": matrix.to_locations(locations),
+            "costing": costing,
+            "units": "kilometers",
+            "directions_type": "none",
+        }
+        with self._lock:
+            response = self.router.route(json.dumps(request))
+
+        if isinstance(response, (str, bytes)):
+            response = json.loads(response)
+
+        trip = response["trip"]
+
+        return RouteResult(
+            duration=float(trip["summary"]["time"]),
+            distance=float(trip["summary"]["length"]),
+            leg_durations=np.array([leg["summary"]["time"] for leg in trip["legs"]]),
+            leg_distances=np.array([leg["summary"]["length"] for leg in trip["legs"]]),
+        )
+
+
+class HaversineBackend(RoutingBackend):
+    """Approximate routing backend based on great-circle distances.
+
+    Network distances are estimated as great-circle distance times a detour factor,
+    travel times as estimated distance divided by an average speed.
+
+    Attributes:
+        detour_factors (dict): The detour factor per costing model.
+        speeds (dict): The average speed in km/h per costing model.
+        chunk_size (int): The number of sources computed at once to bound memory use.
+    """
+
+    __slots__ = ["detour_factors", "speeds", "chunk_size"]
+
+    def __init__(
+        self,
+        detour_factors: dict | None = None,
+        speeds: dict | None = None,
+        chunk_size: int = 2048,
+    ) -> None:
+        """Initialize a HaversineBackend.
+
+        Parameters:
+            detour_factors (dict | None): Overrides of the default detour factors per costing model.
+            speeds (dict | None): Overrides of the default speeds in km/h per costing model.
+            chunk_size (int): The number of sources computed at once.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        self.detour_factors = DETOUR_FACTORS | (detour_factors or {})
+        self.speeds = SPEEDS | (speeds or {})
+        self.chunk_size = chunk_size
+
+    def matrix(
+        self,
+        sources: np.ndarray,
+        targets: np.ndarray | None = None,
+        costing: str = "auto",
+    ) -> matrix.MatrixResult:
+        """Compute an approximate travel-time matrix between sources and targets.
+
+        Parameters:
+            sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+            targets (np.ndarray | None): Target (longitude, latitude) pairs, shape (m, 2). Defaults to sources.
+            costing (str): The costing model, one of "auto", "bicycle" or "pedestrian".
+
+        Returns:
+            result (matrix.MatrixResult): Durations and distances of shape (n, m).
+
+        Raises:
+            ValueError: If the costing is not supported.
+        """
+
+        if costing not in matrix.COSTINGS:
+            raise ValueError(f"Costing must be one of {matrix.COSTINGS}.")
+
+        sources = np.radians(np.asarray(sources, dtype=float).reshape(-1, 2))
+        targets = (
+            sources
+            if targets is None
+            else np.radians(np.asarray(targets, dtype=float).reshape(-1, 2))
+        )
+
+        result = matrix.MatrixResult.empty(len(sources), len(targets))
+
+        factor = self.detour_factors[costing]
+        hours_per_km = 1 / self.speeds[costing]
+
+        for start in range(0, len(sources), self.chunk_size):
+            chunk = sources[start : start + self.chunk_size]
+
+            # Broadcast the chunk's sources as a column against all targets
+            distances = factor * haversine(
+                chunk[:, 0, None], chunk[:, 1, None], targets[:, 0], targets[:, 1]
+            )
+
+            result.distances[start : start + len(chunk)] = distances
+            result.durations[start : start + len(chunk)] = (
+                distances * hours_per_km * 3600
+            )
+
+        return result
+
+    def route(self, locations: np.ndarray, costing: str = "auto") -> RouteResult:
+        """Compute an approximate route visiting the given locations in order.
+
+        Parameters:
+            locations (np.ndarray): (longitude, latitude) pairs, shape (n, 2) with n >= 2.
+            costing (str): The costing model, one of "auto", "bicycle" or "pedestrian".
+
+        Returns:
+            result (RouteResult): The duration and distance of the route and its legs.
+
+        Raises:
+            ValueError: If the costing is not supported.
+        """
+
+        if costing not in matrix.COSTINGS:
+            raise ValueError(f"Costing must be one of {matrix.COSTINGS}.")
+
+        locations = np.radians(np.asarray(locations, dtype=float).reshape(-1, 2))
+
+        # Only consecutive locations are connected, so the legs are computed element-wise
+        leg_distances = self.detour_factors[costing] * haversine(
+            locations[:-1, 0], locations[:-1, 1], locations[1:, 0], locations[1:, 1]
+        )
+        leg_durations = leg_distances / self.speeds[costing] * 3600
+
+        return RouteResult(
+            duration=float(leg_durations.sum()),
+            distance=float(leg_distances.sum()),
+            leg_durations=leg_durations,
+            leg_distances=leg_distances,
+        )
+
+
+def create_backend(name: str = "valhalla", **kwargs) -> RoutingBackend:
+    """Create a routing backend by name.
+
+    Parameters:
+        name (str): Either "valhalla", "valhalla_http" or "haversine".
+        **kwargs: Keyword arguments passed to the backend, or to the ValhallaClient for "valhalla_http".
+
+    Returns:
+        backend (RoutingBackend): The routing backend.
+
+    Raises:
+        ValueError: If the name is unknown.
+    """
+
+    backends = {
+        "valhalla": ValhallaBackend,
+        "valhalla_http": lambda **kwargs: ValhallaBackend(
+            router=http_client.ValhallaClient(**kwargs)
+        ),
+        "haversine": HaversineBackend,
+    }
+
+    if name not in backends:
+        raise ValueError(f"Backend must be one of {tuple(backends)}.")
+
+    return backends[name](**kwargs)
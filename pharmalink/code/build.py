@@ -0,0 +1,525 @@
+"""Module for building the Valhalla routing graph as an incremental pipeline of stages.
+
+The graph build consists of several lengthy steps (downloading the OSM input, building admins, timezones,
+tiles and the compressed extract). Every step is a Stage with explicit dependencies, so the steps form a DAG.
+
+Each stage stores its outputs exactly once in its own directory of the stage store (valhalla/cache/stages),
+together with a manifest. The manifest holds a key over everything the outputs depend on: the stage's
+parameters, the versions (hashes) of the Valhalla tools it runs and the digests of its dependencies.
+The digest of a download stage is the content hash of the downloaded file (e.g. the input PBF),
+the digest of every other stage is its key.
+
+When the pipeline runs, stages whose stored key still matches are skipped. All outputs are hardlinked into
+the data directory (or symlinked if hardlinks are not possible), so no data is duplicated. Stages whose
+dependencies are finished run in parallel, e.g. admins and timezones.
+
+Regional graphs for a single area are built from the input file cut to the area's bounding box. They take
+minutes instead of hours and live in their own data directories (valhalla/regions/<regkey>).
+
+Classes:
+    Stage: A step of the graph build.
+
+Functions:
+    create_stages:  Create the stages of a Valhalla graph build.
+    run_pipeline:   Run the stages of a build, skipping all unchanged stages.
+"""
+
+from __future__ import annotations
+from typing import Callable, List
+from dataclasses import dataclass, field
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import importlib.resources as res
+import pathlib as path
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+import pharmalink.code.download as download
+import pharmalink.code.routing as routing
+
+store_dir = res.files(__package__).joinpath("valhalla", "cache", "stages")
+
+# Download locations of the graph inputs
+PBF_URL = "https://download.geofabrik.de/europe/germany-latest.osm.pbf"
+DEFAULT_SPEEDS_URL = "https://raw.githubusercontent.com/OpenStreetMapSpeeds/schema/master/default_speeds.json"
+
+
+@dataclass
+class Stage:
+    """A step of the graph build.
+
+    Attributes:
+        name (str): The unique name of the stage.
+        outputs (List[str]): The files or directories the stage creates, relative to the data directory.
+        run (Callable): A function creating the outputs in the data directory given as its only argument.
+        deps (List[str]): The names of the stages whose outputs are needed by this stage.
+        tools (List[str]): The Valhalla tools run by the stage, whose versions are part of the key.
+        params (dict): Further parameters that change the outputs, e.g. a download URL.
+        hash_outputs (bool): Whether the digest of the stage is the content hash of its outputs.
+    """
+
+    name: str
+    outputs: List[str]
+    run: Callable[[path.Path], None]
+    deps: List[str] = field(default_factory=list)
+    tools: List[str] = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    hash_outputs: bool = False
+
+
+def _hash(content: dict) -> str:
+    """Compute the SHA-256 hash of a JSON-serializable dict."""
+
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _tool(name: str) -> str:
+    """Get the path of a Valhalla tool."""
+
+    return str(routing.lib_dir.joinpath(name))
+
+
+def _compute_key(stage: Stage, digests: dict) -> str:
+    """Compute the key of a stage from its parameters, tool versions and dependency digests."""
+
+    return _hash(
+        {
+            "stage": stage.name,
+            "outputs": stage.outputs,
+            "params": stage.params,
+            "tools": {tool: routing.hash_file(_tool(tool)) for tool in stage.tools},
+            "deps": {dep: digests[dep] for dep in stage.deps},
+        }
+    )
+
+
+def _read_manifest(stage_dir: path.Path) -> dict | None:
+    """Read the manifest of a stored stage, None if the stage was never completed."""
+
+    manifest = stage_dir.joinpath("manifest.json")
+
+    if not manifest.exists():
+        return None
+
+    with open(manifest, "r") as file:
+        return json.load(file)
+
+
+def _remove(target: path.Path) -> None:
+    """Remove a file, directory or link if it exists."""
+
+    if target.is_symlink() or target.is_file():
+        target.unlink()
+    elif target.is_dir():
+        shutil.rmtree(target)
+
+
+def _link(source: path.Path, target: path.Path) -> None:
+    """Hardlink a stored output into the data directory, falling back to a symlink.
+
+    Directories are recreated and their files hardlinked one by one.
+    Hardlinks fail across file systems, in which case the whole output is symlinked.
+    """
+
+    _remove(target)
+
+    try:
+        if source.is_dir():
+            shutil.copytree(source, target, copy_function=os.link)
+        else:
+            os.link(source, target)
+
+    except OSError:
+        _remove(target)
+        os.symlink(source, target, target_is_directory=source.is_dir())
+
+
+def _link_outputs(
+    stage: Stage,
+    manifest: dict,
+    stage_dir: path.Path,
+    directory: path.Path,
+    linked: dict,
+) -> None:
+    """Link the stored outputs of a stage into the directory, unless they are linked already."""
+
+    if linked.get(stage.name) == manifest["key"] and all(
+        directory.joinpath(output).exists() for output in stage.outputs
+    ):
+        return
+
+    for output in stage.outputs:
+        _link(stage_dir.joinpath(output), directory.joinpath(output))
+
+    linked[stage.name] = manifest["key"]
+
+
+def _run_stage(
+    stage: Stage, key: str, directory: path.Path, stage_dir: path.Path
+) -> dict:
+    """Run a stage, move its outputs into the stage store and write its manifest."""
+
+    print(f"Running stage {stage.name}...")
+    start = time.perf_counter()
+
+    # Stale links must be removed first, tools would otherwise write through hardlinks into the store
+    for output in stage.outputs:
+        _remove(directory.joinpath(output))
+
+    stage.run(directory)
+
+    # Invalidate the stored stage before replacing its outputs
+    _remove(stage_dir)
+    stage_dir.mkdir(parents=True)
+
+    for output in stage.outputs:
+        os.replace(directory.joinpath(output), stage_dir.joinpath(output))
+
+    digest = (
+        _hash(
+            {
+                output: routing.hash_file(stage_dir.joinpath(output))
+                for output in stage.outputs
+            }
+        )
+        if stage.hash_outputs
+        else key
+    )
+
+    manifest = {
+        "stage": stage.name,
+        "key": key,
+        "digest": digest,
+        "outputs": stage.outputs,
+        "seconds": round(time.perf_counter() - start, 1),
+    }
+
+    # The manifest is written last, so only completed stages are ever skipped
+    with open(stage_dir.joinpath("manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    print(f"Stage {stage.name} finished in {manifest['seconds']} s.")
+
+    return manifest
+
+
+def run_pipeline(
+    stages: List[Stage],
+    directory: path.Path,
+    store: path.Path | None = None,
+    forced: bool | List[str] = False,
+    max_workers: int = 4,
+) -> dict:
+    """Run the stages of a build, skipping all unchanged stages.
+
+    A stage runs if it was never completed, if its key changed (e.g. a new input PBF, changed config
+    or tool version) or if it is forced. Otherwise its stored outputs are only linked into the directory.
+
+    Parameters:
+        stages (List[Stage]): The stages of the build.
+        directory (path.Path): The data directory the outputs are linked into.
+        store (path.Path | None): The directory holding the stored outputs. Defaults to valhalla/cache/stages.
+        forced (bool | List[str]): Whether to rerun all stages, or the names of the stages to rerun.
+        max_workers (int): The maximum number of stages running in parallel.
+
+    Returns:
+        manifests (dict): The manifest per stage name.
+
+    Raises:
+        ValueError: If a dependency is unknown or the dependencies contain a cycle.
+    """
+
+    store = path.Path(store or store_dir)
+    directory = path.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    stages = {stage.name: stage for stage in stages}
+    forced = set(stages) if forced is True else set(forced or [])
+
+    for stage in stages.values():
+        if unknown := set(stage.deps) - set(stages):
+            raise ValueError(f"Stage {stage.name} depends on unknown stages {unknown}.")
+
+    # Keys of the stage outputs currently linked into the directory
+    links_file = directory.joinpath("stages.json")
+    linked = {}
+    if links_file.exists():
+        with open(links_file, "r") as file:
+            linked = json.load(file)
+
+    manifests = {}
+    digests = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(manifests) < len(stages):
+            # Stages whose dependencies are all finished
+            ready = [
+                stage
+                for name, stage in stages.items()
+                if name not in manifests
+                and name not in running.values()
+                and all(dep in manifests for dep in stage.deps)
+            ]
+
+            for stage in ready:
+                key = _compute_key(stage, digests)
+                stage_dir = store.joinpath(stage.name)
+                manifest = _read_manifest(stage_dir)
+
+                if stage.name in forced or manifest is None or manifest["key"] != key:
+                    future = executor.submit(
+                        _run_stage, stage, key, directory, stage_dir
+                    )
+                    running[future] = stage.name
+                    continue
+
+                print(f"Stage {stage.name} unchanged. Skipping.")
+                _link_outputs(stage, manifest, stage_dir, directory, linked)
+
+                manifests[stage.name] = manifest
+                digests[stage.name] = manifest["digest"]
+
+            if not running:
+                if not ready and len(manifests) < len(stages):
+                    raise ValueError("The stage dependencies contain a cycle.")
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name = running.pop(future)
+                manifest = future.result()
+
+                _link_outputs(
+                    stages[name], manifest, store.joinpath(name), directory, linked
+                )
+
+                manifests[name] = manifest
+                digests[name] = manifest["digest"]
+
+    with open(links_file, "w") as file:
+        json.dump(linked, file, indent=2)
+
+    return manifests
+
+
+def _run_tool(name: str, *args: str, config: path.Path, **kwargs) -> bytes:
+    """Run a Valhalla tool with the given config and return its output."""
+
+    return subprocess.run(
+        [_tool(name), *args, "--config", str(config)],
+        check=True,
+        cwd=str(routing.lib_dir),
+        **kwargs,
+    ).stdout
+
+
+def create_stages(
+    directory: path.Path,
+    pbf_url: str = PBF_URL,
+    region: str | None = None,
+    bounds: List[float] | None = None,
+) -> List[Stage]:
+    """Create the stages of a Valhalla graph build.
+
+    The stages mirror the manual build process: config, downloads, admins, timezones,
+    tiles (build, elevation, enhance) and the compressed extract.
+
+    For a regional graph, the OSM input file is first cut to the region's bounding box with osmium.
+    All stages depending on the region are named after it, so regional graphs share the stage store
+    (and thereby the downloads and timezones) with the graph of Germany.
+
+    Parameters:
+        directory (path.Path): The data directory the graph is built in, which the config points to.
+        pbf_url (str): The download URL of the OSM input file.
+        region (str | None): The regkey of a regional graph.
+        bounds (List[float] | None): The bounding box [min_lon, min_lat, max_lon, max_lat] of a regional graph.
+
+    Returns:
+        stages (List[Stage]): The stages of the build.
+
+    Raises:
+        ValueError: If only one of region and bounds is given.
+        RuntimeError: If osmium is not installed for a regional build.
+    """
+
+    if (region is None) != (bounds is None):
+        raise ValueError("A regional graph needs both a region and its bounds.")
+
+    def scoped(name: str) -> str:
+        return name if region is None else f"{name}_{region}"
+
+    # The regional stage cuts the input file, all other stages read the cut file instead
+    input_name = "input.osm.pbf" if region is None else "region.osm.pbf"
+    input_stage = "pbf" if region is None else scoped("region")
+
+    def run_config(directory: path.Path) -> None:
+        default_config = json.loads(
+            subprocess.run(
+                [_tool("valhalla_build_config")],
+                check=True,
+                cwd=str(routing.lib_dir),
+                stdout=subprocess.PIPE,
+            ).stdout
+        )
+
+        # Update the config with the paths to the input and output files
+        custom_config_params = {
+            "mjolnir": {
+                "tile_dir": str(directory.joinpath("tiles")),
+                "tile_extract": str(directory.joinpath("tiles.tar")),
+                "admin": str(directory.joinpath("admin.sqlite")),
+                "timezone": str(directory.joinpath("tz_world.sqlite")),
+                "transit_dir": str(directory.joinpath("transit")),
+                "transit_feeds_dir": str(directory.joinpath("transit_feeds")),
+                "default_speeds_config": str(directory.joinpath("default_speeds.json")),
+            },
+            "additional_data": {
+                "elevation": str(directory.joinpath("elevation_data")),
+            },
+        }
+
+        with open(directory.joinpath("valhalla.json"), "w") as file:
+            json.dump(default_config | custom_config_params, file)
+
+    def run_pbf(directory: path.Path) -> None:
+        # This file is around 4 GB in size, so it is downloaded in resumable segments and verified
+        download.download(
+            pbf_url, directory.joinpath("input.osm.pbf"), md5_url=pbf_url + ".md5"
+        )
+
+    def run_default_speeds(directory: path.Path) -> None:
+        download.download(DEFAULT_SPEEDS_URL, directory.joinpath("default_speeds.json"))
+
+    def run_region(directory: path.Path) -> None:
+        subprocess.run(
+            [
+                "osmium",
+                "extract",
+                "--bbox",
+                ",".join(str(value) for value in bounds),
+                "--overwrite",
+                "-o",
+                str(directory.joinpath("region.osm.pbf")),
+                str(directory.joinpath("input.osm.pbf")),
+            ],
+            check=True,
+        )
+
+    def run_admins(directory: path.Path) -> None:
+        _run_tool(
+            "valhalla_build_admins",
+            str(directory.joinpath(input_name)),
+            config=directory.joinpath("valhalla.json"),
+        )
+
+    def run_timezones(directory: path.Path) -> None:
+        # The timezones tool writes the database to stdout and takes no config
+        timezones = subprocess.run(
+            [_tool("valhalla_build_timezones")],
+            check=True,
+            cwd=str(routing.lib_dir),
+            stdout=subprocess.PIPE,
+        )
+
+        with open(directory.joinpath("tz_world.sqlite"), "wb") as file:
+            file.write(timezones.stdout)
+
+    def run_tiles(directory: path.Path) -> None:
+        config = directory.joinpath("valhalla.json")
+        input_file = str(directory.joinpath(input_name))
+
+        # End at build stage, before enhance, so elevation can be added from the built tiles
+        _run_tool("valhalla_build_tiles", "-e", "build", input_file, config=config)
+        _run_tool("valhalla_build_elevation", "-v", "--from-tiles", "-z", config=config)
+
+        # Start at enhance stage, after build
+        _run_tool("valhalla_build_tiles", "-s", "enhance", input_file, config=config)
+
+    def run_extract(directory: path.Path) -> None:
+        _run_tool(
+            "valhalla_build_extract",
+            "-v",
+            "-O",
+            config=directory.joinpath("valhalla.json"),
+        )
+
+    stages = [
+        Stage(
+            name=scoped("config"),
+            outputs=["valhalla.json"],
+            run=run_config,
+            tools=["valhalla_build_config"],
+            params={"directory": str(directory)},
+        ),
+        Stage(
+            name="pbf",
+            outputs=["input.osm.pbf"],
+            run=run_pbf,
+            params={"url": pbf_url},
+            hash_outputs=True,
+        ),
+        Stage(
+            name="default_speeds",
+            outputs=["default_speeds.json"],
+            run=run_default_speeds,
+            params={"url": DEFAULT_SPEEDS_URL},
+            hash_outputs=True,
+        ),
+        Stage(
+            name=scoped("admins"),
+            outputs=["admin.sqlite"],
+            run=run_admins,
+            deps=[scoped("config"), input_stage],
+            tools=["valhalla_build_admins"],
+        ),
+        Stage(
+            name="timezones",
+            outputs=["tz_world.sqlite"],
+            run=run_timezones,
+            tools=["valhalla_build_timezones"],
+        ),
+        Stage(
+            name=scoped("tiles"),
+            outputs=["tiles", "elevation_data"],
+            run=run_tiles,
+            deps=[
+                scoped("config"),
+                input_stage,
+                "default_speeds",
+                scoped("admins"),
+                "timezones",
+            ],
+            tools=["valhalla_build_tiles", "valhalla_build_elevation"],
+        ),
+        Stage(
+            name=scoped("extract"),
+            outputs=["tiles.tar"],
+            run=run_extract,
+            deps=[scoped("config"), scoped("tiles")],
+            tools=["valhalla_build_extract"],
+        ),
+    ]
+
+    if region is not None:
+        if shutil.which("osmium") is None:
+            raise RuntimeError("osmium is required to build regional graphs.")
+
+        osmium_version = subprocess.run(
+            ["osmium", "--version"], check=True, stdout=subprocess.PIPE, text=True
+        ).stdout.splitlines()[0]
+
+        stages.append(
+            Stage(
+                name=scoped("region"),
+                outputs=["region.osm.pbf"],
+                run=run_region,
+                deps=["pbf"],
+                params={"bounds": bounds, "osmium": osmium_version},
+            )
+        )
+
+    return stages
@@ -0,0 +1,326 @@
+"""Module for caching pairwise travel times on disk.
+
+Travel times between the same pharmacies, distribution centers and snapped customer locations are requested
+over and over again across scenarios. The TravelTimeCache stores every computed pair in a SQLite database,
+keyed by the costing model, the quantized origin and destination coordinates and the version of the routing graph.
+Entries of an outdated graph are therefore never returned.
+
+The cache is bounded: once it holds more than max_entries pairs, the least recently used ones are evicted.
+
+Classes:
+    TravelTimeCache: A disk-backed pairwise travel-time cache.
+"""
+
+from __future__ import annotations
+from typing import Tuple
+import importlib.resources as res
+import pathlib as path
+import sqlite3
+import threading
+import time
+import numpy as np
+import pharmalink.code.matrix as matrix
+import pharmalink.code.routing as routing
+
+
+class TravelTimeCache:
+    """A disk-backed pairwise travel-time cache.
+
+    Attributes:
+        path (path.Path): The location of the SQLite database.
+        graph_version (str): The version of the routing graph the cached travel times belong to.
+        precision (int): The number of decimal places coordinates are quantized to (5 = ~1 m).
+        max_entries (int): The maximum number of cached pairs before the least recently used are evicted.
+        hits (int): The number of pairs found in the cache since initialization.
+        misses (int): The number of pairs not found in the cache since initialization.
+
+    Methods:
+        get:    Look up the travel times between sources and targets.
+        put:    Store travel times between sources and targets.
+        evict:  Remove the least recently used pairs beyond max_entries.
+        clear:  Remove all cached pairs.
+    """
+
+    __slots__ = [
+        "path",
+        "graph_version",
+        "precision",
+        "max_entries",
+        "hits",
+        "misses",
+        "_connection",
+        "_lock",
+        "_count",
+    ]
+
+    # Default location next to the cached graph build artifacts
+    default_path = res.files(__package__).joinpath(
+        "valhalla", "cache", "travel_times.sqlite"
+    )
+
+    def __init__(
+        self,
+        cache_path: path.Path | str | None = None,
+        graph_version: str | None = None,
+        precision: int = 5,
+        max_entries: int = 50_000_000,
+    ) -> None:
+        """Initialize a TravelTimeCache.
+
+        Parameters:
+            cache_path (path.Path | str | None): The SQLite database file. Defaults to default_path.
+            graph_version (str | None): The routing graph version. Defaults to routing.get_graph_version().
+            precision (int): The number of decimal places coordinates are quantized to.
+            max_entries (int): The maximum number of cached pairs.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        self.path = path.Path(cache_path or self.default_path)
+        self.graph_version = graph_version or routing.get_graph_version()
+        self.precision = precision
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # The connection is shared by the threads of compute_matrix, access is serialized by the lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS pairs (
+                costing TEXT NOT NULL,
+                version TEXT NOT NULL,
+                origin_lon INTEGER NOT NULL,
+                origin_lat INTEGER NOT NULL,
+                target_lon INTEGER NOT NULL,
+                target_lat INTEGER NOT NULL,
+                duration REAL,
+                distance REAL,
+                accessed INTEGER NOT NULL,
+                PRIMARY KEY (costing, version, origin_lon, origin_lat, target_lon, target_lat)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS pairs_accessed ON pairs (accessed);
+            """)
+
+        # Upper bound of the number of cached pairs, avoids a full count after every put
+        self._count = len(self)
+
+    def __repr__(self) -> str:
+        """Return all information about the TravelTimeCache object."""
+
+        return (
+            f"TravelTimeCache (Path: {self.path}, Graph: {self.graph_version}, "
+            f"Hits: {self.hits}, Misses: {self.misses})"
+        )
+
+    def __len__(self) -> int:
+        """Return the number of cached pairs."""
+
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM pairs").fetchone()[0]
+
+    def _keys(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        """Build the key columns (without costing and version) for all source/target pairs in row-major order."""
+
+        scale = 10**self.precision
+        sources = np.rint(np.asarray(sources).reshape(-1, 2) * scale).astype(np.int64)
+        targets = np.rint(np.asarray(targets).reshape(-1, 2) * scale).astype(np.int64)
+
+        return np.column_stack(
+            [
+                np.repeat(sources, len(targets), axis=0),
+                np.tile(targets, (len(sources), 1)),
+            ]
+        )
+
+    def get(
+        self, costing: str, sources: np.ndarray, targets: np.ndarray
+    ) -> Tuple[matrix.MatrixResult, np.ndarray]:
+        """Look up the travel times between sources and targets.
+
+        Parameters:
+            costing (str): The costing model.
+            sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+            targets (np.ndarray): Target (longitude, latitude) pairs, shape (m, 2).
+
+        Returns:
+            result (matrix.MatrixResult): The cached travel times, NaN where not cached or unreachable.
+            found (np.ndarray): Boolean mask of shape (n, m) of all pairs found in the cache.
+
+        Raises:
+            None
+        """
+
+        num_sources, num_targets = len(sources), len(targets)
+        keys = self._keys(sources, targets)
+
+        result = matrix.MatrixResult.empty(num_sources, num_targets)
+        found = np.zeros(num_sources * num_targets, dtype=bool)
+
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS lookup (
+                    position INTEGER PRIMARY KEY,
+                    origin_lon INTEGER, origin_lat INTEGER,
+                    target_lon INTEGER, target_lat INTEGER
+                )
+                """)
+            cursor.execute("DELETE FROM lookup")
+            cursor.executemany(
+                "INSERT INTO lookup VALUES (?, ?, ?, ?, ?)",
+                ((i, *map(int, key)) for i, key in enumerate(keys)),
+            )
+            rows = cursor.execute(
+                """
+                SELECT lookup.position, pairs.duration, pairs.distance
+                FROM lookup JOIN pairs
+                    ON pairs.costing = ? AND pairs.version = ?
+                    AND pairs.origin_lon = lookup.origin_lon AND pairs.origin_lat = lookup.origin_lat
+                    AND pairs.target_lon = lookup.target_lon AND pairs.target_lat = lookup.target_lat
+                """,
+                (costing, self.graph_version),
+            ).fetchall()
+
+            # Mark the found pairs as recently used
+            cursor.execute(
+                """
+                UPDATE pairs SET accessed = ?
+                WHERE costing = ? AND version = ?
+                AND (origin_lon, origin_lat, target_lon, target_lat) IN (
+                    SELECT origin_lon, origin_lat, target_lon, target_lat FROM lookup
+                )
+                """,
+                (time.time_ns(), costing, self.graph_version),
+            )
+            self._connection.commit()
+
+            # The statistics are shared by all threads as well
+            self.hits += len(rows)
+            self.misses += len(keys) - len(rows)
+
+        if rows:
+            positions, durations, distances = zip(*rows)
+            positions = np.array(positions, dtype=np.int64)
+            found[positions] = True
+            result.durations.flat[positions] = np.array(durations, dtype=float)
+            result.distances.flat[positions] = np.array(distances, dtype=float)
+
+        return result, found.reshape(num_sources, num_targets)
+
+    def put(
+        self,
+        costing: str,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        result: matrix.MatrixResult,
+        mask: np.ndarray | None = None,
+    ) -> None:
+        """Store travel times between sources and targets.
+
+        Unreachable pairs are stored as well, so they are not requested again.
+
+        Parameters:
+            costing (str): The costing model.
+            sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+            targets (np.ndarray): Target (longitude, latitude) pairs, shape (m, 2).
+            result (matrix.MatrixResult): The travel times of shape (n, m).
+            mask (np.ndarray | None): Boolean mask of shape (n, m) of the pairs to store. Defaults to all pairs.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        keys = self._keys(sources, targets)
+        durations = result.durations.ravel()
+        distances = result.distances.ravel()
+
+        positions = (
+            np.arange(len(keys)) if mask is None else np.flatnonzero(mask.ravel())
+        )
+
+        def value(x: float) -> float | None:
+            return None if np.isnan(x) else float(x)
+
+        accessed = time.time_ns()
+        rows = (
+            (
+                costing,
+                self.graph_version,
+                *map(int, keys[i]),
+                value(durations[i]),
+                value(distances[i]),
+                accessed,
+            )
+            for i in positions
+        )
+
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._connection.commit()
+            self._count += len(positions)
+
+        if self._count > self.max_entries:
+            self.evict()
+
+    def evict(self) -> int:
+        """Remove the least recently used pairs beyond max_entries.
+
+        Parameters:
+            None
+
+        Returns:
+            evicted (int): The number of removed pairs.
+
+        Raises:
+            None
+        """
+
+        with self._lock:
+            count = self._connection.execute("SELECT COUNT(*) FROM pairs").fetchone()[0]
+            excess = max(count - self.max_entries, 0)
+
+            if excess > 0:
+                self._connection.execute(
+                    """
+                    DELETE FROM pairs
+                    WHERE (costing, version, origin_lon, origin_lat, target_lon, target_lat) IN (
+                        SELECT costing, version, origin_lon, origin_lat, target_lon, target_lat
+                        FROM pairs ORDER BY accessed LIMIT ?
+                    )
+                    """,
+                    (excess,),
+                )
+                self._connection.commit()
+
+            self._count = count - excess
+
+        return excess
+
+    def clear(self) -> None:
+        """Remove all cached pairs and reset the hit/miss counters."""
+
+        with self._lock:
+            self._connection.execute("DELETE FROM pairs")
+            self._connection.commit()
+            self._count = 0
+            self.hits = 0
+            self.misses = 0
+
+    def close(self) -> None:
+        """Close the database connection."""
+
+        self._connection.close()
@@ -0,0 +1,246 @@
+"""Module for analysing how well customers are served by pharmacies and distribution centers.
+
+The analysis streams synthetic customers Kreis by Kreis (one shard at a time), queries the shared,
+loaded-once spatial indexes of all pharmacies and distribution centers and reduces the straight-line
+distances to fixed-bin histograms per regkey. Only the histograms are kept, so Germany-wide runs never
+hold more than one Kreis worth of customers in memory.
+
+In addition, census grid cells whose centre is farther away from the nearest pharmacy than a threshold
+are collected as underserved cells.
+
+Classes:
+    CoverageReport: Distance histograms and underserved cells per Kreis.
+
+Functions:
+    analyze_coverage: Run the coverage analysis for an area.
+"""
+
+from __future__ import annotations
+from typing import Iterator, Tuple
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pharmalink.code.area as area
+import pharmalink.code.customers as cust
+import pharmalink.code.sources as src
+import pharmalink.code.spatial as spatial
+
+# Targets whose distances are analysed, mapped to the source providing their spatial index
+TARGETS = {
+    "pharmacy": src.Pharmacies,
+    "dist_center": src.DistributionCenters,
+}
+
+
+class CoverageReport:
+    """Distance histograms and underserved cells per Kreis.
+
+    Attributes:
+        regkeys (list): The regkeys of all analysed Kreise, in row order of the histograms.
+        bins (np.ndarray): The histogram bin edges in metres. The last bin collects all larger distances.
+        histograms (dict): Histogram counts of shape (len(regkeys), len(bins) - 1) per target.
+        sums (dict): The summed distances per Kreis of shape (len(regkeys),) per target.
+        underserved_cells (gpd.GeoDataFrame): Census cells farther from a pharmacy than the threshold.
+
+    Methods:
+        add:            Add the distances of one shard to the histogram row of its Kreis.
+        percentiles:    Get distance percentiles for a target, optionally for a single Kreis.
+        get_summary:    Get a per-Kreis summary table.
+    """
+
+    __slots__ = ["regkeys", "bins", "histograms", "sums", "underserved_cells"]
+
+    def __init__(self, regkeys: list, bins: np.ndarray) -> None:
+        """Initialize an empty CoverageReport.
+
+        Parameters:
+            regkeys (list): The regkeys of all Kreise to be analysed.
+            bins (np.ndarray): The histogram bin edges in metres.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        self.regkeys = list(regkeys)
+        self.bins = np.asarray(bins, dtype=float)
+        self.histograms = {
+            target: np.zeros((len(regkeys), len(bins) - 1), dtype=np.int64)
+            for target in TARGETS
+        }
+        self.sums = {target: np.zeros(len(regkeys)) for target in TARGETS}
+        self.underserved_cells = gpd.GeoDataFrame()
+
+    def __repr__(self) -> str:
+        """Return all information about the CoverageReport object."""
+
+        customers = int(self.histograms["pharmacy"].sum())
+
+        return f"CoverageReport (Kreise: {len(self.regkeys)}, Customers: {customers})"
+
+    def add(self, row: int, target: str, distances: np.ndarray) -> None:
+        """Add the distances of one shard to the histogram row of its Kreis.
+
+        Parameters:
+            row (int): The row of the Kreis in regkeys.
+            target (str): The target the distances were measured to.
+            distances (np.ndarray): The distances in metres.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        # Distances beyond the last edge are collected in the last bin
+        bin_ids = np.searchsorted(self.bins, distances, side="right") - 1
+        bin_ids = np.clip(bin_ids, 0, len(self.bins) - 2)
+
+        self.histograms[target][row] += np.bincount(
+            bin_ids, minlength=len(self.bins) - 1
+        )
+        self.sums[target][row] += distances.sum()
+
+    def percentiles(
+        self, q: float | list, target: str = "pharmacy", regkey: str | None = None
+    ) -> np.ndarray:
+        """Get distance percentiles for a target, interpolated linearly within histogram bins.
+
+        Parameters:
+            q (float | list): The percentile(s) between 0 and 100.
+            target (str): The target, either "pharmacy" or "dist_center".
+            regkey (str | None): A single Kreis to get percentiles for. Defaults to all Kreise.
+
+        Returns:
+            percentiles (np.ndarray): The distance percentile(s) in metres.
+
+        Raises:
+            KeyError: If the target is unknown.
+            ValueError: If the regkey was not analysed.
+        """
+
+        histograms = self.histograms[target]
+
+        if regkey is None:
+            counts = histograms.sum(axis=0)
+        else:
+            counts = histograms[self.regkeys.index(regkey)]
+
+        cumulative = np.r_[0, np.cumsum(counts)]
+        ranks = np.asarray(q, dtype=float) / 100 * cumulative[-1]
+
+        # Percentiles within the open-ended last bin are reported as its lower edge
+        edges = np.minimum(self.bins, self.bins[-2])
+
+        return np.interp(ranks, cumulative, edges)
+
+    def get_summary(self, q: tuple = (50, 90, 99)) -> pd.DataFrame:
+        """Get a per-Kreis summary table.
+
+        Parameters:
+            q (tuple): The percentiles to include.
+
+        Returns:
+            summary (pd.DataFrame): Customer counts, mean distances and percentiles per target and Kreis.
+
+        Raises:
+            None
+        """
+
+        summary = pd.DataFrame(index=pd.Index(self.regkeys, name="regkey"))
+        summary["customers"] = self.histograms["pharmacy"].sum(axis=1)
+
+        for target in TARGETS:
+            summary[f"{target}_mean"] = self.sums[target] / np.maximum(
+                summary["customers"], 1
+            )
+            for percentile in q:
+                summary[f"{target}_p{percentile}"] = [
+                    self.percentiles(percentile, target, regkey)
+                    for regkey in self.regkeys
+                ]
+
+        return summary
+
+
+def _stream_customers(regkeys: list) -> Iterator[Tuple[int, area.Area, np.ndarray]]:
+    """Generate the customers of one Kreis at a time as projected coordinates."""
+
+    for row, regkey in enumerate(regkeys):
+        kreis = area.Area(regkey)
+        customers = cust.Customers(kreis)
+
+        yield row, kreis, spatial.get_coordinates(customers.customers)
+
+
+def _underserved_cells(kreis: area.Area, max_distance: float) -> gpd.GeoDataFrame:
+    """Get all populated census cells of a Kreis farther from a pharmacy than max_distance."""
+
+    cells = src.PopulationGrids.get_within_area(kreis)
+    cells = cells[cells["population"] > 0]
+
+    centres = cells.geometry.to_crs(epsg=spatial.PROJECTED_CRS).centroid
+    coordinates = shapely.get_coordinates(centres.values)
+
+    distances, _ = src.Pharmacies.get_index().nearest(coordinates)
+    distances = distances[:, 0]
+
+    underserved = cells[distances > max_distance].copy()
+    underserved["distance"] = distances[distances > max_distance]
+    underserved["regkey"] = kreis.regkey
+
+    return underserved
+
+
+def analyze_coverage(
+    coverage_area: area.Area,
+    bin_width: float = 100,
+    max_distance: float = 50_000,
+    underserved_distance: float = 5_000,
+) -> CoverageReport:
+    """Run the coverage analysis for an area.
+
+    Parameters:
+        coverage_area (area.Area): The area to analyse, e.g. area.Area("00") for the whole country.
+        bin_width (float): The width of the histogram bins in metres.
+        max_distance (float): The upper edge of the last regular histogram bin in metres.
+        underserved_distance (float): The distance to the nearest pharmacy above which a census cell
+            is considered underserved, in metres.
+
+    Returns:
+        report (CoverageReport): The distance histograms and underserved cells per Kreis.
+
+    Raises:
+        TypeError: If coverage_area is not an instance of area.Area.
+    """
+
+    # check if Area is valid
+    if not isinstance(coverage_area, area.Area):
+        raise TypeError("coverage_area must be an instance of area.Area.")
+
+    regkeys = src.AdminAreas.get_kreis_regkeys(coverage_area.regkey)
+
+    # The last bin is open-ended, so all distances beyond max_distance are kept as well
+    bins = np.r_[np.arange(0, max_distance + bin_width, bin_width), np.inf]
+    report = CoverageReport(regkeys, bins)
+
+    # Build the shared indexes once before streaming
+    indexes = {target: source.get_index() for target, source in TARGETS.items()}
+
+    underserved = []
+
+    for row, kreis, coordinates in _stream_customers(regkeys):
+        for target, index in indexes.items():
+            distances, _ = index.nearest(coordinates)
+            report.add(row, target, distances[:, 0])
+
+        underserved.append(_underserved_cells(kreis, underserved_distance))
+
+    if underserved:
+        report.underserved_cells = pd.concat(underserved, ignore_index=True)
+
+    return report
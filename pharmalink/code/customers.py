@@ -22,7 +22,7 @@
 import math
 import pharmalink.code.area as area
 import pharmalink.code.sources as src
-import random
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import folium as fl
@@ -44,11 +44,23 @@ class Customers:
 
     __slots__ = ["_area", "customers"]
 
-    def __init__(self, customer_area: area.Area) -> None:
+    def __init__(
+        self,
+        customer_area: area.Area,
+        seed: int | None = None,
+        residential_areas: gpd.GeoDataFrame | None = None,
+        population_grid: gpd.GeoDataFrame | None = None,
+    ) -> None:
         """Initialize a collection of customers.
 
         Parameters:
-
+            customer_area (area.Area): The area to generate customers for.
+            seed (int | None): The seed of the random generation, None for a random seed.
+                The same area and seed always generate the same customers.
+            residential_areas (gpd.GeoDataFrame | None): The already loaded residential areas of the area.
+                Defaults to ResidentialAreas.get_within_area.
+            population_grid (gpd.GeoDataFrame | None): The already loaded population grid of the area.
+                Defaults to PopulationGrids.get_within_area.
 
         Returns:
             None
@@ -62,7 +74,9 @@ class Customers:
             raise TypeError("Area must be an instance of area.Area.")
 
         self._area = customer_area
-        self.customers = self._generate_customers(self._area)
+        self.customers = self._generate_customers(
+            self._area, seed, residential_areas, population_grid
+        )
 
     def __str__(self) -> str:
         """Return information about the Customers object."""
@@ -146,11 +160,20 @@ class Customers:
         # Return the map
         return map
 
-    def _generate_customers(self, area: area.Area) -> gpd.GeoDataFrame:
+    def _generate_customers(
+        self,
+        area: area.Area,
+        seed: int | None = None,
+        residential_areas: gpd.GeoDataFrame | None = None,
+        population_grid: gpd.GeoDataFrame | None = None,
+    ) -> gpd.GeoDataFrame:
         """Generate randomized but realistic daily customers for a given area.
 
         Parameters:
             AreaGeometry (geo.AreaGeometry): The area to generate customers for.
+            seed (int | None): The seed of the random generation.
+            residential_areas (gpd.GeoDataFrame | None): The residential areas, loaded if not given.
+            population_grid (gpd.GeoDataFrame | None): The population grid, loaded if not given.
 
         Returns:
             gpd.GeoDataFrame: A GeoDataFrame containing the generated customers.
@@ -165,10 +188,18 @@ class Customers:
 
         # warnings.filterwarnings("ignore", category=FutureWarning)
 
-        residential_areas = src.ResidentialAreas.get_within_area(area)
+        # All random draws come from one generator, so a seed reproduces the customers
+        rng = np.random.default_rng(seed)
+
+        if residential_areas is None:
+            residential_areas = src.ResidentialAreas.get_within_area(area)
         residential_areas = residential_areas.unary_union
 
-        population_grid = src.PopulationGrids.get_within_area(area)
+        # The population values are rescaled below, so given grids are copied
+        if population_grid is None:
+            population_grid = src.PopulationGrids.get_within_area(area)
+        else:
+            population_grid = population_grid.copy()
 
         # Scale the population values to match the area's total population
         # Differences can occur due to statistical obfuscation and clipping of the cells to the area boundaries
@@ -203,7 +234,7 @@ class Customers:
                 actual_customers = int_part
 
                 # additional customer with the probability of decimal_part
-                if random.random() < decimal_part:
+                if rng.random() < decimal_part:
                     actual_customers += 1
 
                 cell_customers.append(int(actual_customers))
@@ -212,7 +243,7 @@ class Customers:
             cell_customers = [0 if math.isnan(x) else x for x in cell_customers]
 
             # sample the determined number of customers for each grid cell
-            customer_locs = population_grid.sample_points(cell_customers)
+            customer_locs = population_grid.sample_points(cell_customers, rng=rng)
 
             # Remove all empty entries (= cells without customers) and explode the
             # MultiPoints into a single Point for each customer
@@ -236,7 +267,7 @@ class Customers:
 
             if diff < 0:
                 # sample exactly the number of customers needed from the too large customer list
-                customers = customers.sample(demand)
+                customers = customers.sample(demand, random_state=rng)
 
         # convert the customers to a GeoDataFrame
         customers = gpd.GeoDataFrame(geometry=customers)
@@ -0,0 +1,380 @@
+"""Module for routing large delivery problems by spatial decomposition.
+
+The demand of a Bundesland or of all of Germany cannot be routed as one VRP, since the travel-time matrix
+alone grows quadratically with the number of customers. Instead, the problem is decomposed:
+
+1. Every customer is served by its nearest distribution center (DistributionCenters.get_index).
+2. The customers of every distribution center are split into sectors of at most cluster_size customers
+   by their bearing from the center. Delivery routes start and end at the center, so sectors keep
+   routes compact and adjacent sectors are the only ones whose routes can overlap.
+3. Every sector is solved independently by vrp.solve in a pool of worker processes, while the matrices
+   of further sectors are computed by the routing backend.
+4. The routes are stitched into one plan, then the routes of adjacent sectors of the same distribution
+   center are jointly improved (border repair) in up to three rounds of disjoint sector pairs. Borders between
+   distribution centers are not repaired, as a subproblem has a single depot.
+
+Every subproblem has a bounded size, so the effort grows linearly with the number of customers
+and is spread over all cores.
+
+Classes:
+    DeliveryPlan: The stitched routes of a decomposed delivery problem.
+
+Functions:
+    assign_depots:      Assign every customer to its nearest distribution center.
+    split_sectors:      Split the customers of a depot into sectors of bounded size.
+    solve_decomposed:   Route customers by solving depot sectors in parallel and repairing their borders.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Tuple
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import multiprocessing as mp
+import os
+import numpy as np
+import pharmalink.code.area as area
+import pharmalink.code.backends as backends
+import pharmalink.code.sources as src
+import pharmalink.code.spatial as spatial
+import pharmalink.code.vrp as vrp
+
+
+@dataclass
+class DeliveryPlan:
+    """The stitched routes of a decomposed delivery problem.
+
+    Attributes:
+        routes (List[np.ndarray]): The customer ids of every route in visiting order.
+        depots (np.ndarray): The distribution center (point id of the index) of every route.
+        route_costs (np.ndarray): The travel time of every route in seconds.
+        loads (np.ndarray): The total demand of every route.
+        unserved (np.ndarray): The customers that cannot be served from their distribution center.
+        depot_of (np.ndarray): The distribution center of every customer.
+        sector_of (np.ndarray): The sector of every customer.
+    """
+
+    routes: List[np.ndarray]
+    depots: np.ndarray
+    route_costs: np.ndarray
+    loads: np.ndarray
+    unserved: np.ndarray
+    depot_of: np.ndarray
+    sector_of: np.ndarray
+
+    @property
+    def cost(self) -> float:
+        """The total travel time of all routes in seconds."""
+
+        return float(self.route_costs.sum())
+
+
+def assign_depots(
+    coordinates: np.ndarray, index: spatial.PointIndex | None = None
+) -> np.ndarray:
+    """Assign every customer to its nearest distribution center.
+
+    Parameters:
+        coordinates (np.ndarray): The customer coordinates in the metric CRS, shape (n, 2).
+        index (spatial.PointIndex | None): The distribution centers. Defaults to DistributionCenters.get_index().
+
+    Returns:
+        depots (np.ndarray): The point id of the nearest distribution center per customer.
+
+    Raises:
+        None
+    """
+
+    if index is None:
+        index = src.DistributionCenters.get_index()
+    _, nearest = index.nearest(coordinates, k=1)
+
+    return nearest[:, 0]
+
+
+def split_sectors(
+    coordinates: np.ndarray, depot: np.ndarray, cluster_size: int
+) -> np.ndarray:
+    """Split the customers of a depot into sectors of bounded size.
+
+    Customers are ordered by their bearing from the depot and cut into equally sized consecutive
+    sectors, so sector ids are in angular order and sector i borders sectors i - 1 and i + 1 (cyclic).
+
+    Parameters:
+        coordinates (np.ndarray): The customer coordinates in the metric CRS, shape (n, 2).
+        depot (np.ndarray): The depot coordinates in the metric CRS, shape (2,).
+        cluster_size (int): The maximum number of customers per sector.
+
+    Returns:
+        sectors (np.ndarray): The sector id per customer.
+
+    Raises:
+        None
+    """
+
+    offsets = np.asarray(coordinates, dtype=float) - depot
+    order = np.argsort(np.arctan2(offsets[:, 1], offsets[:, 0]), kind="stable")
+
+    count = -(-len(order) // cluster_size)
+
+    sectors = np.empty(len(order), dtype=np.int64)
+    sectors[order] = np.arange(len(order)) * count // max(len(order), 1)
+
+    return sectors
+
+
+def _solve_subproblem(
+    durations: np.ndarray,
+    problem_kwargs: Dict[str, Any],
+    routes: List[List[int]] | None,
+    time_limit: float,
+    seed: int,
+) -> vrp.VrpSolution:
+    """Solve a subproblem in a worker process, optionally starting from given routes."""
+
+    problem = vrp.VrpProblem(durations, **problem_kwargs)
+
+    return vrp.solve(problem, time_limit=time_limit, seed=seed, routes=routes)
+
+
+def _group(labels: np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """Group element ids by label with a single sort, returning the labels and the ids of each."""
+
+    if len(labels) == 0:
+        return labels, []
+
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+
+    return sorted_labels[starts], np.split(order, starts[1:])
+
+
+def _border_pairs(count: int, step: int) -> List[Tuple[int, int]]:
+    """Get disjoint pairs of adjacent sectors of a ring in round step (0, 1 or 2).
+
+    Round 0 pairs every even sector with the next one, round 1 every odd sector (including the
+    last with the first sector if count is even). An odd ring of three or more sectors has its
+    closing border (count - 1, 0) left for round 2, so every border is repaired exactly once.
+    """
+
+    if step == 2:
+        return [(count - 1, 0)] if count > 2 and count % 2 == 1 else []
+
+    pairs = [(i, i + 1) for i in range(step, count - 1, 2)]
+
+    if step == 1 and count > 2 and count % 2 == 0:
+        pairs.append((count - 1, 0))
+
+    return pairs
+
+
+def solve_decomposed(
+    backend: backends.RoutingBackend,
+    locations: np.ndarray,
+    demands: np.ndarray | None = None,
+    capacity: float = np.inf,
+    service_time: float = 0.0,
+    time_windows: np.ndarray | None = None,
+    max_duration: float = np.inf,
+    costing: str = "auto",
+    cluster_size: int = 500,
+    time_limit: float = 10.0,
+    repair_time_limit: float = 5.0,
+    max_workers: int | None = None,
+    seed: int | None = None,
+    index: spatial.PointIndex | None = None,
+) -> DeliveryPlan:
+    """Route customers by solving depot sectors in parallel and repairing their borders.
+
+    Parameters:
+        backend (backends.RoutingBackend): The routing backend for the travel-time matrices.
+        locations (np.ndarray): The customer (longitude, latitude) pairs, shape (n, 2).
+        demands (np.ndarray | None): The demand per customer. Defaults to 1 each.
+        capacity (float): The capacity of every vehicle.
+        service_time (float): The service time per customer in seconds.
+        time_windows (np.ndarray | None): The earliest and latest service start per customer, shape (n, 2).
+        max_duration (float): The maximum duration of a route in seconds.
+        costing (str): The costing model of the routes.
+        cluster_size (int): The maximum number of customers per sector.
+        time_limit (float): The time budget of the local search per sector in seconds.
+        repair_time_limit (float): The time budget of the local search per sector pair in seconds.
+        max_workers (int | None): The number of worker processes. Defaults to the number of CPU cores.
+        seed (int | None): The seed all subproblem seeds are derived from.
+        index (spatial.PointIndex | None): The distribution centers. Defaults to DistributionCenters.get_index().
+
+    Returns:
+        plan (DeliveryPlan): The routes of all distribution centers.
+
+    Raises:
+        None
+    """
+
+    if index is None:
+        index = src.DistributionCenters.get_index()
+    max_workers = max_workers or os.cpu_count()
+
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    demands = np.ones(len(locations)) if demands is None else np.asarray(demands)
+
+    coordinates = spatial.project(locations[:, 0], locations[:, 1])
+    depot_locations = spatial.project(
+        index.coordinates[:, 0], index.coordinates[:, 1], inverse=True
+    )
+
+    # Sectors of every depot, numbered globally in angular order per depot
+    depot_of = assign_depots(coordinates, index)
+    sector_of = np.empty(len(locations), dtype=np.int64)
+    sectors = []
+    rings = []
+
+    depots, members_of = _group(depot_of)
+    for depot, members in zip(depots.tolist(), members_of):
+        local = split_sectors(
+            coordinates[members], index.coordinates[depot], cluster_size
+        )
+
+        first = len(sectors)
+        sectors.extend([depot] * (local.max() + 1))
+        sector_of[members] = first + local
+        rings.append(list(range(first, len(sectors))))
+
+    seeds = iter(
+        int(child.generate_state(1)[0])
+        for child in np.random.SeedSequence(seed).spawn(len(sectors) * 3)
+    )
+
+    def build(depot: int, customers: np.ndarray) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Compute the matrix and constraints of a subproblem with the depot as node 0."""
+
+        result = backend.matrix(
+            np.vstack([depot_locations[depot], locations[customers]]), costing=costing
+        )
+
+        problem_kwargs = {
+            "demands": np.r_[0.0, demands[customers]],
+            "capacity": capacity,
+            "service_times": service_time,
+            "max_duration": max_duration,
+        }
+
+        if time_windows is not None:
+            problem_kwargs["time_windows"] = np.vstack(
+                [[0.0, np.inf], time_windows[customers]]
+            )
+
+        return result.durations, problem_kwargs
+
+    # Routes as customer ids per sector
+    routes = [[] for _ in sectors]
+    route_costs = [[] for _ in sectors]
+    unserved = []
+
+    def collect(
+        customers: np.ndarray, solution: vrp.VrpSolution
+    ) -> List[Tuple[np.ndarray, float]]:
+        """Translate the routes of a subproblem solution to customer ids."""
+
+        unserved.extend(customers[solution.unserved - 1].tolist())
+
+        return [
+            (customers[route - 1], cost)
+            for route, cost in zip(solution.routes, solution.route_costs.tolist())
+        ]
+
+    # Matrices are computed by threads while the processes solve the sectors already built
+    with ThreadPoolExecutor(max_workers=max_workers) as threads, ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=mp.get_context("spawn")
+    ) as processes:
+
+        def solve_all(subproblems: List[Tuple[int, np.ndarray, List | None, float]]):
+            """Build and solve subproblems of (depot, customers, start routes, time limit)."""
+
+            built = {
+                threads.submit(build, depot, customers): (customers, start, limit)
+                for depot, customers, start, limit in subproblems
+            }
+            solving = {}
+
+            for future in as_completed(built):
+                customers, start, limit = built[future]
+                durations, problem_kwargs = future.result()
+
+                solving[
+                    processes.submit(
+                        _solve_subproblem,
+                        durations,
+                        problem_kwargs,
+                        start,
+                        limit,
+                        next(seeds),
+                    )
+                ] = customers
+
+            for future in as_completed(solving):
+                yield solving[future], future.result()
+
+        # Sector ids are consecutive from 0, so every sector is one group
+        _, customers_of = _group(sector_of)
+
+        for customers, solution in solve_all(
+            [
+                (depot, customers, None, time_limit)
+                for depot, customers in zip(sectors, customers_of)
+            ]
+        ):
+            sector = sector_of[customers[0]]
+            for route, cost in collect(customers, solution):
+                routes[sector].append(route)
+                route_costs[sector].append(cost)
+
+        # Border repair: jointly improve the routes of disjoint pairs of adjacent sectors
+        for step in (0, 1, 2):
+            pairs = [
+                (ring[a], ring[b])
+                for ring in rings
+                for a, b in _border_pairs(len(ring), step)
+            ]
+            pairs = [(a, b) for a, b in pairs if routes[a] and routes[b]]
+
+            subproblems = []
+            for a, b in pairs:
+                # Node ids of the start routes in the joint subproblem (the depot is node 0)
+                customers = np.concatenate(routes[a] + routes[b])
+                order = np.argsort(customers)
+                start = [
+                    (
+                        order[np.searchsorted(customers, route, sorter=order)] + 1
+                    ).tolist()
+                    for route in routes[a] + routes[b]
+                ]
+                subproblems.append((sectors[a], customers, start, repair_time_limit))
+
+                routes[a], routes[b], route_costs[a], route_costs[b] = [], [], [], []
+
+            for customers, solution in solve_all(subproblems):
+                for route, cost in collect(customers, solution):
+                    # Every repaired route belongs to the sector most of its customers come from
+                    route_sectors, counts = np.unique(
+                        sector_of[route], return_counts=True
+                    )
+                    sector = route_sectors[counts.argmax()]
+                    routes[sector].append(route)
+                    route_costs[sector].append(cost)
+
+    route_depots = [
+        sectors[sector] for sector in range(len(sectors)) for _ in routes[sector]
+    ]
+    routes = [route for sector in routes for route in sector]
+
+    return DeliveryPlan(
+        routes=routes,
+        depots=np.array(route_depots, dtype=np.int64),
+        route_costs=np.array(
+            [cost for sector in route_costs for cost in sector], dtype=float
+        ),
+        loads=np.array([demands[route].sum() for route in routes], dtype=float),
+        unserved=np.array(sorted(unserved), dtype=np.int64),
+        depot_of=depot_of,
+        sector_of=sector_of,
+    )
@@ -0,0 +1,259 @@
+"""Module for downloading large input files of the pharmalink model.
+
+The OSM input file of the graph build is around 4 GB in size. Downloads therefore
+- write in large buffered chunks,
+- are split into parallel ranged segments if the server supports HTTP Range requests,
+- resume from a partial file after a broken connection instead of starting over,
+- are verified against a published MD5 checksum (e.g. Geofabrik's .md5 files) and
+- only replace the target file atomically once complete and verified.
+
+While downloading, the data is written to <target>.part and the progress of every segment is kept in
+<target>.part.json. A later download of the same URL continues where the previous one stopped,
+as long as the remote file has not changed in between.
+
+Functions:
+    download:   Download a file with resume, parallel segments and checksum verification.
+    fetch_md5:  Fetch a published MD5 checksum.
+"""
+
+from __future__ import annotations
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import pathlib as path
+import hashlib
+import json
+import os
+import threading
+import time
+import requests as req
+
+# Size of the chunks read from the network and written to disk
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Minimum size of a parallel segment, smaller files are downloaded in one piece
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def fetch_md5(url: str, timeout: float = 60) -> str:
+    """Fetch a published MD5 checksum.
+
+    Checksum files hold the hex digest, optionally followed by the file name ("<md5>  <name>").
+
+    Parameters:
+        url (str): The URL of the checksum file.
+        timeout (float): The timeout of the request in seconds.
+
+    Returns:
+        md5 (str): The hex digest.
+
+    Raises:
+        requests.HTTPError: If the checksum file cannot be fetched.
+    """
+
+    response = req.get(url, timeout=timeout)
+    response.raise_for_status()
+
+    return response.text.split()[0].lower()
+
+
+def _file_md5(file: path.Path) -> str:
+    """Compute the MD5 hex digest of a file."""
+
+    digest = hashlib.md5()
+    with open(file, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _probe(session: req.Session, url: str, timeout: float) -> dict:
+    """Get the size, version and range support of a remote file."""
+
+    response = session.head(url, allow_redirects=True, timeout=timeout)
+    response.raise_for_status()
+
+    size = response.headers.get("Content-Length")
+
+    return {
+        "url": url,
+        "size": int(size) if size is not None else None,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "ranges": response.headers.get("Accept-Ranges", "").lower() == "bytes",
+    }
+
+
+def _plan_segments(size: int | None, ranges: bool, segments: int) -> List[dict]:
+    """Split a file into contiguous byte ranges ("end" is exclusive, None = unknown size)."""
+
+    if size is None or not ranges:
+        return [{"start": 0, "end": size, "done": 0}]
+
+    count = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    bounds = [size * i // count for i in range(count + 1)]
+
+    return [
+        {"start": start, "end": end, "done": 0}
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def download(
+    url: str,
+    target: path.Path,
+    md5: str | None = None,
+    md5_url: str | None = None,
+    segments: int = 4,
+    retries: int = 3,
+    timeout: float = 60,
+) -> path.Path:
+    """Download a file with resume, parallel segments and checksum verification.
+
+    Parameters:
+        url (str): The URL of the file.
+        target (path.Path): The location of the downloaded file.
+        md5 (str | None): The expected MD5 hex digest of the file.
+        md5_url (str | None): The URL of a checksum file holding the expected MD5, e.g. url + ".md5".
+        segments (int): The maximum number of segments downloaded in parallel.
+        retries (int): The number of retries of a failed segment, each resuming where it stopped.
+        timeout (float): The timeout of a single request in seconds.
+
+    Returns:
+        target (path.Path): The location of the downloaded file.
+
+    Raises:
+        requests.HTTPError: If the server rejects a request.
+        RuntimeError: If a segment still fails after all retries or the checksum does not match.
+    """
+
+    target = path.Path(target)
+    part = target.with_name(target.name + ".part")
+    state_file = target.with_name(target.name + ".part.json")
+
+    if md5 is None and md5_url is not None:
+        md5 = fetch_md5(md5_url, timeout=timeout)
+
+    with req.Session() as session:
+        remote = _probe(session, url, timeout)
+
+        # Continue a previous download only if the remote file is unchanged
+        state = None
+        if state_file.exists() and part.exists():
+            with open(state_file, "r") as file:
+                state = json.load(file)
+
+            if state["remote"] != remote:
+                state = None
+
+        if state is None:
+            state = {
+                "remote": remote,
+                "segments": _plan_segments(remote["size"], remote["ranges"], segments),
+            }
+
+            # Preallocate the partial file, so every segment can write at its own offset
+            with open(part, "wb") as file:
+                if remote["size"] is not None:
+                    file.truncate(remote["size"])
+
+        # Without range support a partial download cannot be resumed
+        if not remote["ranges"]:
+            state["segments"][0]["done"] = 0
+
+        lock = threading.Lock()
+        total = remote["size"]
+        print(
+            f"Downloading {url} ({'unknown size' if total is None else f'{total / 1e6:.0f} MB'}, "
+            f"{len(state['segments'])} segment(s))..."
+        )
+
+        def save_state() -> None:
+            temporary = state_file.with_name(state_file.name + ".tmp")
+            with open(temporary, "w") as file:
+                json.dump(state, file)
+            os.replace(temporary, state_file)
+
+        # Progress is reported in steps of 10 percent
+        reported = [0]
+
+        def report_progress() -> None:
+            if total:
+                step = 10 * sum(s["done"] for s in state["segments"]) // total
+                if step > reported[0]:
+                    reported[0] = step
+                    print(f"{10 * step}% downloaded.")
+
+        def fetch_segment(segment: dict) -> None:
+            for attempt in range(retries + 1):
+                position = segment["start"] + segment["done"]
+
+                if segment["end"] is not None and position >= segment["end"]:
+                    return
+
+                headers = {}
+                if remote["ranges"]:
+                    end = "" if segment["end"] is None else segment["end"] - 1
+                    headers["Range"] = f"bytes={position}-{end}"
+
+                try:
+                    with session.get(
+                        url, headers=headers, stream=True, timeout=timeout
+                    ) as response:
+                        response.raise_for_status()
+
+                        if remote["ranges"] and response.status_code != 206:
+                            raise RuntimeError("Server ignored the range request.")
+
+                        with open(part, "r+b") as file:
+                            file.seek(position)
+
+                            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                                file.write(chunk)
+
+                                with lock:
+                                    segment["done"] += len(chunk)
+                                    save_state()
+                                    report_progress()
+
+                    if segment["end"] is None:
+                        segment["end"] = segment["start"] + segment["done"]
+
+                    if segment["start"] + segment["done"] >= segment["end"]:
+                        return
+
+                except (
+                    req.ConnectionError,
+                    req.Timeout,
+                    req.exceptions.ChunkedEncodingError,
+                ) as error:
+                    print(f"Download interrupted ({error}), resuming...")
+
+                    # Without range support the segment starts over
+                    if not remote["ranges"]:
+                        segment["done"] = 0
+
+                time.sleep(2**attempt)
+
+            raise RuntimeError(f"Download of {url} failed after {retries} retries.")
+
+        with ThreadPoolExecutor(max_workers=len(state["segments"])) as executor:
+            # Consume the results to raise errors of any segment
+            list(executor.map(fetch_segment, state["segments"]))
+
+    # A file of unknown size may have been longer in an earlier attempt
+    if total is None:
+        os.truncate(part, state["segments"][0]["end"])
+
+    if md5 is not None and _file_md5(part) != md5:
+        part.unlink()
+        state_file.unlink()
+        raise RuntimeError(f"Checksum mismatch for {url}. The download was discarded.")
+
+    # Only a complete and verified file replaces the target
+    os.replace(part, target)
+    state_file.unlink()
+
+    print(f"Downloaded {target.name}.")
+
+    return target
@@ -0,0 +1,373 @@
+"""Module for estimating road distances and travel times without routing every pair.
+
+Most pairs in a customer x pharmacy matrix are irrelevant because they are far apart. The DetourModel
+is calibrated on a few thousand exact routing queries per area and estimates network distances as
+great-circle distance times a detour factor, and travel times from an average speed.
+Both are fitted per distance band and per urban density class (from the census population grid),
+as detours are larger on short trips and travel speeds are lower in dense cities.
+
+The calibrated model is then used to keep only each source's K most plausible targets for exact routing,
+turning a dense matrix into a sparse one.
+
+Classes:
+    DetourModel: A calibrated distance and travel-time estimator.
+
+Functions:
+    population_density: Look up the population density of the census cells containing coordinates.
+"""
+
+from __future__ import annotations
+from typing import Tuple
+import json
+import pathlib as path
+import numpy as np
+import geopandas as gpd
+import shapely
+import pharmalink.code.area as area
+import pharmalink.code.backends as backends
+import pharmalink.code.matrix as matrix
+import pharmalink.code.sources as src
+import pharmalink.code.spatial as spatial
+
+# Upper edges of the distance bands in kilometres (great-circle distance)
+DISTANCE_BANDS = [0.5, 1, 2, 5, 10, 20, 50, np.inf]
+
+# Upper edges of the density classes in inhabitants per km² (rural, suburban, urban, metropolitan)
+DENSITY_CLASSES = [300, 1500, 5000, np.inf]
+
+# Area of a census grid cell in km²
+CELL_AREA = 0.01
+
+
+def population_density(grid: gpd.GeoDataFrame, coordinates: np.ndarray) -> np.ndarray:
+    """Look up the population density of the census cells containing coordinates.
+
+    Parameters:
+        grid (gpd.GeoDataFrame): A population grid, e.g. from sources.PopulationGrids.get_within_area.
+        coordinates (np.ndarray): (longitude, latitude) pairs, shape (n, 2).
+
+    Returns:
+        densities (np.ndarray): Inhabitants per km² per coordinate. 0 outside of all populated cells.
+
+    Raises:
+        None
+    """
+
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+    densities = np.zeros(len(coordinates))
+
+    points = gpd.GeoSeries(shapely.points(coordinates), crs=4326).to_crs(grid.crs)
+    point_ids, cell_ids = grid.sindex.query(points.values, predicate="within")
+
+    densities[point_ids] = grid["population"].to_numpy()[cell_ids] / CELL_AREA
+
+    return densities
+
+
+class DetourModel:
+    """A calibrated distance and travel-time estimator.
+
+    Attributes:
+        costing (str): The costing model the estimator was calibrated for.
+        detour_factors (np.ndarray): Network/great-circle distance ratios, shape (distance bands, density classes).
+        speeds (np.ndarray): Average speeds in km/h, shape (distance bands, density classes).
+        samples (np.ndarray): The number of calibration pairs per band and class.
+
+    Methods:
+        fit:        Calibrate the model on exact routing results for an area.
+        estimate:   Estimate a travel-time matrix between sources and targets.
+        prune:      Select the K most plausible targets per source.
+        save:       Store the model as JSON.
+        load:       Load a model from JSON.
+    """
+
+    __slots__ = ["costing", "detour_factors", "speeds", "samples"]
+
+    def __init__(self, costing: str = "auto") -> None:
+        """Initialize an uncalibrated DetourModel with the haversine backend's defaults.
+
+        Parameters:
+            costing (str): The costing model, one of "auto", "bicycle" or "pedestrian".
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: If the costing is not supported.
+        """
+
+        if costing not in matrix.COSTINGS:
+            raise ValueError(f"Costing must be one of {matrix.COSTINGS}.")
+
+        shape = (len(DISTANCE_BANDS), len(DENSITY_CLASSES))
+
+        self.costing = costing
+        self.detour_factors = np.full(shape, backends.DETOUR_FACTORS[costing])
+        self.speeds = np.full(shape, backends.SPEEDS[costing])
+        self.samples = np.zeros(shape, dtype=np.int64)
+
+    def __repr__(self) -> str:
+        """Return all information about the DetourModel object."""
+
+        return f"DetourModel (Costing: {self.costing}, Samples: {self.samples.sum()})"
+
+    @staticmethod
+    def _classify(
+        great_circle: np.ndarray, densities: np.ndarray | None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the distance band and density class ids for great-circle distances (km) and densities."""
+
+        bands = np.searchsorted(DISTANCE_BANDS, great_circle, side="left")
+        bands = np.minimum(bands, len(DISTANCE_BANDS) - 1)
+
+        if densities is None:
+            classes = np.zeros(np.shape(great_circle), dtype=np.int64)
+        else:
+            classes = np.searchsorted(DENSITY_CLASSES, densities, side="left")
+            classes = np.minimum(classes, len(DENSITY_CLASSES) - 1)
+
+        return bands, classes
+
+    def fit(
+        self,
+        fit_area: area.Area,
+        backend: backends.RoutingBackend,
+        num_points: int = 60,
+        local_radius: float = 2.0,
+        min_samples: int = 10,
+        seed: int | None = None,
+    ) -> DetourModel:
+        """Calibrate the model on exact routing results for an area.
+
+        num_points origins are drawn from the area's population grid, weighted by population.
+        Half of the destinations are drawn the same way, the other half are placed within local_radius
+        of an origin, so that short trips are represented as well. The full origin x destination matrix
+        (num_points² pairs) is then routed with the exact backend.
+
+        Parameters:
+            fit_area (area.Area): The area to calibrate for.
+            backend (backends.RoutingBackend): The exact routing backend.
+            num_points (int): The number of origins and destinations.
+            local_radius (float): The maximum offset of the local destinations in kilometres.
+            min_samples (int): The minimum number of pairs for a band/class to be fitted on its own.
+                Bands/classes with fewer pairs use the fit over all density classes of their band.
+            seed (int | None): Seed for the random number generator.
+
+        Returns:
+            model (DetourModel): The calibrated model itself.
+
+        Raises:
+            TypeError: If fit_area is not an instance of area.Area.
+        """
+
+        # check if Area is valid
+        if not isinstance(fit_area, area.Area):
+            raise TypeError("fit_area must be an instance of area.Area.")
+
+        rng = np.random.default_rng(seed)
+
+        grid = src.PopulationGrids.get_within_area(fit_area)
+        grid = grid[grid["population"] > 0].to_crs(epsg=4326)
+
+        # Draw cells weighted by population and use their centroids as locations
+        weights = grid["population"].to_numpy(dtype=float)
+        centroids = shapely.get_coordinates(
+            grid.to_crs(epsg=spatial.PROJECTED_CRS).centroid.values
+        )
+        cells = rng.choice(
+            len(grid), size=num_points * 3 // 2, p=weights / weights.sum()
+        )
+        drawn = centroids[cells]
+
+        origins = drawn[:num_points]
+        far = drawn[num_points:]
+
+        # Local destinations: random offsets around random origins
+        offsets = rng.uniform(-1, 1, (num_points - len(far), 2)) * local_radius * 1000
+        near = origins[rng.integers(0, num_points, len(offsets))] + offsets
+
+        destinations = np.vstack([far, near])
+
+        origins = spatial.project(origins[:, 0], origins[:, 1], inverse=True)
+        destinations = spatial.project(
+            destinations[:, 0], destinations[:, 1], inverse=True
+        )
+
+        exact = backend.matrix(origins, destinations, self.costing)
+
+        great_circle = backends.haversine(
+            *np.radians(origins).T[:, :, None], *np.radians(destinations).T[:, None, :]
+        )
+        densities = np.broadcast_to(
+            population_density(grid, origins)[:, None], great_circle.shape
+        )
+
+        # Only reachable pairs with a meaningful distance are used for the fit
+        valid = exact.reachable & (great_circle > 0.05) & (exact.distances > 0)
+
+        ratios = exact.distances[valid] / great_circle[valid]
+        speeds = exact.distances[valid] / (exact.durations[valid] / 3600)
+        bands, classes = self._classify(great_circle[valid], densities[valid])
+
+        for band in range(len(DISTANCE_BANDS)):
+            in_band = bands == band
+
+            # Fall back to the band over all classes, or keep the defaults if the band is empty
+            if in_band.sum() >= min_samples:
+                self.detour_factors[band] = np.median(ratios[in_band])
+                self.speeds[band] = np.median(speeds[in_band])
+
+            for density_class in range(len(DENSITY_CLASSES)):
+                selected = in_band & (classes == density_class)
+                self.samples[band, density_class] = selected.sum()
+
+                if selected.sum() >= min_samples:
+                    self.detour_factors[band, density_class] = np.median(
+                        ratios[selected]
+                    )
+                    self.speeds[band, density_class] = np.median(speeds[selected])
+
+        return self
+
+    def estimate(
+        self,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        densities: np.ndarray | None = None,
+    ) -> matrix.MatrixResult:
+        """Estimate a travel-time matrix between sources and targets.
+
+        Parameters:
+            sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+            targets (np.ndarray): Target (longitude, latitude) pairs, shape (m, 2).
+            densities (np.ndarray | None): Population density per source, see population_density.
+                If not given, the rural density class is used for all sources.
+
+        Returns:
+            result (matrix.MatrixResult): Estimated durations and distances of shape (n, m).
+
+        Raises:
+            None
+        """
+
+        sources = np.radians(np.asarray(sources, dtype=float).reshape(-1, 2))
+        targets = np.radians(np.asarray(targets, dtype=float).reshape(-1, 2))
+
+        great_circle = backends.haversine(
+            sources[:, 0, None], sources[:, 1, None], targets[:, 0], targets[:, 1]
+        )
+
+        if densities is not None:
+            densities = np.broadcast_to(
+                np.asarray(densities)[:, None], great_circle.shape
+            )
+
+        bands, classes = self._classify(great_circle, densities)
+
+        distances = great_circle * self.detour_factors[bands, classes]
+        durations = distances / self.speeds[bands, classes] * 3600
+
+        return matrix.MatrixResult(
+            durations=durations.astype(np.float32),
+            distances=distances.astype(np.float32),
+        )
+
+    def prune(
+        self,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        k: int = 10,
+        densities: np.ndarray | None = None,
+        chunk_size: int = 1024,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Select the K most plausible targets per source by estimated travel time.
+
+        Parameters:
+            sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+            targets (np.ndarray): Target (longitude, latitude) pairs, shape (m, 2).
+            k (int): The number of candidates per source.
+            densities (np.ndarray | None): Population density per source, see population_density.
+            chunk_size (int): The number of sources estimated at once to bound memory use.
+
+        Returns:
+            candidates (np.ndarray): Target ids per source sorted by estimated duration, shape (n, min(k, m)).
+            durations (np.ndarray): The estimated durations in seconds, shape (n, min(k, m)).
+
+        Raises:
+            None
+        """
+
+        sources = np.asarray(sources, dtype=float).reshape(-1, 2)
+        k = min(k, len(targets))
+
+        candidates = np.empty((len(sources), k), dtype=np.int64)
+        durations = np.empty((len(sources), k), dtype=np.float32)
+
+        for start in range(0, len(sources), chunk_size):
+            stop = start + chunk_size
+            chunk_densities = None if densities is None else densities[start:stop]
+            estimate = self.estimate(sources[start:stop], targets, chunk_densities)
+
+            # Partial selection of the k smallest, then sorting of only those
+            selected = np.argpartition(estimate.durations, k - 1, axis=1)[:, :k]
+            selected_durations = np.take_along_axis(estimate.durations, selected, 1)
+            order = np.argsort(selected_durations, axis=1)
+
+            candidates[start:stop] = np.take_along_axis(selected, order, 1)
+            durations[start:stop] = np.take_along_axis(selected_durations, order, 1)
+
+        return candidates, durations
+
+    def save(self, file: path.Path | str) -> None:
+        """Store the model as JSON.
+
+        Parameters:
+            file (path.Path | str): The target file.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        model = {
+            "costing": self.costing,
+            "distance_bands": DISTANCE_BANDS,
+            "density_classes": DENSITY_CLASSES,
+            "detour_factors": self.detour_factors.tolist(),
+            "speeds": self.speeds.tolist(),
+            "samples": self.samples.tolist(),
+        }
+
+        with open(file, "w") as f:
+            json.dump(model, f)
+
+    @classmethod
+    def load(cls, file: path.Path | str) -> DetourModel:
+        """Load a model from JSON.
+
+        Parameters:
+            file (path.Path | str): The source file.
+
+        Returns:
+            model (DetourModel): The loaded model.
+
+        Raises:
+            ValueError: If the model was stored with different bands or classes.
+        """
+
+        with open(file, "r") as f:
+            stored = json.load(f)
+
+        if stored["distance_bands"] != DISTANCE_BANDS or (
+            stored["density_classes"] != DENSITY_CLASSES
+        ):
+            raise ValueError("Model was calibrated with different bands or classes.")
+
+        model = cls(stored["costing"])
+        model.detour_factors = np.array(stored["detour_factors"])
+        model.speeds = np.array(stored["speeds"])
+        model.samples = np.array(stored["samples"], dtype=np.int64)
+
+        return model
@@ -0,0 +1,425 @@
+"""Module for siting the distribution centers of pharmaceutical wholesalers.
+
+The facility-location problem chooses which candidate sites (e.g. distribution centers) to open and which
+open site supplies every demand point (e.g. pharmacy), minimizing fixed site costs plus transport costs.
+The archived PuLP prototype (archive/CashLog/basicModel.py) builds the model element by element with
+pandas lookups and one x[w, r] <= y[w] constraint per pair, which does not scale to Germany.
+
+Here, the mixed-integer program is assembled as sparse arrays in a few vectorized steps and solved with
+HiGHS through scipy.optimize.milp:
+
+- Only pairs within a maximum travel time (or straight-line distance) become variables, so the model
+  grows with the number of relevant pairs instead of sites x demand points.
+- Transport costs are read from a dense or sparse (SparseMatrix) travel-time matrix of shape
+  (sites, demand points), weighted by the demand of every point.
+- Linking constraints are either disaggregated (x[s, d] <= y[s] per pair, tighter LP relaxation) or
+  aggregated (sum_d x[s, d] <= n_s * y[s] per site, far fewer rows).
+
+Classes:
+    LocationModel:  The sparse arrays of a facility-location MILP.
+    LocationResult: The opened sites and assignment of a solved facility-location problem.
+
+Functions:
+    route_candidate_pairs:      Route all site-demand pairs within a straight-line distance.
+    build_model:                Assemble the facility-location MILP from a travel-time matrix.
+    solve_model:                Solve a facility-location MILP with HiGHS.
+    locate_distribution_centers: Choose distribution centers to supply all pharmacies.
+"""
+
+from __future__ import annotations
+from typing import List
+from dataclasses import dataclass
+import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import Bounds, LinearConstraint, milp
+from scipy.spatial import cKDTree
+import pharmalink.code.area as area
+import pharmalink.code.backends as backends
+import pharmalink.code.sources as src
+import pharmalink.code.sparse as sparse
+import pharmalink.code.spatial as spatial
+
+
+@dataclass
+class LocationModel:
+    """The sparse arrays of a facility-location MILP.
+
+    The variables are y (one per site, open or not) followed by x (one per pair, share of the demand point
+    supplied by the site).
+
+    Attributes:
+        num_sites (int): The number of candidate sites.
+        num_demands (int): The number of demand points.
+        pair_sites (np.ndarray): The site of every pair.
+        pair_demands (np.ndarray): The demand point of every pair.
+        costs (np.ndarray): The objective coefficient of every variable.
+        integrality (np.ndarray): 1 for integer and 0 for continuous variables.
+        bounds (Bounds): The variable bounds.
+        constraints (List[LinearConstraint]): The constraint blocks.
+    """
+
+    num_sites: int
+    num_demands: int
+    pair_sites: np.ndarray
+    pair_demands: np.ndarray
+    costs: np.ndarray
+    integrality: np.ndarray
+    bounds: Bounds
+    constraints: List[LinearConstraint]
+
+    @property
+    def num_rows(self) -> int:
+        """The number of constraint rows."""
+
+        return sum(constraint.A.shape[0] for constraint in self.constraints)
+
+
+@dataclass
+class LocationResult:
+    """The opened sites and assignment of a solved facility-location problem.
+
+    Attributes:
+        open (np.ndarray): Whether every site is opened.
+        assignment (np.ndarray): The site supplying the largest share of every demand point.
+        fixed_cost (float): The fixed costs of all opened sites.
+        transport_cost (float): The transport costs of all pairs.
+        gap (float): The relative MIP gap of the solution.
+        message (str): The status message of the solver.
+    """
+
+    open: np.ndarray
+    assignment: np.ndarray
+    fixed_cost: float
+    transport_cost: float
+    gap: float
+    message: str
+
+    @property
+    def total_cost(self) -> float:
+        """The fixed plus transport costs."""
+
+        return self.fixed_cost + self.transport_cost
+
+
+def route_candidate_pairs(
+    backend: backends.RoutingBackend,
+    site_locations: np.ndarray,
+    demand_locations: np.ndarray,
+    max_distance: float,
+    costing: str = "auto",
+) -> sparse.SparseMatrix:
+    """Route all site-demand pairs within a straight-line distance.
+
+    Every demand point keeps at least its nearest site, so no demand point is left without a candidate.
+    Every site is routed against its own candidates as a one-row matrix request.
+
+    Parameters:
+        backend (backends.RoutingBackend): The routing backend.
+        site_locations (np.ndarray): The site (longitude, latitude) pairs, shape (s, 2).
+        demand_locations (np.ndarray): The demand point (longitude, latitude) pairs, shape (d, 2).
+        max_distance (float): The straight-line distance in metres beyond which pairs are dropped.
+        costing (str): The costing model.
+
+    Returns:
+        travel_times (sparse.SparseMatrix): The travel times of the candidate pairs, shape (s, d).
+
+    Raises:
+        None
+    """
+
+    site_locations = np.asarray(site_locations, dtype=float).reshape(-1, 2)
+    demand_locations = np.asarray(demand_locations, dtype=float).reshape(-1, 2)
+
+    demand_coordinates = spatial.project(demand_locations[:, 0], demand_locations[:, 1])
+    site_coordinates = spatial.project(site_locations[:, 0], site_locations[:, 1])
+    site_tree = cKDTree(site_coordinates)
+
+    neighbours = site_tree.query_ball_point(demand_coordinates, r=max_distance)
+    _, nearest = site_tree.query(demand_coordinates, k=1)
+
+    demands = np.repeat(np.arange(len(demand_locations)), [len(n) for n in neighbours])
+    sites = np.fromiter(
+        (site for n in neighbours for site in n), dtype=np.int64, count=len(demands)
+    )
+
+    sites = np.r_[sites, nearest]
+    demands = np.r_[demands, np.arange(len(demand_locations))]
+
+    # Unique pairs, grouped by site
+    pairs = np.unique(np.column_stack([sites, demands]), axis=0)
+    sites, demands = pairs[:, 0], pairs[:, 1]
+    bounds = np.searchsorted(sites, np.arange(len(site_locations) + 1))
+
+    durations = np.empty(len(sites), dtype=np.float32)
+    distances = np.empty(len(sites), dtype=np.float32)
+
+    for site, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if start == stop:
+            continue
+
+        routed = backend.matrix(
+            site_locations[site : site + 1],
+            demand_locations[demands[start:stop]],
+            costing,
+        )
+        durations[start:stop] = routed.durations[0]
+        distances[start:stop] = routed.distances[0]
+
+    return sparse.SparseMatrix._from_rows(
+        (len(site_locations), len(demand_locations)),
+        sites,
+        demands,
+        durations,
+        distances,
+        np.float32,
+    )
+
+
+def build_model(
+    travel_times: np.ndarray | sparse.SparseMatrix,
+    fixed_costs: np.ndarray | float,
+    demands: np.ndarray | None = None,
+    cost_per_second: float = 1.0,
+    max_time: float = np.inf,
+    capacities: np.ndarray | None = None,
+    num_open: int | None = None,
+    force_open: np.ndarray | list = (),
+    aggregated: bool = False,
+    single_source: bool = False,
+) -> LocationModel:
+    """Assemble the facility-location MILP from a travel-time matrix.
+
+    Parameters:
+        travel_times (np.ndarray | sparse.SparseMatrix): Travel times in seconds, shape (sites, demand points).
+            Unreachable (NaN, inf) and, for sparse matrices, unstored pairs are no candidates.
+        fixed_costs (np.ndarray | float): The fixed cost of opening each site.
+        demands (np.ndarray | None): The demand of every demand point. Defaults to 1 each.
+        cost_per_second (float): The transport cost per unit of demand and second of travel time.
+        max_time (float): The travel time in seconds beyond which pairs are dropped.
+        capacities (np.ndarray | None): The maximum demand supplied by each site, None for unlimited.
+        num_open (int | None): The exact number of sites to open, None for any number.
+        force_open (np.ndarray | list): Sites that must be opened.
+        aggregated (bool): Link pairs to sites with one aggregated row per site instead of one row per pair.
+        single_source (bool): Supply every demand point from exactly one site (binary pair variables).
+
+    Returns:
+        model (LocationModel): The assembled model.
+
+    Raises:
+        ValueError: If a demand point has no candidate site.
+    """
+
+    num_sites, num_demands = travel_times.shape
+    demands = np.ones(num_demands) if demands is None else np.asarray(demands, float)
+    fixed_costs = np.broadcast_to(np.asarray(fixed_costs, dtype=float), (num_sites,))
+
+    # Candidate pairs and their travel times
+    if isinstance(travel_times, sparse.SparseMatrix):
+        sites = np.repeat(np.arange(num_sites), np.diff(travel_times.indptr))
+        demand_points = np.asarray(travel_times.indices, dtype=np.int64)
+        times = travel_times.get(sites, demand_points)
+    else:
+        times = np.asarray(travel_times, dtype=float)
+        sites, demand_points = np.nonzero(~np.isnan(times))
+        times = times[sites, demand_points]
+
+    keep = np.isfinite(times) & (times <= max_time)
+    sites, demand_points, times = sites[keep], demand_points[keep], times[keep]
+
+    if uncovered := num_demands - len(np.unique(demand_points)):
+        raise ValueError(
+            f"{uncovered} demand points have no candidate site within {max_time} s."
+        )
+
+    num_pairs = len(sites)
+    pair_ids = num_sites + np.arange(num_pairs)
+
+    costs = np.r_[fixed_costs, cost_per_second * demands[demand_points] * times]
+
+    # Every demand point is fully supplied: sum_s x[s, d] == 1
+    constraints = [
+        LinearConstraint(
+            sp.csr_array(
+                (np.ones(num_pairs), (demand_points, pair_ids)),
+                shape=(num_demands, num_sites + num_pairs),
+            ),
+            1,
+            1,
+        )
+    ]
+
+    # Pairs may only be used by opened sites
+    if aggregated:
+        # sum_d x[s, d] - n_s * y[s] <= 0
+        counts = np.bincount(sites, minlength=num_sites)
+        rows = np.r_[sites, np.arange(num_sites)]
+        columns = np.r_[pair_ids, np.arange(num_sites)]
+        values = np.r_[np.ones(num_pairs), -counts]
+        shape = (num_sites, num_sites + num_pairs)
+    else:
+        # x[s, d] - y[s] <= 0
+        rows = np.r_[np.arange(num_pairs), np.arange(num_pairs)]
+        columns = np.r_[pair_ids, sites]
+        values = np.r_[np.ones(num_pairs), -np.ones(num_pairs)]
+        shape = (num_pairs, num_sites + num_pairs)
+
+    constraints.append(
+        LinearConstraint(
+            sp.csr_array((values, (rows, columns)), shape=shape), -np.inf, 0
+        )
+    )
+
+    # sum_d demand[d] * x[s, d] - capacity[s] * y[s] <= 0
+    if capacities is not None:
+        capacities = np.broadcast_to(np.asarray(capacities, dtype=float), (num_sites,))
+        constraints.append(
+            LinearConstraint(
+                sp.csr_array(
+                    (
+                        np.r_[demands[demand_points], -capacities],
+                        (
+                            np.r_[sites, np.arange(num_sites)],
+                            np.r_[pair_ids, np.arange(num_sites)],
+                        ),
+                    ),
+                    shape=(num_sites, num_sites + num_pairs),
+                ),
+                -np.inf,
+                0,
+            )
+        )
+
+    # sum_s y[s] == num_open
+    if num_open is not None:
+        constraints.append(
+            LinearConstraint(
+                sp.csr_array(
+                    (
+                        np.ones(num_sites),
+                        (np.zeros(num_sites, dtype=np.int64), np.arange(num_sites)),
+                    ),
+                    shape=(1, num_sites + num_pairs),
+                ),
+                num_open,
+                num_open,
+            )
+        )
+
+    lower = np.zeros(num_sites + num_pairs)
+    lower[np.asarray(force_open, dtype=np.int64)] = 1
+
+    return LocationModel(
+        num_sites=num_sites,
+        num_demands=num_demands,
+        pair_sites=sites,
+        pair_demands=demand_points,
+        costs=costs,
+        integrality=np.r_[
+            np.ones(num_sites), np.full(num_pairs, 1 if single_source else 0)
+        ],
+        bounds=Bounds(lower, 1),
+        constraints=constraints,
+    )
+
+
+def solve_model(
+    model: LocationModel, time_limit: float | None = None, mip_gap: float = 1e-4
+) -> LocationResult:
+    """Solve a facility-location MILP with HiGHS.
+
+    Parameters:
+        model (LocationModel): The model, e.g. from build_model.
+        time_limit (float | None): The time limit of the solver in seconds, None for unlimited.
+        mip_gap (float): The relative MIP gap at which the solver stops.
+
+    Returns:
+        result (LocationResult): The opened sites and assignment.
+
+    Raises:
+        RuntimeError: If the solver finds no feasible solution.
+    """
+
+    options = {"mip_rel_gap": mip_gap}
+    if time_limit is not None:
+        options["time_limit"] = time_limit
+
+    solution = milp(
+        model.costs,
+        integrality=model.integrality,
+        bounds=model.bounds,
+        constraints=model.constraints,
+        options=options,
+    )
+
+    if solution.x is None:
+        raise RuntimeError(f"No feasible solution found: {solution.message}")
+
+    opened = solution.x[: model.num_sites] > 0.5
+    shares = solution.x[model.num_sites :]
+
+    # Site with the largest share of every demand point
+    order = np.lexsort((-shares, model.pair_demands))
+    first = np.r_[True, model.pair_demands[order][1:] != model.pair_demands[order][:-1]]
+
+    assignment = np.full(model.num_demands, -1, dtype=np.int64)
+    assignment[model.pair_demands[order][first]] = model.pair_sites[order][first]
+
+    fixed_cost = float(model.costs[: model.num_sites] @ opened)
+
+    return LocationResult(
+        open=opened,
+        assignment=assignment,
+        fixed_cost=fixed_cost,
+        transport_cost=float(model.costs[model.num_sites :] @ shares),
+        gap=float(getattr(solution, "mip_gap", 0.0) or 0.0),
+        message=solution.message,
+    )
+
+
+def locate_distribution_centers(
+    backend: backends.RoutingBackend,
+    fixed_costs: np.ndarray | float,
+    demands: np.ndarray | None = None,
+    max_distance: float = 150_000,
+    costing: str = "auto",
+    time_limit: float | None = None,
+    **model_kwargs,
+) -> LocationResult:
+    """Choose distribution centers to supply all pharmacies.
+
+    The candidate sites are all distribution centers (DistributionCenters.get_index), the demand points
+    all pharmacies (Pharmacies.get_index), both in the order of their point ids.
+
+    Parameters:
+        backend (backends.RoutingBackend): The routing backend for the travel times.
+        fixed_costs (np.ndarray | float): The fixed cost of operating each distribution center.
+        demands (np.ndarray | None): The demand of every pharmacy. Defaults to 1 each.
+        max_distance (float): The straight-line distance in metres beyond which pairs are dropped.
+        costing (str): The costing model.
+        time_limit (float | None): The time limit of the solver in seconds, None for unlimited.
+        **model_kwargs: Further arguments of build_model, e.g. num_open, capacities or aggregated.
+
+    Returns:
+        result (LocationResult): The opened distribution centers and the one supplying every pharmacy.
+
+    Raises:
+        ValueError: If a pharmacy has no candidate distribution center.
+        RuntimeError: If the solver finds no feasible solution.
+    """
+
+    sites = src.DistributionCenters.get_index()
+    pharmacies = src.Pharmacies.get_index()
+
+    travel_times = route_candidate_pairs(
+        backend,
+        spatial.project(sites.coordinates[:, 0], sites.coordinates[:, 1], inverse=True),
+        spatial.project(
+            pharmacies.coordinates[:, 0], pharmacies.coordinates[:, 1], inverse=True
+        ),
+        max_distance,
+        costing,
+    )
+
+    model = build_model(travel_times, fixed_costs, demands, **model_kwargs)
+
+    return solve_model(model, time_limit=time_limit)
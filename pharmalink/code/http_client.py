@@ -0,0 +1,269 @@
+"""Module for routing against a Valhalla HTTP service.
+
+Besides the in-process Python bindings, Valhalla can run as a standalone HTTP service (e.g. the Docker setup
+in archive/old_valhalla.py on port 8002), which allows scaling routing horizontally onto separate machines.
+
+The ValhallaClient talks to such a service through a pooled keep-alive session. It exposes the same request
+methods as a valhalla.Actor, so it can be used wherever an actor is expected (e.g. matrix.compute_matrix or
+backends.ValhallaBackend). For high throughput, requests can also be pipelined with asyncio under a
+concurrency limit. Failed requests (connection errors, timeouts, overload responses) are retried with
+exponential backoff.
+
+Classes:
+    ValhallaClient: A client for a Valhalla HTTP service.
+"""
+
+from __future__ import annotations
+from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import json
+import time
+import numpy as np
+import requests as req
+from requests.adapters import HTTPAdapter
+import pharmalink.code.matrix as matrix
+
+# Valhalla service endpoints per actor action
+ENDPOINTS = {
+    "route": "route",
+    "matrix": "sources_to_targets",
+    "isochrone": "isochrone",
+    "locate": "locate",
+    "optimized_route": "optimized_route",
+    "status": "status",
+}
+
+# HTTP status codes which indicate a temporary problem worth retrying
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class ValhallaClient:
+    """A client for a Valhalla HTTP service.
+
+    Attributes:
+        base_url (str): The URL of the service, e.g. "http://localhost:8002".
+        concurrency (int): The maximum number of requests in flight.
+        retries (int): The number of retries of a failed request.
+        backoff (float): The delay before the first retry in seconds, doubled for every further retry.
+        timeout (float): The timeout of a single request in seconds.
+
+    Methods:
+        request:        Send a request and return the JSON response string.
+        route:          Compute a route.
+        matrix:         Compute a travel-time matrix.
+        isochrone:      Compute isochrones.
+        locate:         Locate coordinates on the graph.
+        arequest:       Send a request from asyncio code.
+        compute_matrix: Compute a travel-time matrix from asyncio code.
+        close:          Close all pooled connections.
+    """
+
+    __slots__ = [
+        "base_url",
+        "concurrency",
+        "retries",
+        "backoff",
+        "timeout",
+        "_session",
+        "_executor",
+    ]
+
+    def __init__(
+        self,
+        base_url: str = "http://localhost:8002",
+        concurrency: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 60,
+    ) -> None:
+        """Initialize a ValhallaClient.
+
+        Parameters:
+            base_url (str): The URL of the service.
+            concurrency (int): The maximum number of requests in flight (and pooled connections).
+            retries (int): The number of retries of a failed request.
+            backoff (float): The delay before the first retry in seconds.
+            timeout (float): The timeout of a single request in seconds.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # One keep-alive connection per concurrent request, retries are handled by request()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=concurrency, max_retries=0
+        )
+        self._session = req.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        # Blocking requests are run on these threads when called from asyncio code
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def __repr__(self) -> str:
+        """Return all information about the ValhallaClient object."""
+
+        return f"ValhallaClient (URL: {self.base_url}, Concurrency: {self.concurrency})"
+
+    def __enter__(self) -> ValhallaClient:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def request(self, action: str, request: str | dict | None = None) -> str:
+        """Send a request and return the JSON response string.
+
+        Parameters:
+            action (str): The actor action, e.g. "route", "matrix" or "isochrone".
+            request (str | dict | None): The request as JSON string or dict.
+
+        Returns:
+            response (str): The JSON response string.
+
+        Raises:
+            ValueError: If the action is not supported.
+            RuntimeError: If the service rejects the request or all retries failed.
+        """
+
+        if action not in ENDPOINTS:
+            raise ValueError(f"Action must be one of {tuple(ENDPOINTS)}.")
+
+        if isinstance(request, dict):
+            request = json.dumps(request)
+
+        url = f"{self.base_url}/{ENDPOINTS[action]}"
+
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+
+            try:
+                response = self._session.post(
+                    url,
+                    data=request,
+                    headers={"Content-Type": "application/json"},
+                    timeout=self.timeout,
+                )
+                response.raise_for_status()
+
+                return response.text
+
+            except (req.ConnectionError, req.Timeout) as error:
+                if last_attempt:
+                    raise RuntimeError(
+                        f"Valhalla service unavailable: {error}"
+                    ) from error
+
+            except req.HTTPError as error:
+                if response.status_code not in RETRY_STATUS or last_attempt:
+                    raise RuntimeError(
+                        f"Valhalla request failed ({response.status_code}): {response.text}"
+                    ) from error
+
+            time.sleep(self.backoff * 2**attempt)
+
+    def route(self, request: str) -> str:
+        """Compute a route."""
+
+        return self.request("route", request)
+
+    def matrix(self, request: str) -> str:
+        """Compute a travel-time matrix."""
+
+        return self.request("matrix", request)
+
+    def isochrone(self, request: str) -> str:
+        """Compute isochrones."""
+
+        return self.request("isochrone", request)
+
+    def locate(self, request: str) -> str:
+        """Locate coordinates on the graph."""
+
+        return self.request("locate", request)
+
+    async def arequest(self, action: str, request: str | dict | None = None) -> str:
+        """Send a request from asyncio code.
+
+        The blocking request runs on the client's thread pool, whose size limits the number of requests in flight.
+
+        Parameters:
+            action (str): The actor action, e.g. "route", "matrix" or "isochrone".
+            request (str | dict | None): The request as JSON string or dict.
+
+        Returns:
+            response (str): The JSON response string.
+
+        Raises:
+            ValueError: If the action is not supported.
+            RuntimeError: If the service rejects the request or all retries failed.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self._executor, self.request, action, request)
+
+    async def compute_matrix(
+        self,
+        sources: np.ndarray,
+        targets: np.ndarray | None = None,
+        costing: str = "auto",
+        max_pairs: int | None = None,
+        cache: Any = None,
+    ) -> matrix.MatrixResult:
+        """Compute a travel-time matrix from asyncio code.
+
+        Runs matrix.compute_matrix with the client as router, so the tiling and the optional travel-time cache
+        are the same, while up to concurrency blocks are in flight at once.
+
+        Parameters:
+            sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+            targets (np.ndarray | None): Target (longitude, latitude) pairs, shape (m, 2). Defaults to sources.
+            costing (str): The costing model, one of "auto", "bicycle" or "pedestrian".
+            max_pairs (int | None): The maximum number of location pairs per request.
+                Defaults to matrix.MAX_LOCATION_PAIRS.
+            cache (Any): An optional cache.TravelTimeCache. Only pairs missing from the cache are requested.
+
+        Returns:
+            result (matrix.MatrixResult): Durations and distances of shape (n, m).
+
+        Raises:
+            ValueError: If the costing is not supported.
+            RuntimeError: If a block request fails.
+        """
+
+        # Resolved here, as the matrix method shadows the matrix module in the class body
+        max_pairs = max_pairs or matrix.MAX_LOCATION_PAIRS
+        loop = asyncio.get_running_loop()
+
+        # compute_matrix blocks its thread while its own threads send up to concurrency block requests
+        return await loop.run_in_executor(
+            None,
+            functools.partial(
+                matrix.compute_matrix,
+                self,
+                sources,
+                targets,
+                costing,
+                max_pairs=max_pairs,
+                max_workers=self.concurrency,
+                cache=cache,
+            ),
+        )
+
+    def close(self) -> None:
+        """Close all pooled connections."""
+
+        self._executor.shutdown(wait=True)
+        self._session.close()
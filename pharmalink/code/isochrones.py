@@ -0,0 +1,330 @@
+"""Module for computing isochrone catchments of pharmacies and distribution centers.
+
+Questions like "which customers can reach a pharmacy within 10 minutes on foot" would otherwise need a route
+per customer. Instead, one Valhalla isochrone request per site and mode of transport yields the polygons
+reachable within each time band (e.g. 5, 10 and 15 minutes). Customers are then labelled in bulk by
+point-in-polygon queries against a spatial index over all polygons, so the routing effort scales with the
+number of sites instead of the number of customers.
+
+Isochrones only change with the routing graph, so they are cached on disk per graph version.
+
+Classes:
+    IsochroneCache: A disk-backed cache of isochrone polygons.
+
+Functions:
+    compute_isochrones: Compute the isochrone polygons of sites at the given time bands.
+    label_customers:    Label customers with the smallest time band and site whose catchment contains them.
+"""
+
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import importlib.resources as res
+import pathlib as path
+import sqlite3
+import threading
+import json
+import numpy as np
+import geopandas as gpd
+import shapely
+import pharmalink.code.matrix as matrix
+import pharmalink.code.routing as routing
+
+if TYPE_CHECKING:
+    import pharmalink.code.area as area
+
+# Default time bands in minutes
+CONTOURS = (5, 10, 15)
+
+
+class IsochroneCache:
+    """A disk-backed cache of isochrone polygons.
+
+    Polygons are keyed by the costing model, the quantized site coordinates, the time band
+    and the version of the routing graph, so polygons of an outdated graph are never returned.
+
+    Attributes:
+        path (path.Path): The location of the SQLite database.
+        graph_version (str): The version of the routing graph the cached polygons belong to.
+        precision (int): The number of decimal places coordinates are quantized to (5 = ~1 m).
+
+    Methods:
+        get:    Look up the polygons of a site.
+        put:    Store the polygons of a site.
+        clear:  Remove all cached polygons.
+        close:  Close the database connection.
+    """
+
+    __slots__ = ["path", "graph_version", "precision", "_connection", "_lock"]
+
+    # Default location next to the cached graph build artifacts
+    default_path = res.files(__package__).joinpath(
+        "valhalla", "cache", "isochrones.sqlite"
+    )
+
+    def __init__(
+        self,
+        cache_path: path.Path | str | None = None,
+        graph_version: str | None = None,
+        precision: int = 5,
+        area: area.Area | None = None,
+    ) -> None:
+        """Initialize an IsochroneCache.
+
+        Parameters:
+            cache_path (path.Path | str | None): The SQLite database file. Defaults to default_path.
+            graph_version (str | None): The routing graph version. Defaults to the version of the graph
+                of area, see routing.get_graph_version.
+            precision (int): The number of decimal places coordinates are quantized to.
+            area (area.Area | None): The area whose regional graph the router uses, None for the graph
+                of Germany.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        self.path = path.Path(cache_path or self.default_path)
+        self.graph_version = graph_version or routing.get_graph_version(area)
+        self.precision = precision
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # The connection is shared by the threads of compute_isochrones, access is serialized by the lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS isochrones (
+                costing TEXT NOT NULL,
+                version TEXT NOT NULL,
+                lon INTEGER NOT NULL,
+                lat INTEGER NOT NULL,
+                minutes REAL NOT NULL,
+                geometry BLOB NOT NULL,
+                PRIMARY KEY (costing, version, lon, lat, minutes)
+            ) WITHOUT ROWID;
+            """)
+
+    def __repr__(self) -> str:
+        """Return all information about the IsochroneCache object."""
+
+        return f"IsochroneCache (Path: {self.path}, Graph: {self.graph_version})"
+
+    def _key(self, costing: str, location: np.ndarray) -> tuple:
+        """Build the key columns (without time band) of a site."""
+
+        scale = 10**self.precision
+        lon, lat = np.rint(np.asarray(location, dtype=float) * scale).astype(np.int64)
+
+        return (costing, self.graph_version, int(lon), int(lat))
+
+    def get(
+        self, costing: str, location: np.ndarray, contours: Tuple[float, ...]
+    ) -> List[shapely.Geometry] | None:
+        """Look up the polygons of a site.
+
+        Parameters:
+            costing (str): The costing model.
+            location (np.ndarray): The (longitude, latitude) pair of the site.
+            contours (Tuple[float, ...]): The time bands in minutes.
+
+        Returns:
+            polygons (List[shapely.Geometry] | None): The polygon per time band, None unless all are cached.
+
+        Raises:
+            None
+        """
+
+        with self._lock:
+            rows = dict(
+                self._connection.execute(
+                    """
+                    SELECT minutes, geometry FROM isochrones
+                    WHERE costing = ? AND version = ? AND lon = ? AND lat = ?
+                    """,
+                    self._key(costing, location),
+                ).fetchall()
+            )
+
+        if not all(float(minutes) in rows for minutes in contours):
+            return None
+
+        return [shapely.from_wkb(rows[float(minutes)]) for minutes in contours]
+
+    def put(
+        self,
+        costing: str,
+        location: np.ndarray,
+        contours: Tuple[float, ...],
+        polygons: List[shapely.Geometry],
+    ) -> None:
+        """Store the polygons of a site.
+
+        Parameters:
+            costing (str): The costing model.
+            location (np.ndarray): The (longitude, latitude) pair of the site.
+            contours (Tuple[float, ...]): The time bands in minutes.
+            polygons (List[shapely.Geometry]): The polygon per time band.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        key = self._key(costing, location)
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO isochrones VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (*key, float(minutes), shapely.to_wkb(polygon))
+                    for minutes, polygon in zip(contours, polygons)
+                ),
+            )
+
+    def clear(self) -> None:
+        """Remove all cached polygons."""
+
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM isochrones")
+
+    def close(self) -> None:
+        """Close the database connection."""
+
+        self._connection.close()
+
+
+def _parse_isochrones(
+    response: str | bytes | dict, contours: Tuple[float, ...]
+) -> List[shapely.Geometry]:
+    """Parse a Valhalla isochrone response (GeoJSON) into one polygon per time band."""
+
+    if isinstance(response, (str, bytes)):
+        response = json.loads(response)
+
+    polygons = {
+        float(feature["properties"]["contour"]): shapely.from_geojson(
+            json.dumps(feature["geometry"])
+        )
+        for feature in response["features"]
+    }
+
+    # Bands without a polygon (e.g. a site off the road network) are empty
+    return [polygons.get(float(minutes), shapely.Polygon()) for minutes in contours]
+
+
+def compute_isochrones(
+    router: Any,
+    locations: np.ndarray,
+    costing: str = "pedestrian",
+    contours: Tuple[float, ...] = CONTOURS,
+    max_workers: int = 1,
+    cache: IsochroneCache | None = None,
+) -> gpd.GeoDataFrame:
+    """Compute the isochrone polygons of sites at the given time bands.
+
+    Parameters:
+        router (Any): A routing actor with an isochrone method, e.g. from routing.RoutingService.get_actor
+            or an actor_pool.ActorPool.
+        locations (np.ndarray): Site (longitude, latitude) pairs, shape (n, 2), e.g. pharmacies.
+        costing (str): The costing model, one of "auto", "bicycle" or "pedestrian".
+        contours (Tuple[float, ...]): The time bands in minutes.
+        max_workers (int): The number of sites requested concurrently. A valhalla.Actor is not thread-safe,
+            so only an actor_pool.ActorPool (with at least this many workers) should get more than 1.
+        cache (IsochroneCache | None): An optional cache of already computed polygons.
+
+    Returns:
+        isochrones (gpd.GeoDataFrame): One polygon per site and time band with columns site (row in
+            locations), costing and minutes, in EPSG:4326.
+
+    Raises:
+        ValueError: If the costing is not supported.
+    """
+
+    if costing not in matrix.COSTINGS:
+        raise ValueError(f"Costing must be one of {matrix.COSTINGS}.")
+
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    contours = tuple(sorted(contours))
+
+    def compute_site(location: np.ndarray) -> List[shapely.Geometry]:
+        if cache is not None and (polygons := cache.get(costing, location, contours)):
+            return polygons
+
+        request = {
+            "locations": matrix.to_locations(location[None]),
+            "costing": costing,
+            "contours": [{"time": minutes} for minutes in contours],
+            "polygons": True,
+        }
+        polygons = _parse_isochrones(router.isochrone(json.dumps(request)), contours)
+
+        if cache is not None:
+            cache.put(costing, location, contours, polygons)
+
+        return polygons
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        polygons = list(executor.map(compute_site, locations))
+
+    return gpd.GeoDataFrame(
+        {
+            "site": np.repeat(np.arange(len(locations)), len(contours)),
+            "costing": costing,
+            "minutes": np.tile(np.array(contours, dtype=float), len(locations)),
+        },
+        geometry=[polygon for site in polygons for polygon in site],
+        crs=4326,
+    )
+
+
+def label_customers(
+    customers: gpd.GeoSeries | gpd.GeoDataFrame, isochrones: gpd.GeoDataFrame
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Label customers with the smallest time band and site whose catchment contains them.
+
+    All polygons are put into one spatial index, which is queried with all customers at once.
+
+    Parameters:
+        customers (gpd.GeoSeries | gpd.GeoDataFrame): The customer locations.
+        isochrones (gpd.GeoDataFrame): The isochrones, e.g. from compute_isochrones.
+
+    Returns:
+        minutes (np.ndarray): The smallest time band reaching each customer, inf if none does.
+        sites (np.ndarray): The site of that time band per customer, -1 if none reaches the customer.
+
+    Raises:
+        None
+    """
+
+    points = customers.to_crs(4326).geometry.values
+    polygons = isochrones.to_crs(4326).geometry.values
+
+    tree = shapely.STRtree(polygons)
+    customer_ids, polygon_ids = tree.query(points, predicate="within")
+
+    minutes = np.full(len(points), np.inf)
+    sites = np.full(len(points), -1, dtype=np.int64)
+
+    if len(customer_ids) == 0:
+        return minutes, sites
+
+    # Of all polygons containing a customer, keep the one with the smallest band
+    band = isochrones["minutes"].to_numpy(dtype=float)[polygon_ids]
+    order = np.lexsort((band, customer_ids))
+    customer_ids, polygon_ids, band = (
+        customer_ids[order],
+        polygon_ids[order],
+        band[order],
+    )
+    first = np.r_[True, customer_ids[1:] != customer_ids[:-1]]
+
+    minutes[customer_ids[first]] = band[first]
+    sites[customer_ids[first]] = isochrones["site"].to_numpy()[polygon_ids[first]]
+
+    return minutes, sites
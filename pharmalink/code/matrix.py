@@ -0,0 +1,266 @@
+"""Module for computing many-to-many travel-time matrices with the Valhalla routing engine.
+
+Valhalla rejects matrix requests above a configured number of location pairs
+(service_limits.<costing>.max_matrix_location_pairs, 2500 by default).
+Large requests are therefore tiled into size-limited blocks which are sent concurrently,
+and the block results are written into dense float32 arrays.
+
+Coordinates are always given as numpy arrays of shape (n, 2) holding (longitude, latitude) pairs in EPSG:4326.
+Durations are returned in seconds and distances in kilometres, unreachable pairs are NaN.
+
+Classes:
+    MatrixResult: Dense duration and distance matrices.
+
+Functions:
+    compute_matrix: Compute a travel-time matrix between sources and targets.
+"""
+
+from __future__ import annotations
+from typing import Any, List, Tuple
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import math
+import json
+import numpy as np
+
+# Costing models for which Valhalla can compute matrices
+COSTINGS = ("auto", "bicycle", "pedestrian")
+
+# Default Valhalla limit for the number of location pairs in a single matrix request
+MAX_LOCATION_PAIRS = 2500
+
+
+@dataclass
+class MatrixResult:
+    """Dense duration and distance matrices.
+
+    Attributes:
+        durations (np.ndarray): Travel times in seconds, shape (sources, targets). NaN if unreachable.
+        distances (np.ndarray): Travel distances in kilometres, shape (sources, targets). NaN if unreachable.
+    """
+
+    durations: np.ndarray
+    distances: np.ndarray
+
+    @classmethod
+    def empty(cls, num_sources: int, num_targets: int) -> MatrixResult:
+        """Create a MatrixResult with all pairs unreachable."""
+
+        shape = (num_sources, num_targets)
+
+        return cls(
+            durations=np.full(shape, np.nan, dtype=np.float32),
+            distances=np.full(shape, np.nan, dtype=np.float32),
+        )
+
+    @property
+    def reachable(self) -> np.ndarray:
+        """Boolean mask of all pairs for which a route could be computed."""
+
+        return ~np.isnan(self.durations)
+
+
+def to_locations(coordinates: np.ndarray) -> List[dict]:
+    """Convert a coordinate array to a list of Valhalla locations.
+
+    Parameters:
+        coordinates (np.ndarray): (longitude, latitude) pairs, shape (n, 2).
+
+    Returns:
+        locations (List[dict]): A list of {"lat", "lon"} dicts.
+
+    Raises:
+        None
+    """
+
+    return [
+        {"lat": float(lat), "lon": float(lon)}
+        for lon, lat in np.asarray(coordinates).reshape(-1, 2)
+    ]
+
+
+def plan_blocks(
+    num_sources: int, num_targets: int, max_pairs: int = MAX_LOCATION_PAIRS
+) -> List[Tuple[slice, slice]]:
+    """Tile a matrix into blocks that stay within the location pair limit.
+
+    Blocks are as square as possible to keep the number of requests low.
+
+    Parameters:
+        num_sources (int): The number of sources.
+        num_targets (int): The number of targets.
+        max_pairs (int): The maximum number of location pairs per block.
+
+    Returns:
+        blocks (List[Tuple[slice, slice]]): (source slice, target slice) for every block.
+
+    Raises:
+        ValueError: If max_pairs is smaller than 1.
+    """
+
+    if max_pairs < 1:
+        raise ValueError("max_pairs must be at least 1.")
+
+    if num_sources == 0 or num_targets == 0:
+        return []
+
+    # Start with a square block and widen it if one side is smaller than the square's edge
+    edge = max(int(math.isqrt(max_pairs)), 1)
+    rows = min(num_sources, edge)
+    cols = min(num_targets, max(max_pairs // max(rows, 1), 1))
+    rows = min(num_sources, max(max_pairs // max(cols, 1), 1))
+
+    return [
+        (
+            slice(row, min(row + rows, num_sources)),
+            slice(col, min(col + cols, num_targets)),
+        )
+        for row in range(0, num_sources, rows)
+        for col in range(0, num_targets, cols)
+    ]
+
+
+def parse_matrix(response: Any, num_sources: int, num_targets: int) -> MatrixResult:
+    """Parse a Valhalla matrix response into a MatrixResult.
+
+    Both the verbose (list of objects per row) and the concise (durations/distances arrays)
+    response formats are supported.
+
+    Parameters:
+        response (Any): The response as returned by the actor, either a JSON string or a dict.
+        num_sources (int): The number of sources in the request.
+        num_targets (int): The number of targets in the request.
+
+    Returns:
+        result (MatrixResult): The parsed block.
+
+    Raises:
+        ValueError: If the response contains no matrix.
+    """
+
+    if isinstance(response, (str, bytes)):
+        response = json.loads(response)
+
+    if "sources_to_targets" not in response:
+        raise ValueError(f"Invalid matrix response: {response}")
+
+    matrix = response["sources_to_targets"]
+    result = MatrixResult.empty(num_sources, num_targets)
+
+    # Concise format: {"durations": [[...]], "distances": [[...]]}
+    if isinstance(matrix, dict):
+        result.durations[:] = np.array(matrix["durations"], dtype=float)
+        result.distances[:] = np.array(matrix["distances"], dtype=float)
+        return result
+
+    # Verbose format: one list of {"time", "distance", "from_index", "to_index"} per source
+    for row, cells in enumerate(matrix):
+        result.durations[row] = [
+            np.nan if cell.get("time") is None else cell["time"] for cell in cells
+        ]
+        result.distances[row] = [
+            np.nan if cell.get("distance") is None else cell["distance"]
+            for cell in cells
+        ]
+
+    return result
+
+
+def compute_matrix(
+    router: Any,
+    sources: np.ndarray,
+    targets: np.ndarray | None = None,
+    costing: str = "auto",
+    max_pairs: int = MAX_LOCATION_PAIRS,
+    max_workers: int = 1,
+    cache: Any = None,
+) -> MatrixResult:
+    """Compute a travel-time matrix between sources and targets.
+
+    Parameters:
+        router (Any): A routing actor with a matrix method, e.g. from routing.create_routing_actor
+            or an actor_pool.ActorPool.
+        sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+        targets (np.ndarray | None): Target (longitude, latitude) pairs, shape (m, 2). Defaults to sources.
+        costing (str): The costing model, one of "auto", "bicycle" or "pedestrian".
+        max_pairs (int): The maximum number of location pairs per request.
+        max_workers (int): The number of blocks requested concurrently. A valhalla.Actor is not thread-safe,
+            so only routers serving concurrent requests (an actor_pool.ActorPool with at least this many
+            workers or an http_client.ValhallaClient) should get more than 1.
+        cache (Any): An optional cache.TravelTimeCache. Only pairs missing from the cache are requested.
+
+    Returns:
+        result (MatrixResult): Durations and distances of shape (n, m).
+
+    Raises:
+        ValueError: If the costing is not supported.
+    """
+
+    if costing not in COSTINGS:
+        raise ValueError(f"Costing must be one of {COSTINGS}.")
+
+    sources = np.asarray(sources, dtype=float).reshape(-1, 2)
+    targets = (
+        sources if targets is None else np.asarray(targets, dtype=float).reshape(-1, 2)
+    )
+
+    result = MatrixResult.empty(len(sources), len(targets))
+
+    def request_block(rows: np.ndarray, cols: np.ndarray) -> MatrixResult:
+        request = {
+            "sources": to_locations(sources[rows]),
+            "targets": to_locations(targets[cols]),
+            "costing": costing,
+            "units": "kilometers",
+        }
+        response = router.matrix(json.dumps(request))
+        return parse_matrix(response, len(rows), len(cols))
+
+    def compute_block(
+        block: Tuple[slice, slice],
+    ) -> Tuple[Tuple[slice, slice], MatrixResult]:
+        rows, cols = block
+        row_ids = np.arange(rows.start, rows.stop)
+        col_ids = np.arange(cols.start, cols.stop)
+
+        if cache is None:
+            return block, request_block(row_ids, col_ids)
+
+        block_result, found = cache.get(costing, sources[rows], targets[cols])
+
+        if found.all():
+            return block, block_result
+
+        # Only request the rows and columns with at least one uncached pair
+        missing_rows = np.flatnonzero(~found.all(axis=1))
+        missing_cols = np.flatnonzero(~found.all(axis=0))
+        computed = request_block(row_ids[missing_rows], col_ids[missing_cols])
+
+        missing = ~found[np.ix_(missing_rows, missing_cols)]
+        cache.put(
+            costing,
+            sources[row_ids[missing_rows]],
+            targets[col_ids[missing_cols]],
+            computed,
+            mask=missing,
+        )
+
+        # Fill in the computed pairs, cached pairs keep their cached values
+        cells = np.ix_(missing_rows, missing_cols)
+        block_result.durations[cells] = np.where(
+            missing, computed.durations, block_result.durations[cells]
+        )
+        block_result.distances[cells] = np.where(
+            missing, computed.distances, block_result.distances[cells]
+        )
+
+        return block, block_result
+
+    blocks = plan_blocks(len(sources), len(targets), max_pairs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for (rows, cols), block_result in executor.map(compute_block, blocks):
+            result.durations[rows, cols] = block_result.durations
+            result.distances[rows, cols] = block_result.distances
+
+    return result
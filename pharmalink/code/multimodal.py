@@ -0,0 +1,199 @@
+"""Module for computing multi-modal travel times and choosing a mode of transport per customer.
+
+The mode-choice model (sources.evaluate_mode_of_transport) draws a mode per trip from usage probabilities
+by trip length, restricted to the modes for which a route exists. Instead of routing every customer
+separately per mode, the matrices of all costing models are computed in one batched run. The availability
+of every mode then follows from the unreachable (NaN) entries, and modes are drawn for all customers at once:
+the probabilities of each customer's trip length band are looked up with a single searchsorted, masked
+by availability, renormalized and sampled via their cumulative sums.
+
+Classes:
+    ModeAssignment: The chosen mode of transport and resulting trip per customer.
+
+Functions:
+    compute_mode_matrices:  Compute the travel-time matrices of several costing models in one batched run.
+    assign_modes:           Choose a mode of transport for every customer.
+"""
+
+from __future__ import annotations
+from typing import Dict, Tuple
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pharmalink.code.area as area
+import pharmalink.code.backends as backends
+import pharmalink.code.matrix as matrix
+import pharmalink.code.sources as src
+
+
+@dataclass
+class ModeAssignment:
+    """The chosen mode of transport and resulting trip per customer.
+
+    Attributes:
+        modes (np.ndarray): The index of the chosen mode in matrix.COSTINGS per customer, -1 if none is available.
+        targets (np.ndarray): The column of the chosen target (e.g. pharmacy) per customer.
+        durations (np.ndarray): The travel time in seconds with the chosen mode, NaN if none is available.
+        distances (np.ndarray): The travel distance in km with the chosen mode, NaN if none is available.
+        available (np.ndarray): Whether each mode is available per customer, shape (customers, modes).
+    """
+
+    modes: np.ndarray
+    targets: np.ndarray
+    durations: np.ndarray
+    distances: np.ndarray
+    available: np.ndarray
+
+    def get_modes(self) -> np.ndarray:
+        """Get the name of the chosen mode per customer, None if none is available."""
+
+        names = np.array(matrix.COSTINGS + (None,), dtype=object)
+
+        return names[self.modes]
+
+    def get_counts(self) -> Dict[str, int]:
+        """Get the number of customers per chosen mode."""
+
+        counts = np.bincount(
+            self.modes[self.modes >= 0], minlength=len(matrix.COSTINGS)
+        )
+
+        return dict(zip(matrix.COSTINGS, counts.tolist()))
+
+
+def _mode_table() -> Tuple[np.ndarray, np.ndarray]:
+    """Get the trip length breaks in km and the mode probabilities per band, shape (bands, modes)."""
+
+    table = src.load_transport_modes()
+
+    breaks = table.index.left.to_numpy(dtype=float)
+    probabilities = table[list(matrix.COSTINGS)].to_numpy(dtype=float)
+
+    return breaks, probabilities
+
+
+def compute_mode_matrices(
+    backend: backends.RoutingBackend,
+    sources: np.ndarray,
+    targets: np.ndarray | None = None,
+    costings: Tuple[str, ...] = matrix.COSTINGS,
+) -> Dict[str, matrix.MatrixResult]:
+    """Compute the travel-time matrices of several costing models in one batched run.
+
+    The costing models are computed concurrently, each one tiled by the backend.
+
+    Parameters:
+        backend (backends.RoutingBackend): The routing backend.
+        sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2), e.g. customers.
+        targets (np.ndarray | None): Target (longitude, latitude) pairs, shape (m, 2), e.g. pharmacies.
+        costings (Tuple[str, ...]): The costing models to compute.
+
+    Returns:
+        matrices (Dict[str, matrix.MatrixResult]): The matrix of shape (n, m) per costing model.
+
+    Raises:
+        ValueError: If a costing is not supported.
+    """
+
+    if unknown := set(costings) - set(matrix.COSTINGS):
+        raise ValueError(f"Costings must be among {matrix.COSTINGS}, got {unknown}.")
+
+    with ThreadPoolExecutor(max_workers=len(costings)) as executor:
+        futures = {
+            costing: executor.submit(backend.matrix, sources, targets, costing)
+            for costing in costings
+        }
+
+    return {costing: future.result() for costing, future in futures.items()}
+
+
+def assign_modes(
+    matrices: Dict[str, matrix.MatrixResult],
+    targets: np.ndarray | None = None,
+    seed: int | np.random.Generator | None = None,
+) -> ModeAssignment:
+    """Choose a mode of transport for every customer.
+
+    Every customer (matrix row) travels to one target (matrix column). A mode is available if its route
+    to that target could be computed. The trip length used to look up the mode probabilities is the
+    shortest distance among the available modes. If all available modes have zero probability for that
+    length (e.g. only walking is possible for a 60 km trip), the fastest available mode is chosen.
+
+    Parameters:
+        matrices (Dict[str, matrix.MatrixResult]): The matrix per costing model, e.g. from compute_mode_matrices.
+        targets (np.ndarray | None): The target column per customer. Defaults to the target with the
+            shortest distance over all modes.
+        seed (int | np.random.Generator | None): The seed or generator of the random draws.
+
+    Returns:
+        assignment (ModeAssignment): The chosen mode and trip per customer.
+
+    Raises:
+        ValueError: If no matrix is given.
+    """
+
+    if not matrices:
+        raise ValueError("At least one costing matrix is needed.")
+
+    rng = np.random.default_rng(seed)
+    num_customers, num_targets = next(iter(matrices.values())).durations.shape
+
+    rows = np.arange(num_customers)
+
+    if targets is None:
+        # Shortest distance over all modes, unreachable targets are pushed behind all reachable ones
+        shortest = np.full((num_customers, num_targets), np.inf)
+        for result in matrices.values():
+            shortest = np.fmin(shortest, result.distances)
+
+        targets = (
+            np.argmin(shortest, axis=1)
+            if num_targets
+            else np.zeros(num_customers, dtype=np.int64)
+        )
+
+    targets = np.asarray(targets, dtype=np.int64)
+
+    # Trip of every customer per mode in the order of matrix.COSTINGS, missing costings are unavailable
+    trip_durations = np.full((num_customers, len(matrix.COSTINGS)), np.nan)
+    trip_distances = np.full((num_customers, len(matrix.COSTINGS)), np.nan)
+
+    for mode, costing in enumerate(matrix.COSTINGS):
+        if costing in matrices and num_targets:
+            trip_durations[:, mode] = matrices[costing].durations[rows, targets]
+            trip_distances[:, mode] = matrices[costing].distances[rows, targets]
+
+    available = ~np.isnan(trip_durations)
+    reachable = available.any(axis=1)
+
+    # Probabilities of every customer's trip length band, restricted to the available modes
+    breaks, table = _mode_table()
+    length = np.nan_to_num(np.fmin.reduce(trip_distances, axis=1), nan=0.0)
+    bands = np.clip(
+        np.searchsorted(breaks, length, side="right") - 1, 0, len(table) - 1
+    )
+
+    probabilities = table[bands] * available
+    totals = probabilities.sum(axis=1)
+
+    # Draw the first mode whose cumulative probability exceeds a uniform random number
+    drawable = totals > 0
+    cumulative = np.cumsum(probabilities[drawable], axis=1) / totals[drawable, None]
+    draws = rng.random(np.count_nonzero(drawable))
+
+    modes = np.full(num_customers, -1, dtype=np.int64)
+    modes[drawable] = np.argmax(cumulative > draws[:, None], axis=1)
+
+    # Fall back to the fastest available mode where the available modes have zero probability
+    fallback = reachable & ~drawable
+    modes[fallback] = np.nanargmin(trip_durations[fallback], axis=1)
+
+    chosen = np.maximum(modes, 0)
+
+    return ModeAssignment(
+        modes=modes,
+        targets=targets,
+        durations=np.where(reachable, trip_durations[rows, chosen], np.nan),
+        distances=np.where(reachable, trip_distances[rows, chosen], np.nan),
+        available=available,
+    )
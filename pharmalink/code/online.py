@@ -0,0 +1,560 @@
+"""Module for inserting orders into a running delivery plan.
+
+Pharmacy couriers receive orders throughout the day. Re-solving the whole VRP for every new order is far too
+slow, so the OnlinePlanner keeps the current routes and inserts each order at its cheapest feasible position:
+
+- Only positions next to the K nearest planned stops are considered. These are found with a KD-tree
+  over the projected stop locations, which is rebuilt only every few hundred orders.
+- Only the travel times between the order and the few nodes around these positions are requested. They are
+  kept in a pairwise matrix over all nodes, so the travel times of planned stops are never requested twice.
+- Capacity, time windows and the maximum route duration are checked in constant time per position from the
+  precomputed schedule segments of every route (see vrp).
+
+Optionally, the routes around the inserted order are re-optimized afterwards by the local search of vrp,
+while all other routes stay untouched.
+
+Classes:
+    Insertion:      The position an order was inserted at.
+    OnlinePlanner:  A delivery plan of a depot that orders can be inserted into one at a time.
+"""
+
+from __future__ import annotations
+from typing import Dict, List, Tuple
+from dataclasses import dataclass
+import numpy as np
+from scipy.spatial import cKDTree
+import pharmalink.code.backends as backends
+import pharmalink.code.spatial as spatial
+import pharmalink.code.vrp as vrp
+
+# Number of stops added to the plan before the KD-tree over all stops is rebuilt
+REBUILD_INTERVAL = 256
+
+# Initial number of nodes the pairwise travel-time matrix has room for, doubled whenever it is full
+INITIAL_NODES = 64
+
+
+@dataclass
+class Insertion:
+    """The position an order was inserted at, after a re-optimization if one was requested.
+
+    Attributes:
+        node (int): The node id of the order in the planner.
+        route (int): The route the order is on.
+        position (int): The position of the order within the route (1 = first stop).
+        added_cost (float): The change of the travel time of the plan in seconds.
+    """
+
+    node: int
+    route: int
+    position: int
+    added_cost: float
+
+
+class OnlinePlanner:
+    """A delivery plan of a depot that orders can be inserted into one at a time.
+
+    The depot is node 0, every order becomes the next node id.
+
+    Attributes:
+        backend (backends.RoutingBackend): The routing backend for the travel times of new orders.
+        capacity (float): The capacity of every vehicle.
+        max_duration (float): The maximum duration of a route in seconds.
+        max_routes (int | None): The maximum number of routes, None for unlimited.
+        costing (str): The costing model of the routes.
+        neighbours (int): The number of nearest planned stops whose positions are considered per order.
+        routes (List[List[int]]): The node ids of every route, starting and ending at the depot (0).
+
+    Methods:
+        load_plan:      Add planned stops and routes, e.g. from a vrp.VrpSolution.
+        insert:         Insert an order at its cheapest feasible position.
+        reoptimize:     Improve some routes by local search.
+        get_routes:     Get the stops of all routes.
+        get_cost:       Get the total travel time of all routes.
+    """
+
+    __slots__ = [
+        "backend",
+        "capacity",
+        "max_duration",
+        "max_routes",
+        "costing",
+        "neighbours",
+        "routes",
+        "_locations",
+        "_coordinates",
+        "_demands",
+        "_service_times",
+        "_time_windows",
+        "_travel",
+        "_route_of",
+        "_loads",
+        "_prefixes",
+        "_suffixes",
+        "_tree",
+        "_indexed",
+    ]
+
+    def __init__(
+        self,
+        backend: backends.RoutingBackend,
+        depot: np.ndarray,
+        capacity: float = np.inf,
+        max_duration: float = np.inf,
+        depot_window: Tuple[float, float] = (0.0, np.inf),
+        max_routes: int | None = None,
+        costing: str = "auto",
+        neighbours: int = 10,
+    ) -> None:
+        """Initialize an OnlinePlanner without any routes.
+
+        Parameters:
+            backend (backends.RoutingBackend): The routing backend for the travel times of new orders.
+            depot (np.ndarray): The (longitude, latitude) pair of the depot.
+            capacity (float): The capacity of every vehicle.
+            max_duration (float): The maximum duration of a route in seconds.
+            depot_window (Tuple[float, float]): The earliest start and latest return of every route in seconds.
+            max_routes (int | None): The maximum number of routes, None for unlimited.
+            costing (str): The costing model of the routes.
+            neighbours (int): The number of nearest planned stops whose positions are considered per order.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        self.backend = backend
+        self.capacity = float(capacity)
+        self.max_duration = float(max_duration)
+        self.max_routes = max_routes
+        self.costing = costing
+        self.neighbours = neighbours
+        self.routes = []
+
+        depot = np.asarray(depot, dtype=float).reshape(2)
+
+        # Node attributes grow with every order, so they are kept as lists
+        self._locations = [depot]
+        self._coordinates = [spatial.project(depot[:1], depot[1:])[0]]
+        self._demands = [0.0]
+        self._service_times = [0.0]
+        self._time_windows = [tuple(map(float, depot_window))]
+
+        # Pairwise travel times in seconds by (from node, to node), NaN if not requested yet
+        self._travel = np.full((INITIAL_NODES, INITIAL_NODES), np.nan)
+        self._travel[0, 0] = 0.0
+
+        self._route_of = [-1]
+        self._loads = []
+        self._prefixes = []
+        self._suffixes = []
+
+        self._tree = None
+        self._indexed = 0
+
+    def __repr__(self) -> str:
+        """Return all information about the OnlinePlanner object."""
+
+        return (
+            f"OnlinePlanner (Stops: {len(self._locations) - 1}, Routes: {len(self.routes)}, "
+            f"Cached pairs: {np.count_nonzero(~np.isnan(self._travel))})"
+        )
+
+    def _add_node(
+        self,
+        location: np.ndarray,
+        demand: float,
+        service_time: float,
+        time_window: Tuple[float, float] | None,
+    ) -> int:
+        """Add a node without routing it and return its id."""
+
+        location = np.asarray(location, dtype=float).reshape(2)
+
+        self._locations.append(location)
+        self._coordinates.append(spatial.project(location[:1], location[1:])[0])
+        self._demands.append(float(demand))
+        self._service_times.append(float(service_time))
+        self._time_windows.append(
+            (0.0, np.inf) if time_window is None else tuple(map(float, time_window))
+        )
+        self._route_of.append(-1)
+
+        if len(self._locations) > len(self._travel):
+            travel = np.full((2 * len(self._travel),) * 2, np.nan)
+            travel[: len(self._travel), : len(self._travel)] = self._travel
+            self._travel = travel
+
+        return len(self._locations) - 1
+
+    def _request(self, sources: np.ndarray, targets: np.ndarray) -> None:
+        """Compute and cache the travel times from source to target nodes in one backend request."""
+
+        result = self.backend.matrix(
+            np.array([self._locations[node] for node in sources]),
+            np.array([self._locations[node] for node in targets]),
+            costing=self.costing,
+        )
+        self._travel[np.ix_(sources, targets)] = np.where(
+            np.isnan(result.durations), np.inf, result.durations
+        )
+
+    def _fetch(self, groups: List[List[int]]) -> None:
+        """Compute and cache all missing travel times between the nodes of all groups.
+
+        Every group of source nodes (e.g. the stops of a route) is requested at once, to the union of its
+        missing target nodes. Groups without missing pairs are not requested.
+        """
+
+        nodes = np.array(
+            list(dict.fromkeys(node for group in groups for node in group)),
+            dtype=np.int64,
+        )
+
+        for group in groups:
+            sources = np.array(list(dict.fromkeys(group)), dtype=np.int64)
+            missing = np.isnan(self._travel[np.ix_(sources, nodes)])
+            rows = missing.any(axis=1)
+
+            if rows.any():
+                self._request(sources[rows], nodes[missing[rows].any(axis=0)])
+
+    def _fetch_node(self, node: int, others: List[int]) -> None:
+        """Compute and cache the missing travel times between a node and others, in both directions."""
+
+        others = np.array(list(dict.fromkeys([node, *others])), dtype=np.int64)
+        outgoing = others[np.isnan(self._travel[node, others])]
+        incoming = others[np.isnan(self._travel[others, node])]
+
+        if len(outgoing):
+            self._request(np.array([node]), outgoing)
+        if len(incoming):
+            self._request(incoming, np.array([node]))
+
+    def _t(self, i: int, j: int) -> float:
+        """Get a cached travel time, inf if it is unknown."""
+
+        t = self._travel[i, j]
+
+        return np.inf if np.isnan(t) else float(t)
+
+    def _segment(self, node: int) -> Tuple[float, float, float, float]:
+        """Get the schedule segment of a single node."""
+
+        earliest, latest = self._time_windows[node]
+
+        return (self._service_times[node], earliest, latest, 0.0)
+
+    def _update(self, r: int) -> None:
+        """Recompute the loads and schedule segments of a route."""
+
+        sequence = self.routes[r]
+        segments = [self._segment(node) for node in sequence]
+        travel = [self._t(a, b) for a, b in zip(sequence[:-1], sequence[1:])]
+
+        prefixes = [segments[0]]
+        for segment, t in zip(segments[1:], travel):
+            prefixes.append(vrp._concat(prefixes[-1], segment, t))
+
+        suffixes = [segments[-1]]
+        for segment, t in zip(segments[-2::-1], travel[::-1]):
+            suffixes.append(vrp._concat(segment, suffixes[-1], t))
+
+        self._prefixes[r] = prefixes
+        self._suffixes[r] = suffixes[::-1]
+        self._loads[r] = sum(self._demands[node] for node in sequence)
+
+        for node in sequence[1:-1]:
+            self._route_of[node] = r
+
+    def _feasible(self, segment: Tuple[float, float, float, float]) -> bool:
+        """Check whether the segment of a complete route is feasible."""
+
+        return segment[3] <= vrp.EPSILON and segment[0] <= self.max_duration
+
+    def _set_routes(self, routes: Dict[int, List[int]]) -> None:
+        """Replace or append routes (without depot), given by route id (-1 appends)."""
+
+        for r, stops in routes.items():
+            sequence = [0, *stops, 0]
+
+            if r < 0:
+                self.routes.append(sequence)
+                self._loads.append(0.0)
+                self._prefixes.append(None)
+                self._suffixes.append(None)
+                r = len(self.routes) - 1
+            else:
+                self.routes[r] = sequence
+
+            self._update(r)
+
+    def _nearest(self, node: int) -> np.ndarray:
+        """Find the nearest planned stops of a node."""
+
+        stops = len(self._coordinates) - 1
+
+        if stops - self._indexed > REBUILD_INTERVAL or (self._tree is None and stops):
+            self._tree = cKDTree(np.array(self._coordinates[1:]))
+            self._indexed = stops
+
+        point = self._coordinates[node]
+        candidates = []
+
+        if self._tree is not None:
+            _, indices = self._tree.query(point, k=min(self.neighbours, self._indexed))
+            candidates.append(np.atleast_1d(indices) + 1)
+
+        # Stops added since the last rebuild are searched exhaustively
+        if stops > self._indexed:
+            recent = np.arange(self._indexed + 1, stops + 1)
+            distances = np.linalg.norm(
+                np.array(self._coordinates[self._indexed + 1 :]) - point, axis=1
+            )
+            candidates.append(recent[np.argsort(distances)[: self.neighbours]])
+
+        if not candidates:
+            return np.zeros(0, dtype=np.int64)
+
+        nodes = [
+            candidate
+            for candidate in np.concatenate(candidates).tolist()
+            if candidate != node and self._route_of[candidate] >= 0
+        ]
+        nodes = np.array(nodes, dtype=np.int64)
+
+        distances = np.linalg.norm(
+            np.array([self._coordinates[candidate] for candidate in nodes]).reshape(
+                -1, 2
+            )
+            - point,
+            axis=1,
+        )
+
+        return nodes[np.argsort(distances)[: self.neighbours]]
+
+    def load_plan(
+        self,
+        locations: np.ndarray,
+        routes: List[np.ndarray],
+        demands: np.ndarray | None = None,
+        service_times: np.ndarray | float = 0.0,
+        time_windows: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """Add planned stops and routes, e.g. from a vrp.VrpSolution.
+
+        The travel times within every route are requested route by route. The routes must be feasible.
+
+        Parameters:
+            locations (np.ndarray): The (longitude, latitude) pairs of the stops, shape (n, 2).
+            routes (List[np.ndarray]): The rows of locations visited by every route in order.
+            demands (np.ndarray | None): The demand per stop. Defaults to 1 each.
+            service_times (np.ndarray | float): The service time in seconds for all or per stop.
+            time_windows (np.ndarray | None): The earliest and latest service start per stop, shape (n, 2).
+
+        Returns:
+            nodes (np.ndarray): The node id of every stop in the planner.
+
+        Raises:
+            None
+        """
+
+        locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+        demands = np.ones(len(locations)) if demands is None else demands
+        service_times = np.broadcast_to(service_times, (len(locations),))
+
+        nodes = np.array(
+            [
+                self._add_node(
+                    locations[stop],
+                    demands[stop],
+                    service_times[stop],
+                    None if time_windows is None else time_windows[stop],
+                )
+                for stop in range(len(locations))
+            ],
+            dtype=np.int64,
+        )
+
+        for route in routes:
+            stops = nodes[np.asarray(route, dtype=np.int64)].tolist()
+            self._fetch([[0, *stops]])
+            self._set_routes({-1: stops})
+
+        return nodes
+
+    def insert(
+        self,
+        location: np.ndarray,
+        demand: float = 1.0,
+        service_time: float = 0.0,
+        time_window: Tuple[float, float] | None = None,
+        reoptimize_time: float = 0.0,
+    ) -> Insertion | None:
+        """Insert an order at its cheapest feasible position.
+
+        All positions before and after the nearest planned stops are evaluated. If none of them is feasible,
+        the order gets a new route (unless max_routes is reached).
+
+        Parameters:
+            location (np.ndarray): The (longitude, latitude) pair of the order.
+            demand (float): The demand of the order.
+            service_time (float): The service time in seconds.
+            time_window (Tuple[float, float] | None): The earliest and latest service start in seconds.
+            reoptimize_time (float): The time budget in seconds for re-optimizing the routes around the
+                order afterwards, 0 to skip.
+
+        Returns:
+            insertion (Insertion | None): The position of the order, None if it cannot be served.
+                Rejected orders keep their node id but are not part of any route.
+
+        Raises:
+            None
+        """
+
+        node = self._add_node(location, demand, service_time, time_window)
+        nearest = self._nearest(node)
+
+        # Positions (route, index of the preceding node) around the nearest stops
+        positions = set()
+        for stop in nearest.tolist():
+            r = self._route_of[stop]
+            index = self.routes[r].index(stop)
+            positions.update({(r, index - 1), (r, index)})
+
+        # Travel times between route neighbours are known, only those of the order are requested
+        self._fetch_node(
+            node,
+            [
+                0,
+                *(self.routes[r][i] for r, i in positions),
+                *(self.routes[r][i + 1] for r, i in positions),
+            ],
+        )
+
+        segment = self._segment(node)
+        best = None
+
+        for r, i in positions:
+            if self._loads[r] + demand > self.capacity:
+                continue
+
+            a, b = self.routes[r][i], self.routes[r][i + 1]
+            added = self._t(a, node) + self._t(node, b) - self._t(a, b)
+
+            if not np.isfinite(added) or (best is not None and added >= best[2]):
+                continue
+
+            full = vrp._concat(
+                vrp._concat(self._prefixes[r][i], segment, self._t(a, node)),
+                self._suffixes[r][i + 1],
+                self._t(node, b),
+            )
+
+            if self._feasible(full):
+                best = (r, i + 1, added)
+
+        if best is None:
+            # Open a new route (or reuse an emptied one), if allowed and feasible on its own
+            empty = next(
+                (r for r, sequence in enumerate(self.routes) if len(sequence) == 2), -1
+            )
+            added = self._t(0, node) + self._t(node, 0)
+            single = vrp._concat(
+                vrp._concat(self._segment(0), segment, self._t(0, node)),
+                self._segment(0),
+                self._t(node, 0),
+            )
+
+            if (
+                (
+                    empty < 0
+                    and self.max_routes is not None
+                    and len(self.routes) >= self.max_routes
+                )
+                or not np.isfinite(added)
+                or demand > self.capacity
+                or not self._feasible(single)
+            ):
+                return None
+
+            self._set_routes({empty: [node]})
+            best = (empty if empty >= 0 else len(self.routes) - 1, 1, added)
+
+        else:
+            r, position, _ = best
+            self.routes[r].insert(position, node)
+            self._update(r)
+
+        route, position, added = best
+
+        if reoptimize_time > 0:
+            affected = {route} | {self._route_of[stop] for stop in nearest.tolist()}
+            added -= self.reoptimize(sorted(affected), time_limit=reoptimize_time)
+
+            # The order may have moved to another route or position
+            route = self._route_of[node]
+            position = self.routes[route].index(node)
+
+        return Insertion(node=node, route=route, position=position, added_cost=added)
+
+    def reoptimize(self, routes: List[int], time_limit: float = 0.1) -> float:
+        """Improve some routes by local search, leaving all other routes untouched.
+
+        Stops may move between the given routes. Missing travel times between their stops are requested once.
+
+        Parameters:
+            routes (List[int]): The ids of the routes to improve.
+            time_limit (float): The time budget of the local search in seconds.
+
+        Returns:
+            saving (float): The reduction of the travel time of the routes in seconds.
+
+        Raises:
+            None
+        """
+
+        nodes = [0, *(node for r in routes for node in self.routes[r][1:-1])]
+        self._fetch([[0], *(self.routes[r][1:-1] for r in routes)])
+
+        durations = self._travel[np.ix_(nodes, nodes)]
+        problem = vrp.VrpProblem(
+            durations,
+            demands=np.array(self._demands)[nodes],
+            capacity=self.capacity,
+            service_times=np.array(self._service_times)[nodes],
+            time_windows=np.array(self._time_windows)[nodes],
+            max_duration=self.max_duration,
+        )
+
+        local = {node: index for index, node in enumerate(nodes)}
+        before = [[local[node] for node in self.routes[r][1:-1]] for r in routes]
+        cost = sum(self._route_cost(r) for r in routes)
+
+        solution = vrp.solve(problem, time_limit=time_limit, routes=before)
+
+        # Routes emptied by the search stay in the plan without stops
+        improved = [np.array(nodes)[route].tolist() for route in solution.routes]
+        improved += [[]] * (len(routes) - len(improved))
+        self._set_routes(dict(zip(routes, improved)))
+
+        return cost - solution.cost
+
+    def _route_cost(self, r: int) -> float:
+        """Get the travel time of a route."""
+
+        sequence = self.routes[r]
+
+        return sum(self._t(a, b) for a, b in zip(sequence[:-1], sequence[1:]))
+
+    def get_routes(self) -> List[np.ndarray]:
+        """Get the node ids of the stops of all routes, without the depot."""
+
+        return [np.array(sequence[1:-1], dtype=np.int64) for sequence in self.routes]
+
+    def get_cost(self) -> float:
+        """Get the total travel time of all routes in seconds."""
+
+        return sum(self._route_cost(r) for r in range(len(self.routes)))
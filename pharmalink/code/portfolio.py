@@ -0,0 +1,174 @@
+"""Module for solving a VRP with many randomized starts in parallel.
+
+The result of the local search in vrp.solve depends heavily on the constructed start solution. The portfolio
+runs many starts with different seeds and savings perturbations (from the plain Clarke-Wright savings to
+strongly randomized ones) in a pool of worker processes and keeps the best solution.
+
+The travel-time matrix is written once to a working directory (SparseMatrix.save or a .npy file) together
+with the neighbour lists, and memory-mapped read-only by every worker. The workers therefore share the same
+pages instead of receiving a pickled copy of the matrix with every start.
+
+Classes:
+    PortfolioResult: The best solution and convergence of a portfolio run.
+
+Functions:
+    solve_portfolio: Solve a VRP with many randomized starts in a pool of worker processes.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Tuple
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+import pathlib as path
+import tempfile
+import time
+import os
+import numpy as np
+import pharmalink.code.sparse as sparse
+import pharmalink.code.vrp as vrp
+
+# Default relative perturbations of the savings, used round robin by the starts
+NOISES = (0.0, 0.05, 0.1, 0.2, 0.4)
+
+# Problem of the current worker process, created once by _initialize_worker
+_problem = None
+
+
+def _initialize_worker(directory: str, problem_kwargs: Dict[str, Any]) -> None:
+    """Create the problem of a worker process from the memory-mapped matrix."""
+
+    global _problem
+    directory = path.Path(directory)
+
+    if directory.joinpath("matrix").exists():
+        durations = sparse.SparseMatrix.load(directory.joinpath("matrix"), mmap=True)
+    else:
+        durations = np.load(directory.joinpath("durations.npy"), mmap_mode="r")
+
+    neighbours = np.load(directory.joinpath("neighbours.npy"), mmap_mode="r")
+
+    _problem = vrp.VrpProblem(durations, neighbours=neighbours, **problem_kwargs)
+
+
+def _run_start(seed: int, noise: float, time_limit: float) -> vrp.VrpSolution:
+    """Run a single start on the problem of the current worker process."""
+
+    return vrp.solve(_problem, time_limit=time_limit, seed=seed, noise=noise)
+
+
+@dataclass
+class PortfolioResult:
+    """The best solution and convergence of a portfolio run.
+
+    Attributes:
+        solution (vrp.VrpSolution): The best solution of all starts.
+        trace (List[Tuple[float, float]]): The (elapsed seconds, best cost) after every finished start.
+        starts (List[Tuple[int, float, float]]): The (seed, noise, cost) of every finished start.
+    """
+
+    solution: vrp.VrpSolution
+    trace: List[Tuple[float, float]]
+    starts: List[Tuple[int, float, float]]
+
+
+def _better(solution: vrp.VrpSolution, best: vrp.VrpSolution | None) -> bool:
+    """Check whether a solution serves more stops, or as many at a lower cost, than the best one."""
+
+    if best is None:
+        return True
+
+    return (len(solution.unserved), solution.cost) < (len(best.unserved), best.cost)
+
+
+def solve_portfolio(
+    durations: np.ndarray | sparse.SparseMatrix,
+    starts: int = 32,
+    time_limit: float = 10.0,
+    noises: Tuple[float, ...] = NOISES,
+    max_workers: int | None = None,
+    seed: int | None = None,
+    work_dir: path.Path | str | None = None,
+    **problem_kwargs: Any,
+) -> PortfolioResult:
+    """Solve a VRP with many randomized starts in a pool of worker processes.
+
+    Every start runs vrp.solve with its own seed and one of the savings perturbations (round robin),
+    so the first start is always the plain savings construction.
+
+    Parameters:
+        durations (np.ndarray | sparse.SparseMatrix): The travel-time matrix, see vrp.VrpProblem.
+        starts (int): The number of starts.
+        time_limit (float): The time budget of the local search of every start in seconds.
+        noises (Tuple[float, ...]): The relative perturbations of the savings.
+        max_workers (int | None): The number of worker processes. Defaults to the number of CPU cores.
+        seed (int | None): The seed the seeds of all starts are derived from.
+        work_dir (path.Path | str | None): The directory the shared matrix is written to.
+            Defaults to a temporary directory, which is removed afterwards.
+        **problem_kwargs (Any): The constraints of the problem, e.g. demands, capacity and time_windows,
+            passed on to vrp.VrpProblem.
+
+    Returns:
+        result (PortfolioResult): The best solution and convergence of all starts.
+
+    Raises:
+        ValueError: If the number of starts is not positive.
+    """
+
+    if starts < 1:
+        raise ValueError("At least one start is needed.")
+
+    start = time.perf_counter()
+    max_workers = min(max_workers or os.cpu_count(), starts)
+
+    # Independent seeds of all starts, reproducible from the portfolio seed
+    seeds = [
+        int(child.generate_state(1)[0])
+        for child in np.random.SeedSequence(seed).spawn(starts)
+    ]
+
+    # The neighbour lists are computed once here instead of in every worker
+    problem = vrp.VrpProblem(durations, **problem_kwargs)
+    problem_kwargs = {
+        key: value for key, value in problem_kwargs.items() if key != "neighbours"
+    }
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as directory:
+        directory = path.Path(directory)
+
+        if isinstance(durations, sparse.SparseMatrix):
+            durations.save(directory.joinpath("matrix"))
+        else:
+            # Unreachable pairs are stored as inf, so the workers use the mapped matrix without a copy
+            np.save(directory.joinpath("durations.npy"), problem._dense)
+
+        np.save(directory.joinpath("neighbours.npy"), problem.neighbours)
+
+        best = None
+        trace = []
+        finished = []
+
+        # Spawned workers start from a clean interpreter, so no state of the parent is inherited
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_initialize_worker,
+            initargs=(str(directory), problem_kwargs),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _run_start, start_seed, noises[i % len(noises)], time_limit
+                ): (start_seed, noises[i % len(noises)])
+                for i, start_seed in enumerate(seeds)
+            }
+
+            for future in as_completed(futures):
+                solution = future.result()
+                finished.append((*futures[future], solution.cost))
+
+                if _better(solution, best):
+                    best = solution
+
+                trace.append((time.perf_counter() - start, best.cost))
+
+    return PortfolioResult(solution=best, trace=trace, starts=finished)
@@ -0,0 +1,487 @@
+"""Module for Monte-Carlo replications of the stochastic pharmalink scenarios.
+
+Customer generation is random, so the KPIs of a single run (demand, distances, delivery route costs) are
+only one draw. The replication runner generates many seeded replications per area in a pool of worker
+processes and reduces their KPIs into streaming accumulators:
+
+- mean and variance by Welford's online algorithm,
+- quantiles by the P-square algorithm (Jain & Chlamtac, 1985), which keeps five markers instead of
+  all observations.
+
+Replications of an area stop as soon as the confidence intervals of all its KPIs are narrower than a target
+relative half-width, so stable areas need few replications and volatile ones get more.
+
+Every worker process keeps its routing backend, the loaded source datasets and the already created Areas
+across replications. Replication i of the k-th area always uses the same seed, so results are reproducible
+regardless of the order in which the workers finish.
+
+Classes:
+    P2Quantile:         A streaming quantile estimate.
+    RunningStats:       Streaming mean, variance and quantiles of one KPI.
+    ReplicationReport:  The KPI statistics of all replications per area.
+
+Functions:
+    compute_kpis:       Compute the default KPIs of one replication.
+    run_replications:   Run seeded replications of areas until their KPIs are precise enough.
+"""
+
+from __future__ import annotations
+from typing import Callable, Dict, Tuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
+import multiprocessing as mp
+import os
+import numpy as np
+import pandas as pd
+from scipy import stats
+import pharmalink.code.area as area
+import pharmalink.code.backends as backends
+import pharmalink.code.customers as cust
+import pharmalink.code.sources as src
+import pharmalink.code.spatial as spatial
+import pharmalink.code.vrp as vrp
+
+# Default quantiles tracked for every KPI
+QUANTILES = (0.05, 0.5, 0.95)
+
+# Routing backend of the current worker process, created once by _initialize_worker
+_backend = None
+
+
+class P2Quantile:
+    """A streaming quantile estimate by the P-square algorithm.
+
+    Five markers track the minimum, the quantile, the maximum and two intermediate quantiles.
+    Their heights are adjusted by piecewise-parabolic interpolation as observations arrive.
+
+    Attributes:
+        p (float): The quantile between 0 and 1.
+        count (int): The number of observations.
+
+    Methods:
+        add:    Add an observation.
+        value:  Get the current quantile estimate.
+    """
+
+    __slots__ = ["p", "count", "_heights", "_positions", "_desired", "_increments"]
+
+    def __init__(self, p: float) -> None:
+        """Initialize a P2Quantile without observations."""
+
+        self.p = p
+        self.count = 0
+        self._heights = []
+        self._positions = np.arange(5, dtype=float)
+        self._desired = np.array([0, 2 * p, 4 * p, 2 + 2 * p, 4])
+        self._increments = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+    def __repr__(self) -> str:
+        """Return all information about the P2Quantile object."""
+
+        return f"P2Quantile (p: {self.p}, Observations: {self.count}, Value: {self.value()})"
+
+    def add(self, x: float) -> None:
+        """Add an observation."""
+
+        self.count += 1
+
+        # The first five observations initialize the markers
+        if self.count <= 5:
+            self._heights.append(x)
+            self._heights.sort()
+            if self.count == 5:
+                self._heights = np.array(self._heights, dtype=float)
+            return
+
+        q, n = self._heights, self._positions
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = int(np.searchsorted(q, x, side="right")) - 1
+
+        n[k + 1 :] += 1
+        self._desired += self._increments
+
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = np.sign(d)
+
+                parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    j = i + int(d)
+                    q[i] = q[i] + d * (q[j] - q[i]) / (n[j] - n[i])
+
+                n[i] += d
+
+    def value(self) -> float:
+        """Get the current quantile estimate, NaN without observations."""
+
+        if self.count == 0:
+            return np.nan
+
+        if self.count < 5:
+            return float(np.quantile(self._heights, self.p))
+
+        return float(self._heights[2])
+
+
+class RunningStats:
+    """Streaming mean, variance and quantiles of one KPI.
+
+    Attributes:
+        count (int): The number of observations.
+        mean (float): The mean of all observations.
+        quantiles (Dict[float, P2Quantile]): The quantile estimates.
+
+    Methods:
+        add:        Add an observation.
+        variance:   Get the sample variance.
+        half_width: Get the half-width of the confidence interval of the mean.
+    """
+
+    __slots__ = ["count", "mean", "quantiles", "_m2"]
+
+    def __init__(self, quantiles: Tuple[float, ...] = QUANTILES) -> None:
+        """Initialize RunningStats without observations."""
+
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.quantiles = {p: P2Quantile(p) for p in quantiles}
+
+    def __repr__(self) -> str:
+        """Return all information about the RunningStats object."""
+
+        return f"RunningStats (Observations: {self.count}, Mean: {self.mean}, Variance: {self.variance()})"
+
+    def add(self, x: float) -> None:
+        """Add an observation (Welford's update)."""
+
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+
+        for quantile in self.quantiles.values():
+            quantile.add(x)
+
+    def variance(self) -> float:
+        """Get the sample variance, NaN for less than two observations."""
+
+        return self._m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    def half_width(self, confidence: float = 0.95) -> float:
+        """Get the half-width of the Student-t confidence interval of the mean, inf for less than two observations."""
+
+        if self.count < 2:
+            return np.inf
+
+        t = stats.t.ppf((1 + confidence) / 2, self.count - 1)
+
+        return float(t * np.sqrt(self.variance() / self.count))
+
+
+class ReplicationReport:
+    """The KPI statistics of all replications per area.
+
+    Attributes:
+        regkeys (list): The regkeys of all replicated areas.
+        stats (Dict[str, Dict[str, RunningStats]]): The statistics per regkey and KPI.
+        quantiles (Tuple[float, ...]): The tracked quantiles.
+
+    Methods:
+        add:            Add the KPIs of one replication.
+        is_converged:   Check whether all KPI confidence intervals of an area are narrow enough.
+        get_summary:    Get a summary table per area and KPI.
+    """
+
+    __slots__ = ["regkeys", "stats", "quantiles"]
+
+    def __init__(self, regkeys: list, quantiles: Tuple[float, ...] = QUANTILES) -> None:
+        """Initialize an empty ReplicationReport."""
+
+        self.regkeys = list(regkeys)
+        self.quantiles = quantiles
+        self.stats = {regkey: {} for regkey in self.regkeys}
+
+    def __repr__(self) -> str:
+        """Return all information about the ReplicationReport object."""
+
+        replications = sum(
+            next(iter(kpis.values())).count for kpis in self.stats.values() if kpis
+        )
+
+        return f"ReplicationReport (Areas: {len(self.regkeys)}, Replications: {replications})"
+
+    def add(self, regkey: str, kpis: Dict[str, float]) -> None:
+        """Add the KPIs of one replication of an area."""
+
+        for name, value in kpis.items():
+            self.stats[regkey].setdefault(name, RunningStats(self.quantiles)).add(
+                float(value)
+            )
+
+    def count(self, regkey: str) -> int:
+        """Get the number of replications of an area."""
+
+        kpis = self.stats[regkey]
+
+        return next(iter(kpis.values())).count if kpis else 0
+
+    def is_converged(
+        self, regkey: str, rel_width: float = 0.05, confidence: float = 0.95
+    ) -> bool:
+        """Check whether the confidence intervals of all KPIs of an area are narrow enough.
+
+        Parameters:
+            regkey (str): The regkey of the area.
+            rel_width (float): The target half-width of the confidence intervals relative to the mean.
+            confidence (float): The confidence level.
+
+        Returns:
+            converged (bool): Whether every half-width is at most rel_width times the absolute mean.
+
+        Raises:
+            None
+        """
+
+        kpis = self.stats[regkey]
+
+        return bool(kpis) and all(
+            kpi.half_width(confidence) <= rel_width * abs(kpi.mean)
+            or kpi.variance() == 0
+            for kpi in kpis.values()
+        )
+
+    def get_summary(self, confidence: float = 0.95) -> pd.DataFrame:
+        """Get a summary table per area and KPI.
+
+        Parameters:
+            confidence (float): The confidence level of the intervals.
+
+        Returns:
+            summary (pd.DataFrame): Replications, mean, standard deviation, confidence interval and
+                quantiles, indexed by regkey and KPI.
+
+        Raises:
+            None
+        """
+
+        rows = []
+        for regkey, kpis in self.stats.items():
+            for name, kpi in kpis.items():
+                half_width = kpi.half_width(confidence)
+                row = {
+                    "regkey": regkey,
+                    "kpi": name,
+                    "replications": kpi.count,
+                    "mean": kpi.mean,
+                    "std": np.sqrt(kpi.variance()),
+                    "ci_low": kpi.mean - half_width,
+                    "ci_high": kpi.mean + half_width,
+                }
+                for p, quantile in kpi.quantiles.items():
+                    row[f"q{round(p * 100):02d}"] = quantile.value()
+                rows.append(row)
+
+        return pd.DataFrame(rows).set_index(["regkey", "kpi"])
+
+
+def compute_kpis(
+    replication_area: area.Area,
+    customers: cust.Customers,
+    backend: backends.RoutingBackend,
+    rng: np.random.Generator,
+    courier_fraction: float = src.Constants.fraction_of_pharmaceuticals_delivered_by_courier,
+    capacity: float = np.inf,
+    time_limit: float = 1.0,
+) -> Dict[str, float]:
+    """Compute the default KPIs of one replication.
+
+    Every customer gets their pharmaceuticals from the nearest pharmacy. Each customer is delivered by courier
+    with probability courier_fraction, and every pharmacy serves its courier customers on tours of at most
+    capacity customers.
+
+    Parameters:
+        replication_area (area.Area): The area of the replication.
+        customers (cust.Customers): The generated customers.
+        backend (backends.RoutingBackend): The routing backend for the courier tours.
+        rng (np.random.Generator): The generator of all random decisions besides customer generation.
+        courier_fraction (float): The probability of a customer being delivered by courier.
+        capacity (float): The maximum number of customers per courier tour.
+        time_limit (float): The time budget of the local search per pharmacy in seconds.
+
+    Returns:
+        kpis (Dict[str, float]): The demand (customers), mean distance to the nearest pharmacy (km),
+            courier customers and total courier route cost (seconds).
+
+    Raises:
+        None
+    """
+
+    locations = customers.customers.to_crs(4326).get_coordinates().to_numpy()
+    coordinates = spatial.project(locations[:, 0], locations[:, 1])
+
+    index = src.Pharmacies.get_index()
+    distances, pharmacies = index.nearest(coordinates)
+    distances, pharmacies = distances[:, 0], pharmacies[:, 0]
+
+    courier = rng.random(len(locations)) < courier_fraction
+    pharmacy_locations = spatial.project(
+        index.coordinates[:, 0], index.coordinates[:, 1], inverse=True
+    )
+
+    route_cost = 0.0
+    for pharmacy in np.unique(pharmacies[courier]).tolist():
+        stops = locations[courier & (pharmacies == pharmacy)]
+        durations = backend.matrix(
+            np.vstack([pharmacy_locations[pharmacy], stops])
+        ).durations
+        route_cost += vrp.solve(
+            vrp.VrpProblem(durations, capacity=capacity), time_limit=time_limit
+        ).cost
+
+    return {
+        "demand": len(locations),
+        "distance": distances.mean() / 1000 if len(locations) else 0.0,
+        "courier_customers": int(courier.sum()),
+        "route_cost": route_cost,
+    }
+
+
+@lru_cache(maxsize=64)
+def _get_area(regkey: str) -> area.Area:
+    """Get an Area, created once per worker process."""
+
+    return area.Area(regkey)
+
+
+def _initialize_worker(backend: str) -> None:
+    """Create the routing backend and load the sources of a worker process."""
+
+    global _backend
+    _backend = backends.create_backend(backend)
+
+    src.Pharmacies.get_index()
+
+
+def _replicate(
+    regkey: str,
+    sequence: np.random.SeedSequence,
+    kpis: Callable[..., Dict[str, float]],
+) -> Dict[str, float]:
+    """Run one replication of an area in a worker process."""
+
+    customer_seed, kpi_seed = sequence.spawn(2)
+    replication_area = _get_area(regkey)
+
+    customers = cust.Customers(
+        replication_area, seed=int(customer_seed.generate_state(1)[0])
+    )
+
+    return kpis(replication_area, customers, _backend, np.random.default_rng(kpi_seed))
+
+
+def run_replications(
+    regkeys: list,
+    max_replications: int = 100,
+    min_replications: int = 5,
+    rel_width: float = 0.05,
+    confidence: float = 0.95,
+    quantiles: Tuple[float, ...] = QUANTILES,
+    kpis: Callable[..., Dict[str, float]] = compute_kpis,
+    backend: str = "haversine",
+    max_workers: int | None = None,
+    seed: int | None = None,
+) -> ReplicationReport:
+    """Run seeded replications of areas until their KPIs are precise enough.
+
+    Every area gets at least min_replications and at most max_replications replications. In between,
+    replications of an area stop once is_converged holds. The workers are kept busy with the areas
+    that have the fewest replications so far.
+
+    Parameters:
+        regkeys (list): The regkeys of the areas.
+        max_replications (int): The maximum number of replications per area.
+        min_replications (int): The minimum number of replications per area.
+        rel_width (float): The target half-width of the confidence intervals relative to the mean.
+        confidence (float): The confidence level.
+        quantiles (Tuple[float, ...]): The quantiles tracked for every KPI.
+        kpis (Callable[..., Dict[str, float]]): A module-level function computing the KPIs of one replication,
+            with the signature of compute_kpis.
+        backend (str): The name of the routing backend, see backends.create_backend.
+        max_workers (int | None): The number of worker processes. Defaults to the number of CPU cores.
+        seed (int | None): The seed all replication seeds are derived from.
+
+    Returns:
+        report (ReplicationReport): The KPI statistics per area.
+
+    Raises:
+        ValueError: If min_replications exceeds max_replications.
+    """
+
+    if min_replications > max_replications:
+        raise ValueError("min_replications must not exceed max_replications.")
+
+    max_workers = max_workers or os.cpu_count()
+    report = ReplicationReport(regkeys, quantiles)
+
+    # Replication i of the k-th area always gets the seed sequence (k, i) of the root entropy
+    entropy = np.random.SeedSequence(seed).entropy
+    submitted = dict.fromkeys(report.regkeys, 0)
+    pending = {}
+
+    # Spawned workers start from a clean interpreter, so no state of the parent is inherited
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_initialize_worker,
+        initargs=(backend,),
+    ) as executor:
+
+        def submit(regkey: str) -> None:
+            sequence = np.random.SeedSequence(
+                entropy, spawn_key=(report.regkeys.index(regkey), submitted[regkey])
+            )
+            pending[executor.submit(_replicate, regkey, sequence, kpis)] = regkey
+            submitted[regkey] += 1
+
+        def is_active(regkey: str) -> bool:
+            if submitted[regkey] >= max_replications:
+                return False
+            if submitted[regkey] < min_replications:
+                return True
+
+            return report.count(regkey) < min_replications or not report.is_converged(
+                regkey, rel_width, confidence
+            )
+
+        while True:
+            # Keep twice as many replications pending as there are workers
+            while len(pending) < 2 * max_workers:
+                active = [regkey for regkey in report.regkeys if is_active(regkey)]
+                if not active:
+                    break
+                submit(min(active, key=submitted.get))
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                report.add(pending.pop(future), future.result())
+
+    return report
@@ -6,6 +6,7 @@ import venv
 
 if TYPE_CHECKING:
     import pharmalink.code.valhalla.lib.src.bindings.python.valhalla as valhalla
+    import pharmalink.code.area as area
 
 
 import importlib.resources as res
@@ -14,53 +15,328 @@ import subprocess
 import pathlib as path
 import json
 import os
-import requests as req
+import hashlib
+import threading
+import time
 import sys
-
+import numpy as np
+import shapely
+import pharmalink.code.matrix as matrix
+import pharmalink.code.spatial as spatial
 
 lib_dir = res.files(__package__).joinpath("valhalla", "lib")
 data_dir = res.files(__package__).joinpath("valhalla", "data")
+regions_dir = res.files(__package__).joinpath("valhalla", "regions")
+
+# Distance in metres by which the bounding box of a regional graph extends beyond its area
+REGION_BUFFER = 10_000
+
+
+# A short route within Berlin (Alexanderplatz to Potsdamer Platz) queried to warm up a new actor.
+# Locations far apart would exceed Valhalla's maximum matrix and route distances.
+WARMUP_LOCATIONS = [
+    (13.4132, 52.5219),
+    (13.3759, 52.5096),
+]
+
+# Offset in degrees of longitude of the second warm-up location of a regional graph (about 1 km)
+WARMUP_OFFSET = 0.015
 
 
 def create_routing_actor(
-    force_valhalla_build: bool = False, force_graph_build: bool = False
+    force_valhalla_build: bool = False,
+    force_graph_build: bool = False,
+    max_rebuilds: int = 1,
+    area: area.Area | None = None,
+    buffer: float = REGION_BUFFER,
 ) -> valhalla.Actor:
     """Create a new Valhalla routing actor.
 
     WARNING: Running this for the first time will trigger multiple lengthy build processes to bootstrap everything.
+    If the actor cannot be created, the library is rebuilt at most max_rebuilds times before giving up.
 
     Args:
-        forced: Whether to build anew or lazy-load existing parts from cache.
+        force_valhalla_build: Whether to rebuild the library instead of lazy-loading it from cache.
+        force_graph_build: Whether to rebuild the graph instead of lazy-loading it from cache.
+        max_rebuilds: The maximum number of forced library rebuilds after a failed actor creation.
+        area: An optional area to route within, using a regional graph instead of the graph of Germany.
+        buffer: The distance in metres by which a regional graph extends beyond the area.
 
     Returns:
         A valhalla.Actor instance.
+
+    Raises:
+        RuntimeError: If the actor could not be created after all rebuilds.
     """
 
-    if not lib_dir.exists() or force_valhalla_build:
-        build_valhalla(forced=force_valhalla_build)
+    # Load the Valhalla configuration file
+    directory = get_data_dir(area)
+    config_file = directory.joinpath("valhalla.json")
+
+    for attempt in range(max_rebuilds + 1):
+        if not lib_dir.exists() or force_valhalla_build:
+            build_valhalla(forced=force_valhalla_build)
 
-    if not data_dir.exists() or force_graph_build:
-        build_graph(forced=force_graph_build)
+        if not config_file.exists() or force_graph_build:
+            build_graph(forced=force_graph_build, area=area, buffer=buffer)
+
+        # Create a new Valhalla actor
+        try:
+            valhalla = _import_bindings()
+            return valhalla.Actor(str(config_file))
+
+        except Exception as e:
+            error = e
+            print(e)
+
+            if attempt < max_rebuilds:
+                print(
+                    "Valhalla actor creation failed. Trying again with forced lib rebuild..."
+                )
+                force_valhalla_build = True  # force lib rebuild
+                force_graph_build = False
+
+    raise RuntimeError(
+        f"Valhalla actor creation failed after {max_rebuilds} library rebuild(s)."
+    ) from error
+
+
+def _import_bindings():
+    """Import the Valhalla python bindings from the built library."""
+
+    bindings_path = lib_dir.joinpath("src", "bindings", "python").as_posix()
+
+    if bindings_path not in sys.path:
+        sys.path.append(bindings_path)
 
-    # Load the Valhalla library
-    bindings_path = res.files(__package__).joinpath(
-        "valhalla", "lib", "src", "bindings", "python"
-    )
-    sys.path.append(bindings_path.as_posix())
     import valhalla
 
-    # Load the Valhalla configuration file
-    config_file = data_dir.joinpath("valhalla.json")
+    return valhalla
+
+
+def get_data_dir(area: area.Area | None = None) -> path.Path:
+    """Get the data directory of the graph of Germany or of a regional graph.
+
+    Args:
+        area: An optional area whose regional graph is requested.
+
+    Returns:
+        The data directory holding the graph and its config.
+    """
+
+    if area is None:
+        return data_dir
+
+    return regions_dir.joinpath(area.regkey)
+
+
+def get_region_bounds(area: area.Area, buffer: float = REGION_BUFFER) -> list:
+    """Get the bounding box of a regional graph.
+
+    Args:
+        area: The area of the regional graph.
+        buffer: The distance in metres by which the bounding box extends beyond the area.
+
+    Returns:
+        The bounding box as [min_lon, min_lat, max_lon, max_lat] in EPSG:4326.
+    """
+
+    bounds = (
+        area.geometry.to_crs(spatial.PROJECTED_CRS)
+        .envelope.buffer(buffer, join_style="mitre")
+        .to_crs(4326)
+        .total_bounds
+    )
+
+    return [round(float(value), 5) for value in bounds]
+
+
+class RoutingService:
+    """Process-wide routing service holding one warm Valhalla actor per graph.
+
+    Creating an actor loads the graph configuration, and its first queries page in tile data from disk.
+    The service therefore creates the actor of a graph (Germany or a regional graph) only once per process,
+    warms it up with a cheap matrix query and hands out the same actor to all callers. Worker processes
+    (e.g. of an actor_pool.ActorPool) get their own actors, as actors cannot be shared between processes.
+
+    Attributes:
+        load_time: Seconds taken to create the most recently loaded actor, None if none was loaded.
+        warmup_time: Seconds taken by the most recent warm-up query, None if none was run.
+
+    Methods:
+        get_actor: Get the warm routing actor of the current process.
+        is_ready:  Check whether a warm, healthy actor is loaded in the current process.
+        check_health: Run a health check query on an actor.
+        reset:     Drop all actors of the current process.
+    """
+
+    load_time = None
+    warmup_time = None
+
+    # Actors of the current process per regkey (None = Germany) and the id of the process that created them
+    _actors = {}
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_actor(
+        cls,
+        max_rebuilds: int = 1,
+        area: area.Area | None = None,
+        buffer: float = REGION_BUFFER,
+    ) -> valhalla.Actor:
+        """Get the warm routing actor of the current process, creating it on first use.
+
+        Args:
+            max_rebuilds: The maximum number of forced library rebuilds if the actor cannot be created.
+            area: An optional area to route within, using its regional graph.
+            buffer: The distance in metres by which a regional graph extends beyond the area.
+
+        Returns:
+            A warmed-up valhalla.Actor instance.
+
+        Raises:
+            RuntimeError: If the actor could not be created or fails its health check.
+        """
+
+        regkey = None if area is None else area.regkey
+
+        with cls._lock:
+            # Actors inherited from a parent process are unusable
+            if cls._pid != os.getpid():
+                cls._actors = {}
+                cls._pid = os.getpid()
+
+            if regkey in cls._actors:
+                return cls._actors[regkey]
+
+            start = time.perf_counter()
+            actor = create_routing_actor(
+                max_rebuilds=max_rebuilds, area=area, buffer=buffer
+            )
+            cls.load_time = time.perf_counter() - start
+
+            # The first query pages in tile data, so later queries run at full speed
+            if area is None:
+                locations = np.array(WARMUP_LOCATIONS)
+            else:
+                point = shapely.get_coordinates(
+                    area.geometry.geometry.representative_point()
+                )[0]
+                locations = np.array([point, point + (WARMUP_OFFSET, 0.0)])
+
+            start = time.perf_counter()
+            if not cls.check_health(actor, locations):
+                raise RuntimeError("Valhalla actor failed its health check.")
+            cls.warmup_time = time.perf_counter() - start
+
+            cls._actors[regkey] = actor
+
+            return actor
+
+    @classmethod
+    def is_ready(cls, area: area.Area | None = None) -> bool:
+        """Check whether a warm, healthy actor is loaded in the current process."""
+
+        regkey = None if area is None else area.regkey
+
+        return cls._pid == os.getpid() and regkey in cls._actors
+
+    @staticmethod
+    def check_health(
+        actor: valhalla.Actor, locations: np.ndarray | None = None
+    ) -> bool:
+        """Run a health check query on an actor.
+
+        A short auto route through the locations is computed. The actor is healthy
+        if it finds a route.
 
-    # Create a new Valhalla actor
+        Args:
+            actor: The routing actor to check.
+            locations: (longitude, latitude) pairs close to each other within the graph.
+                Defaults to the warm-up locations in Berlin.
 
-    try:
-        return valhalla.Actor(str(config_file))
+        Returns:
+            Whether the actor is healthy.
+        """
 
-    except Exception as e:
-        print(e)
-        print("Valhalla actor creation failed. Trying again with forced lib rebuild...")
-        return create_routing_actor(force_valhalla_build=True)  # force lib rebuild
+        if locations is None:
+            locations = np.array(WARMUP_LOCATIONS)
+        request = {
+            "locations": matrix.to_locations(locations),
+            "costing": "auto",
+        }
+
+        try:
+            response = json.loads(actor.route(json.dumps(request)))
+        except Exception as e:
+            print(e)
+            return False
+
+        return response.get("trip", {}).get("status") == 0
+
+    @classmethod
+    def reset(cls) -> None:
+        """Drop all actors of the current process, so the next get_actor call creates a new one."""
+
+        with cls._lock:
+            cls._actors = {}
+            cls._pid = None
+            cls.load_time = None
+            cls.warmup_time = None
+
+
+def get_graph_version(area: area.Area | None = None) -> str:
+    """Get a version identifier of the current Valhalla graph.
+
+    The identifier is the SHA-256 hash of the compressed graph (tiles.tar).
+
+    Args:
+        area: An optional area whose regional graph is identified.
+
+    Returns:
+        The first 16 hex digits of the graph's SHA-256 hash.
+    """
+
+    return hash_file(get_data_dir(area).joinpath("tiles.tar"))[:16]
+
+
+def hash_file(file: path.Path) -> str:
+    """Compute the SHA-256 hash of a file.
+
+    As hashing several GB takes a while, the hash is stored next to the file and only recomputed
+    if the file's size or modification time changes.
+
+    Args:
+        file: The file to hash.
+
+    Returns:
+        The hex digest of the file's SHA-256 hash.
+    """
+
+    file = path.Path(file)
+    sidecar = file.with_name(file.name + ".sha256")
+
+    stat = os.stat(file)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    # Reuse the stored hash if the file has not changed since it was computed
+    if sidecar.exists():
+        with open(sidecar, "r") as f:
+            stored = json.load(f)
+
+        if all(stored.get(key) == value for key, value in fingerprint.items()):
+            return stored["sha256"]
+
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(16 * 1024 * 1024):
+            digest.update(chunk)
+
+    with open(sidecar, "w") as f:
+        json.dump(fingerprint | {"sha256": digest.hexdigest()}, f)
+
+    return digest.hexdigest()
 
 
 def build_valhalla(forced: bool = False) -> None:
@@ -188,298 +464,46 @@ def build_valhalla(forced: bool = False) -> None:
     shutil.rmtree(build_dir)
 
 
-def build_graph(forced: bool = False) -> None:
+def build_graph(
+    forced: bool = False,
+    area: area.Area | None = None,
+    buffer: float = REGION_BUFFER,
+) -> None:
     """Build the Valhalla routing graph for a given OSM input file.
 
     WARNING: This process is quite resource-intensive and can take a long time to complete.
     Unlike the library build, this should work on all systems out of the box.
     It is again loosely based on the official Valhalla documentation, but I had to hand-stitch the components together.
-    """
-
-    # TODO: Simplify the cache/data structure (optimally alike the OSM input file), it's a bit convoluted right now and duplicate copies should be unnecessary
-
-    cache_dir = res.files(__package__).joinpath("valhalla", "cache")
-
-    if data_dir.exists() and not forced:
-        print("Valhalla graph found. Skipping build.")
-        return
-
-    # Continue with build if the Valhalla graph is missing or forced
-    print("Valhalla graph not found. Building now...")
-
-    # Cleanup existing Valhalla data directory
-    if data_dir.exists():
-        shutil.rmtree(data_dir)
-
-    data_dir.mkdir(exist_ok=True, parents=True)
-
-    # CONFIG FILE
-
-    config_source = cache_dir.joinpath("valhalla.json")
-    config_target = data_dir.joinpath("valhalla.json")
-
-    print("Creating config file...")
-
-    # Create the default config content
-    default_config_builder = str(lib_dir.joinpath("valhalla_build_config"))
-    default_config_run = subprocess.run(
-        [default_config_builder],
-        check=True,
-        cwd=str(lib_dir),
-        stdout=subprocess.PIPE,
-    )
-    default_config = json.loads(default_config_run.stdout)
-
-    # Update the config with the paths to the input and output files
-    custom_config_params = {
-        "mjolnir": {
-            "tile_dir": str(data_dir.joinpath("tiles")),
-            "tile_extract": str(data_dir.joinpath("tiles.tar")),
-            "admin": str(data_dir.joinpath("admin.sqlite")),
-            "timezone": str(data_dir.joinpath("tz_world.sqlite")),
-            "transit_dir": str(data_dir.joinpath("transit")),
-            "transit_feeds_dir": str(data_dir.joinpath("transit_feeds")),
-            "default_speeds_config": str(data_dir.joinpath("default_speeds.json")),
-        },
-        "additional_data": {
-            "elevation": str(data_dir.joinpath("elevation_data")),
-        },
-    }
-    # Merge the default and custom config
-    config = default_config | custom_config_params
-
-    # Write the final config to a file
-    with open(config_target, "w") as file:
-        json.dump(config, file)
-
-    # Copy the built config file to the source directory for simple caching
-    shutil.copy(config_target, config_source)
-    print("Config file created.")
-
-    config_file = config_target
-
-    # ENSURE NECESSARY FILES EXIST
-
-    # OSM INPUT FILE
-    input_file = cache_dir.joinpath("germany.osm.pbf")
-
-    if not input_file.exists() or forced:
-        print("Downloading OSM input file...")
-        input_url = "https://download.geofabrik.de/europe/germany-latest.osm.pbf"
-
-        # This file is around 4 GB in size, so we stream it to disk
-        with req.get(input_url, stream=True) as request:
-            request.raise_for_status()
-            with open(input_file, "wb") as file:
-                for chunk in request.iter_content(chunk_size=8192):
-                    file.write(chunk)
-
-        print("OSM input file downloaded.")
-
-    # Default speeds file to enhance graph
-    default_speeds_source = cache_dir.joinpath("default_speeds.json")
-    default_speeds_target = path.Path(config["mjolnir"]["default_speeds_config"])
-
-    # Download default speeds data
-    if not default_speeds_source.exists() or forced:
-        print("Downloading default speeds file...")
-        default_speeds_url = "https://raw.githubusercontent.com/OpenStreetMapSpeeds/schema/master/default_speeds.json"
-
-        with open(default_speeds_source, "wb") as f:
-            f.write(req.get(default_speeds_url).content)
-
-    shutil.copy(default_speeds_source, default_speeds_target)
-    print("Default speeds file copied.")
-
-    # Download transit data for Germany
-    # transit_feeds_source = cache_dir.joinpath("transit_feeds")
-    # transit_feeds_target = path.Path(config["mjolnir"]["transit_feeds_dir"])
-
-    # if not transit_feeds_source.exists() or forced:
-    #     # Create transit feeds directory and a subdirectory for Germany
-    #     transit_feeds_source.mkdir(parents=True, exist_ok=True)
-
-    #     # Download feed for Germany
-    #     germany_dir = transit_feeds_source.joinpath("germany")
-    #     germany_dir.mkdir(parents=True, exist_ok=True)
-
-    #     # Download GTFS data for Germany
-    #     gtfs_url = "https://download.gtfs.de/germany/free/latest.zip"
-    #     # gtfs_url = ""
-
-    #     print("Downloading GTFS data for Germany...")
-    #     gtfs_file = germany_dir.joinpath("gtfs.zip")
-    #     with open(gtfs_file, "wb") as f:
-    #         f.write(req.get(gtfs_url).content)
-
-    #     # Unzip the GTFS data
-    #     with zipfile.ZipFile(gtfs_file, "r") as zip_ref:
-    #         zip_ref.extractall(germany_dir)
-    #     gtfs_file.unlink()
-
-    #     print("GTFS data for Germany downloaded.")
-
-    # shutil.copytree(transit_feeds_source, transit_feeds_target)
-    # print("Transit data copied.")
-
-    # BUILD ADMINS
-    admins_source = cache_dir.joinpath("admin.sqlite")
-    admins_target = path.Path(config["mjolnir"]["admin"])
-
-    if not admins_source.exists() or forced:
-        print("Building admins database...")
-        admins_command = [
-            str(lib_dir.joinpath("valhalla_build_admins")),
-            "--config",
-            str(config_file),
-            str(input_file),
-        ]
-        subprocess.run(admins_command, check=True, cwd=str(lib_dir))
-
-        # Copy the built admins database to the source directory for simple caching
-        shutil.copy(admins_target, admins_source)
-
-        print("Admins database built.")
 
-    shutil.copy(admins_source, admins_target)
-    print("Admins database copied.")
+    The build runs as a pipeline of cached stages (see build.py): unchanged stages are skipped and their
+    stored outputs are linked into the data directory instead of being copied.
 
-    # BUILD TIMEZONES
-    timezones_source = cache_dir.joinpath("tz_world.sqlite")
-    timezones_target = path.Path(config["mjolnir"]["timezone"])
+    If an area is given, the OSM input file is first cut to the area's bounding box plus a buffer,
+    and a much smaller regional graph is built into its own data directory (valhalla/regions/<regkey>).
+    For a single Kreis this takes minutes instead of hours.
 
-    if not timezones_source.exists() or forced:
-        print("Building timezones database...")
-        timezones = subprocess.run(
-            str(lib_dir.joinpath("valhalla_build_timezones")),
-            check=True,
-            cwd=str(lib_dir),
-            stdout=subprocess.PIPE,
-        )
+    Args:
+        forced: Whether to rerun all stages instead of only the changed ones.
+        area: An optional area to build a regional graph for.
+        buffer: The distance in metres by which a regional graph extends beyond the area.
+    """
 
-        with open(config["mjolnir"]["timezone"], "wb") as f:
-            f.write(timezones.stdout)
-
-        # Copy the built timezones database to the source directory for simple caching
-        shutil.copy(timezones_target, timezones_source)
-
-        print("Timezones database built.")
-
-    shutil.copy(timezones_source, timezones_target)
-    print("Timezones database copied.")
-
-    # TRANSIT DATA
-    # transit_dir_source = cache_dir.joinpath("transit")
-    # transit_dir_target = path.Path(config["mjolnir"]["transit_dir"])
-
-    # if not transit_dir_source.exists() or forced:
-    #     print("Building transit data...")
-    #     ingest_transit_cmd = [
-    #         str(lib_dir.joinpath("valhalla_ingest_transit")),
-    #         "--config",
-    #         str(config_file),
-    #         str(input_file),
-    #     ]
-    #     subprocess.run(
-    #         ingest_transit_cmd,
-    #         check=True,
-    #         cwd=str(lib_dir),
-    #     )
-
-    #     # Copy the built transit data to the source directory for simple caching
-    #     shutil.copytree(transit_dir_target, transit_dir_source)
-    #     print("Transit data built.")
-
-    # shutil.copytree(transit_dir_source, transit_dir_target)
-    # print("Transit data copied.")
-
-    # TODO: Give this another go if possible. Parsing the transit data took over 10 days on a M1 Pro during a trial run (before failing due to a mistake on my part).
-    # However, while transit is relevant for accurately representing used modes of transport, valhalla matrices can only be calculated for auto, pedestrian, and bicycle modes, anyways.
-
-    # FIRST TILE BUILD
-    tiles_source = cache_dir.joinpath("tiles")
-    tiles_target = path.Path(config["mjolnir"]["tile_dir"])
-
-    if not tiles_source.exists() or forced:
-        print("Building first tiles...")
-        tiles_command = [
-            str(lib_dir.joinpath("valhalla_build_tiles")),
-            "-e",
-            "build",  # end at build stage, before enhance
-            "--config",
-            str(config_file),
-            str(input_file),
-        ]
-        subprocess.run(tiles_command, check=True, cwd=str(lib_dir))
-
-        print("First tiles built.")
-
-        # ELEVATION TILES
-        elevation_source = cache_dir.joinpath("elevation_data")
-        elevation_target = path.Path(config["additional_data"]["elevation"])
-
-        if not elevation_source.exists() or forced:
-            print("Building elevation tiles...")
-            elevation_command = [
-                str(lib_dir.joinpath("valhalla_build_elevation")),
-                "-v",
-                "--from-tiles",
-                "-z",
-                "--config",
-                str(config_file),
-            ]
-            subprocess.run(elevation_command, check=True, cwd=str(lib_dir))
-
-            # Copy the built elevation tiles to the source directory for simple caching
-            shutil.copytree(elevation_target, elevation_source)
-            print("Elevation tiles built.")
-        else:
-            shutil.copytree(elevation_source, elevation_target)
-            print("Elevation tiles copied.")
-
-        # ENHANCE TILES
-        print("Enhancing tiles...")
-        enhance_command = [
-            str(lib_dir.joinpath("valhalla_build_tiles")),
-            "-s",
-            "enhance",  # start at enhance stage, after build
-            "--config",
-            str(config_file),
-            str(input_file),
-        ]
-        subprocess.run(enhance_command, check=True, cwd=str(lib_dir))
-        print("Tiles enhanced.")
+    import pharmalink.code.build as build
 
-        shutil.copytree(tiles_target, tiles_source)
-        print("Enhanced tiles copied to source.")
+    directory = get_data_dir(area)
 
+    if area is None:
+        print("Building Valhalla graph...")
+        stages = build.create_stages(directory)
     else:
-        shutil.copytree(tiles_source, tiles_target)
-        print("Tiles copied.")
-
-    # EXTRACT AND COMPRESS GRAPH
-
-    extract_source = cache_dir.joinpath("tiles.tar")
-    extract_target = path.Path(config["mjolnir"]["tile_extract"])
-
-    if not extract_source.exists() or forced:
-        print("Extracting graph...")
-        extract_command = [
-            str(lib_dir.joinpath("valhalla_build_extract")),
-            "-v",
-            "--config",
-            str(config_file),
-            "-O",
-        ]
-        subprocess.run(extract_command, check=True, cwd=str(lib_dir))
-
-        # Copy the compressed graph to the cache directory
-        shutil.copy(extract_target, extract_source)
+        print(f"Building regional Valhalla graph for {area.regkey}...")
+        stages = build.create_stages(
+            directory, region=area.regkey, bounds=get_region_bounds(area, buffer)
+        )
 
-        print("Graph extracted and compressed.")
+    build.run_pipeline(stages, directory, forced=forced)
 
-    shutil.copy(extract_source, extract_target)
-    print("Compressed graph copied.")
+    # Transit data is not built: valhalla matrices can only be calculated for auto, pedestrian, and bicycle modes,
+    # and parsing the transit data took over 10 days on a M1 Pro during a trial run.
 
     print("Valhalla graph built. Ready to route.")
-    return
@@ -0,0 +1,616 @@
+"""Module for a long-running local model service with warm caches.
+
+Every script or notebook run pays for imports, source decompression and routing actor startup from scratch.
+The ModelService instead runs as a local asyncio HTTP server (on a TCP port or a Unix socket) and keeps
+everything warm in memory between requests:
+
+- the pharmacy index and the source datasets of recently used areas (sources.GeometryHandler cache),
+- the routing backend, for Valhalla optionally backed by an actor_pool.ActorPool and a cache.TravelTimeCache,
+- the Area and Customers objects of recently used areas and seeds,
+- the responses of recent deterministic requests.
+
+Requests and responses are JSON. The endpoints are:
+
+    GET  /health        Status and cache sizes of the service.
+    POST /area          {"area": "09162"}
+    POST /customers     {"area": "09162", "seed": 1}
+    POST /matrix        {"sources": [[lon, lat], ...], "targets": [[lon, lat], ...], "costing": "auto"}
+    POST /assignment    {"area": "09162", "seed": 1, "capacity": 500} or {"locations": [[lon, lat], ...]}
+
+Model computations run in a thread pool, so the event loop keeps accepting requests. Concurrent requests
+for the same Area or Customers share a single computation.
+
+Classes:
+    ModelService:   A local HTTP server answering model requests from warm caches.
+    ServiceClient:  A minimal client of the ModelService.
+
+Functions:
+    main:   Run the ModelService from the command line.
+"""
+
+from __future__ import annotations
+from typing import Any, Callable, Dict, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import socket
+import time
+import numpy as np
+import pharmalink.code.actor_pool as actor_pool
+import pharmalink.code.area as area
+import pharmalink.code.assignment as assignment
+import pharmalink.code.backends as backends
+import pharmalink.code.cache as cache
+import pharmalink.code.customers as cust
+import pharmalink.code.sources as src
+import pharmalink.code.spatial as spatial
+
+DEFAULT_PORT = 8765
+
+# Maximum size of a request body in bytes
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+
+class ModelService:
+    """A local HTTP server answering model requests from warm caches.
+
+    Attributes:
+        backend (backends.RoutingBackend): The routing backend of all matrix requests.
+        cache_size (int): The maximum number of Areas, Customers and responses kept per cache.
+        requests (int): The number of requests answered since startup.
+        started (float): The time.time() the service was started at.
+
+    Methods:
+        warm_up:    Load the pharmacy index and the given areas ahead of the first request.
+        serve:      Serve requests on a TCP port or a Unix socket until cancelled.
+        get_area:   Get the (cached) Area of an identifier.
+        get_customers: Get the (cached) Customers of an area and seed.
+        close:      Shut down the thread pool and the routing backend.
+    """
+
+    __slots__ = [
+        "backend",
+        "cache_size",
+        "requests",
+        "started",
+        "_executor",
+        "_areas",
+        "_customers",
+        "_responses",
+        "_pending",
+        "_routes",
+    ]
+
+    def __init__(
+        self,
+        backend: backends.RoutingBackend | str = "haversine",
+        cache_size: int = 32,
+        max_workers: int | None = None,
+    ) -> None:
+        """Initialize a ModelService.
+
+        Parameters:
+            backend (backends.RoutingBackend | str): The routing backend or its name, see backends.create_backend.
+            cache_size (int): The maximum number of Areas, Customers and responses kept per cache.
+            max_workers (int | None): The number of threads computing requests. Defaults to the number of CPU cores.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        if isinstance(backend, str):
+            backend = backends.create_backend(backend)
+
+        self.backend = backend
+        self.cache_size = cache_size
+        self.requests = 0
+        self.started = time.time()
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+        self._areas = OrderedDict()
+        self._customers = OrderedDict()
+        self._responses = OrderedDict()
+
+        # Futures of computations in progress, shared by concurrent requests for the same key
+        self._pending = {}
+
+        self._routes = {
+            ("GET", "/health"): self._health,
+            ("POST", "/area"): self._area,
+            ("POST", "/customers"): self._customers_endpoint,
+            ("POST", "/matrix"): self._matrix,
+            ("POST", "/assignment"): self._assignment,
+        }
+
+    def __repr__(self) -> str:
+        """Return all information about the ModelService object."""
+
+        return (
+            f"ModelService (Backend: {type(self.backend).__name__}, "
+            f"Areas: {len(self._areas)}, Customers: {len(self._customers)}, "
+            f"Responses: {len(self._responses)})"
+        )
+
+    def warm_up(self, identifiers: Tuple[str, ...] = ()) -> None:
+        """Load the pharmacy index and the given areas ahead of the first request.
+
+        Parameters:
+            identifiers (Tuple[str, ...]): The regkeys or names of areas to load, including their sources.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        src.Pharmacies.get_index()
+
+        for identifier in identifiers:
+            loaded = area.Area(identifier)
+            self._remember(self._areas, identifier, loaded)
+
+            src.ResidentialAreas.get_within_area(loaded)
+            src.PopulationGrids.get_within_area(loaded)
+
+    async def serve(
+        self,
+        host: str = "127.0.0.1",
+        port: int = DEFAULT_PORT,
+        unix_path: str | None = None,
+    ) -> None:
+        """Serve requests on a TCP port or a Unix socket until cancelled.
+
+        Parameters:
+            host (str): The host to bind to. Only used without unix_path.
+            port (int): The TCP port to bind to. Only used without unix_path.
+            unix_path (str | None): The path of a Unix socket to bind to instead of a TCP port.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self._handle, path=unix_path)
+            print(f"Serving on {unix_path}.")
+        else:
+            server = await asyncio.start_server(self._handle, host=host, port=port)
+            print(f"Serving on http://{host}:{port}.")
+
+        async with server:
+            await server.serve_forever()
+
+    async def get_area(self, identifier: str) -> area.Area:
+        """Get the (cached) Area of an identifier."""
+
+        return await self._cached(
+            self._areas, str(identifier), lambda: area.Area(str(identifier))
+        )
+
+    async def get_customers(self, identifier: str, seed: int | None) -> cust.Customers:
+        """Get the (cached) Customers of an area and seed.
+
+        Customers without a seed are random, so they are generated anew for every request.
+        """
+
+        customer_area = await self.get_area(identifier)
+
+        if seed is None:
+            return await self._run(cust.Customers, customer_area)
+
+        return await self._cached(
+            self._customers,
+            (customer_area.regkey, int(seed)),
+            lambda: cust.Customers(customer_area, seed=int(seed)),
+        )
+
+    def close(self) -> None:
+        """Shut down the thread pool and the routing backend."""
+
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+        router = getattr(self.backend, "router", None)
+        if hasattr(router, "close"):
+            router.close()
+
+    def _remember(self, cache: OrderedDict, key: Any, value: Any) -> None:
+        """Store a value in a cache, evicting the least recently used entries beyond cache_size."""
+
+        cache[key] = value
+        cache.move_to_end(key)
+
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    async def _run(self, function: Callable, *args) -> Any:
+        """Run a blocking function in the thread pool."""
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, function, *args
+        )
+
+    async def _cached(self, cache: OrderedDict, key: Any, compute: Callable) -> Any:
+        """Get a value from a cache, computing it only once for concurrent requests."""
+
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        pending = (id(cache), key)
+        if pending not in self._pending:
+            self._pending[pending] = asyncio.ensure_future(self._run(compute))
+
+        try:
+            value = await asyncio.shield(self._pending[pending])
+        finally:
+            self._pending.pop(pending, None)
+
+        self._remember(cache, key, value)
+
+        return value
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Answer the HTTP/1.1 requests of a connection (keep-alive) until the client closes it."""
+
+        try:
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_SIZE:
+                    status, data = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"{}"
+                    await self._respond(writer, status, data, close=True)
+                    break
+
+                body = await reader.readexactly(length)
+                status, data = await self._dispatch(method, target.split("?")[0], body)
+
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, data, close)
+                if close:
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(
+        writer: asyncio.StreamWriter, status: HTTPStatus, data: bytes, close: bool
+    ) -> None:
+        """Write a JSON response."""
+
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def _dispatch(
+        self, method: str, target: str, body: bytes
+    ) -> Tuple[HTTPStatus, bytes]:
+        """Route a request to its endpoint and serialize the response."""
+
+        endpoint = self._routes.get((method, target))
+        if endpoint is None:
+            return HTTPStatus.NOT_FOUND, _dumps({"error": f"No endpoint {target}."})
+
+        try:
+            payload = json.loads(body) if body else {}
+
+            # Deterministic requests are answered from the response cache
+            key = (target, json.dumps(payload, sort_keys=True))
+            if key in self._responses:
+                self._responses.move_to_end(key)
+                data = self._responses[key]
+            else:
+                result, cacheable = await endpoint(payload)
+                data = _dumps(result)
+                if cacheable:
+                    self._remember(self._responses, key, data)
+
+        except (KeyError, TypeError, ValueError) as error:
+            return HTTPStatus.BAD_REQUEST, _dumps(
+                {"error": f"{type(error).__name__}: {error}"}
+            )
+
+        except Exception as error:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, _dumps(
+                {"error": f"{type(error).__name__}: {error}"}
+            )
+
+        self.requests += 1
+
+        return HTTPStatus.OK, data
+
+    async def _health(self, payload: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """Status and cache sizes of the service."""
+
+        return {
+            "status": "ok",
+            "backend": type(self.backend).__name__,
+            "uptime": time.time() - self.started,
+            "requests": self.requests,
+            "areas": len(self._areas),
+            "customers": len(self._customers),
+            "responses": len(self._responses),
+        }, False
+
+    async def _area(self, payload: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """Information about an area."""
+
+        result = await self.get_area(payload["area"])
+
+        return {
+            "regkey": result.regkey,
+            "level": str(result.level),
+            "bundesland": result.bundesland,
+            "full_name": str(result.full_name),
+            "geo_name": str(result.geo_name),
+            "title": str(result.title),
+            "population": int(result.population),
+            "bounds": result.geometry.to_crs(4326).total_bounds.tolist(),
+        }, True
+
+    async def _customers_endpoint(
+        self, payload: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], bool]:
+        """The generated customers of an area and seed."""
+
+        seed = payload.get("seed")
+        customers = await self.get_customers(payload["area"], seed)
+
+        locations = customers.customers.to_crs(4326).get_coordinates().to_numpy()
+
+        return {
+            "count": len(locations),
+            "locations": np.round(locations, 6).tolist(),
+        }, seed is not None
+
+    async def _matrix(self, payload: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """The travel-time matrix between sources and targets."""
+
+        sources = np.asarray(payload["sources"], dtype=float).reshape(-1, 2)
+        targets = payload.get("targets")
+        if targets is not None:
+            targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+
+        result = await self._run(
+            lambda: self.backend.matrix(
+                sources, targets, costing=payload.get("costing", "auto")
+            )
+        )
+
+        return {
+            "durations": _to_list(result.durations),
+            "distances": _to_list(result.distances),
+        }, True
+
+    async def _assignment(self, payload: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """The nearest pharmacy of every customer of an area and seed or of given locations."""
+
+        if "locations" in payload:
+            locations = np.asarray(payload["locations"], dtype=float).reshape(-1, 2)
+
+            def compute() -> Tuple[np.ndarray, np.ndarray]:
+                coordinates = spatial.project(locations[:, 0], locations[:, 1])
+                return assignment.assign_nearest(
+                    coordinates, src.Pharmacies.get_index()
+                )
+
+            pharmacy_ids, distances = await self._run(compute)
+            cacheable = True
+
+        else:
+            seed = payload.get("seed")
+            customers = await self.get_customers(payload["area"], seed)
+
+            result = await self._run(
+                lambda: assignment.PharmacyAssignment(
+                    customers, capacity=payload.get("capacity")
+                )
+            )
+            pharmacy_ids, distances = result.pharmacy_ids, result.distances
+            cacheable = seed is not None
+
+        counts = np.bincount(pharmacy_ids)
+        pharmacies = np.flatnonzero(counts)
+
+        return {
+            "pharmacy_ids": pharmacy_ids.tolist(),
+            "distances": np.round(distances, 1).tolist(),
+            "counts": dict(zip(pharmacies.tolist(), counts[pharmacies].tolist())),
+        }, cacheable
+
+
+def _to_list(values: np.ndarray) -> list:
+    """Convert an array to nested lists with None for NaN (unreachable)."""
+
+    values = np.asarray(values, dtype=float)
+
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def _dumps(payload: Dict[str, Any]) -> bytes:
+    """Serialize a response payload."""
+
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    """An HTTPConnection over a Unix socket."""
+
+    def __init__(self, unix_path: str, timeout: float) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = unix_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class ServiceClient:
+    """A minimal client of the ModelService, keeping one connection open.
+
+    Attributes:
+        timeout (float): The timeout of every request in seconds.
+
+    Methods:
+        request:    Send a request to an endpoint and return the decoded response.
+        close:      Close the connection.
+    """
+
+    __slots__ = ["timeout", "_connection"]
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = DEFAULT_PORT,
+        unix_path: str | None = None,
+        timeout: float = 600.0,
+    ) -> None:
+        """Initialize a ServiceClient.
+
+        Parameters:
+            host (str): The host of the service. Only used without unix_path.
+            port (int): The TCP port of the service. Only used without unix_path.
+            unix_path (str | None): The path of the Unix socket of the service.
+            timeout (float): The timeout of every request in seconds.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        self.timeout = timeout
+
+        if unix_path is not None:
+            self._connection = _UnixConnection(unix_path, timeout)
+        else:
+            self._connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, endpoint: str, payload: Dict[str, Any] | None = None) -> Any:
+        """Send a request to an endpoint and return the decoded response.
+
+        Parameters:
+            endpoint (str): The endpoint, e.g. "customers" or "/customers".
+            payload (Dict[str, Any] | None): The request; None sends a GET request.
+
+        Returns:
+            response (Any): The decoded JSON response.
+
+        Raises:
+            RuntimeError: If the service answers with an error.
+        """
+
+        endpoint = "/" + endpoint.lstrip("/")
+
+        if payload is None:
+            self._connection.request("GET", endpoint)
+        else:
+            self._connection.request(
+                "POST",
+                endpoint,
+                body=json.dumps(payload),
+                headers={"Content-Type": "application/json"},
+            )
+
+        response = self._connection.getresponse()
+        data = json.loads(response.read())
+
+        if response.status != HTTPStatus.OK:
+            raise RuntimeError(f"{response.status}: {data.get('error')}")
+
+        return data
+
+    def close(self) -> None:
+        """Close the connection."""
+
+        self._connection.close()
+
+
+def main(argv: list | None = None) -> None:
+    """Run the ModelService from the command line.
+
+    Examples:
+        python -m pharmalink.code.service --port 8765 --warm 09162
+        python -m pharmalink.code.service --backend valhalla --pool-size 8 --unix /tmp/pharmalink.sock
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pharmalink.code.service",
+        description="Run a local model service with warm caches.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host to bind to.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port.")
+    parser.add_argument("--unix", help="Unix socket path instead of a TCP port.")
+    parser.add_argument("--backend", default="haversine", help="Routing backend.")
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=0,
+        help="Routing actors of the valhalla backend (0 = one actor in the service process).",
+    )
+    parser.add_argument(
+        "--travel-time-cache",
+        action="store_true",
+        help="Use the disk-backed travel-time cache of the valhalla backend.",
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=32, help="Entries kept per cache."
+    )
+    parser.add_argument(
+        "--warm", nargs="*", default=[], help="Areas loaded on startup."
+    )
+    args = parser.parse_args(argv)
+
+    if args.backend == "valhalla":
+        backend = backends.ValhallaBackend(
+            router=actor_pool.ActorPool(args.pool_size) if args.pool_size else None,
+            cache=cache.TravelTimeCache() if args.travel_time_cache else None,
+        )
+    else:
+        backend = backends.create_backend(args.backend)
+
+    service = ModelService(backend, cache_size=args.cache_size)
+
+    start = time.perf_counter()
+    service.warm_up(tuple(args.warm))
+    print(f"Warmed up in {time.perf_counter() - start:.1f} s.")
+
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Module for snapping and deduplicating customer locations before routing.
+
+Thousands of generated customers end up in the same 100 m census cell or on the same street segment,
+so routing every single one of them separately wastes most of the work. Customer locations are therefore
+snapped to routing nodes first, either on a regular metric grid or onto the road edges found by Valhalla's
+locate service. Routing is then only computed for the unique nodes and expanded back to the customers by index.
+
+Classes:
+    SnappedLocations: Unique routing nodes and the mapping of the original locations onto them.
+
+Functions:
+    snap_to_grid:       Snap locations to the cells of a regular metric grid.
+    snap_to_roads:      Snap locations onto the road edges found by Valhalla's locate service.
+    snap_customers:     Snap the locations of a collection of customers.
+"""
+
+from __future__ import annotations
+from typing import Any
+from dataclasses import dataclass
+import json
+import numpy as np
+import pharmalink.code.customers as cust
+import pharmalink.code.matrix as matrix
+import pharmalink.code.spatial as spatial
+
+
+@dataclass
+class SnappedLocations:
+    """Unique routing nodes and the mapping of the original locations onto them.
+
+    Attributes:
+        nodes (np.ndarray): The (longitude, latitude) pairs of the unique nodes, shape (k, 2).
+        inverse (np.ndarray): The node id of every original location, shape (n,).
+    """
+
+    nodes: np.ndarray
+    inverse: np.ndarray
+
+    def __len__(self) -> int:
+        """Return the number of unique nodes."""
+
+        return len(self.nodes)
+
+    @property
+    def compression(self) -> float:
+        """The ratio of original locations to unique nodes."""
+
+        return len(self.inverse) / max(len(self.nodes), 1)
+
+    def expand(self, values: np.ndarray, axis: int = 0) -> np.ndarray:
+        """Expand per-node values back to the original locations.
+
+        Parameters:
+            values (np.ndarray): Values per node along the given axis.
+            axis (int): The axis holding the nodes.
+
+        Returns:
+            values (np.ndarray): The values per original location along the given axis.
+
+        Raises:
+            None
+        """
+
+        return np.take(values, self.inverse, axis=axis)
+
+    def expand_matrix(
+        self, result: matrix.MatrixResult, targets: SnappedLocations | None = None
+    ) -> matrix.MatrixResult:
+        """Expand a matrix between snapped nodes back to the original locations.
+
+        Parameters:
+            result (matrix.MatrixResult): The matrix with the snapped nodes as sources.
+            targets (SnappedLocations | None): The snapped targets, if the targets were snapped as well.
+
+        Returns:
+            result (matrix.MatrixResult): The matrix with the original locations as sources (and targets).
+
+        Raises:
+            None
+        """
+
+        durations = self.expand(result.durations, axis=0)
+        distances = self.expand(result.distances, axis=0)
+
+        if targets is not None:
+            durations = targets.expand(durations, axis=1)
+            distances = targets.expand(distances, axis=1)
+
+        return matrix.MatrixResult(durations=durations, distances=distances)
+
+
+def snap_to_grid(coordinates: np.ndarray, cell_size: float = 100) -> SnappedLocations:
+    """Snap locations to the cells of a regular metric grid.
+
+    Every cell is represented by the first location that falls into it, so nodes are always real
+    customer locations and never end up in a lake or on a building's roof in the cell centre.
+
+    Parameters:
+        coordinates (np.ndarray): (longitude, latitude) pairs, shape (n, 2).
+        cell_size (float): The edge length of the grid cells in metres.
+
+    Returns:
+        snapped (SnappedLocations): The unique nodes and the node id of every location.
+
+    Raises:
+        None
+    """
+
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+
+    projected = spatial.project(coordinates[:, 0], coordinates[:, 1])
+    cells = np.floor(projected / cell_size).astype(np.int64)
+
+    _, first, inverse = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+
+    return SnappedLocations(nodes=coordinates[first], inverse=inverse.ravel())
+
+
+def snap_to_roads(
+    router: Any,
+    coordinates: np.ndarray,
+    costing: str = "auto",
+    tolerance: float = 25,
+    batch_size: int = 1000,
+) -> SnappedLocations:
+    """Snap locations onto the road edges found by Valhalla's locate service.
+
+    Locations are moved to their correlated position on the nearest edge. Locations on the same road
+    (OSM way) within the tolerance of each other share a node. Locations which cannot be located on the graph
+    keep their own position and are snapped to a grid with the tolerance as cell size.
+
+    Parameters:
+        router (Any): A routing actor with a locate method, e.g. from routing.create_routing_actor.
+        coordinates (np.ndarray): (longitude, latitude) pairs, shape (n, 2).
+        costing (str): The costing model used to select routable edges.
+        tolerance (float): The distance in metres within which locations on the same road are merged.
+        batch_size (int): The number of locations sent per locate request.
+
+    Returns:
+        snapped (SnappedLocations): The unique nodes and the node id of every location.
+
+    Raises:
+        None
+    """
+
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+
+    correlated = coordinates.copy()
+    way_ids = np.full(len(coordinates), -1, dtype=np.int64)
+
+    for start in range(0, len(coordinates), batch_size):
+        batch = coordinates[start : start + batch_size]
+        request = {
+            "locations": matrix.to_locations(batch),
+            "costing": costing,
+            "verbose": False,
+        }
+        response = router.locate(json.dumps(request))
+
+        if isinstance(response, (str, bytes)):
+            response = json.loads(response)
+
+        for offset, location in enumerate(response):
+            edges = location.get("edges") or []
+
+            if not edges:
+                continue
+
+            edge = edges[0]
+            correlated[start + offset] = (
+                edge["correlated_lon"],
+                edge["correlated_lat"],
+            )
+            way_ids[start + offset] = edge.get("way_id", -1)
+
+    # Merge locations on the same way within the same tolerance cell
+    projected = spatial.project(correlated[:, 0], correlated[:, 1])
+    cells = np.floor(projected / tolerance).astype(np.int64)
+    keys = np.column_stack([way_ids, cells])
+
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+    return SnappedLocations(nodes=correlated[first], inverse=inverse.ravel())
+
+
+def snap_customers(
+    customers: cust.Customers, cell_size: float = 100, router: Any = None
+) -> SnappedLocations:
+    """Snap the locations of a collection of customers.
+
+    Parameters:
+        customers (cust.Customers): The customers to snap.
+        cell_size (float): The grid cell size, or the merge tolerance when snapping to roads, in metres.
+        router (Any): An optional routing actor. If given, customers are snapped onto road edges.
+
+    Returns:
+        snapped (SnappedLocations): The unique nodes and the node id of every customer.
+
+    Raises:
+        TypeError: If customers is not an instance of cust.Customers.
+    """
+
+    # check if Customers are valid
+    if not isinstance(customers, cust.Customers):
+        raise TypeError("customers must be an instance of customers.Customers.")
+
+    locations = customers.customers.to_crs(epsg=4326)
+    coordinates = np.column_stack([locations.geometry.x, locations.geometry.y])
+
+    if router is None:
+        return snap_to_grid(coordinates, cell_size)
+
+    return snap_to_roads(router, coordinates, tolerance=cell_size)
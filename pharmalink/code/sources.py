@@ -7,13 +7,18 @@ This module exists to abstract the data source handling from the main codebase.
 from __future__ import annotations
 from typing import List
 from dataclasses import dataclass
+from functools import lru_cache
+from collections import OrderedDict
 import pharmalink.code.area as area
+import pharmalink.code.spatial as spatial
 import importlib.resources as res
 import lzma
+import threading
 import warnings
 import pyogrio as pgr
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 from shapely.geometry import Point
 import json
 
@@ -64,6 +69,7 @@ class AdminAreas:
         get_area_names: Get a DataFrame containing the names of all German administrative areas.
         get_areas:      Get information about all German administrative areas.
         get_area:       Get information about a German administrative area.
+        get_kreis_regkeys: Get the regkeys of all Kreise within a German administrative area.
     """
 
     # compressed admin_areas GeoPackage in the sources subfolder
@@ -208,6 +214,49 @@ class AdminAreas:
 
         return area
 
+    @classmethod
+    def get_kreis_regkeys(cls, regkey: str = "000000000000") -> list:
+        """Get the regkeys of all Kreise (and kreisfreie Städte) within a German administrative area.
+
+        Data source is an aggregated list of all German administrative areas.
+        For more information, see: sources/admin_areas.
+
+        Parameters:
+            regkey (str): The regkey of the enclosing area. Defaults to the whole country.
+
+        Returns:
+            regkeys (list): A sorted list of the 12-digit regkeys of all Kreise within the area.
+
+        Raises:
+            None
+        """
+
+        # Filter RuntimeWarnings from pyogrio. The GDAL driver for GeoPackage expects a .gpkg filename,
+        # but the virtual file it receives from lzma cannot comply with the file standard in this regard.
+        warnings.filterwarnings("ignore", category=RuntimeWarning, module="pyogrio")
+
+        # Decompress with lzma, then access with pyogrio.
+        # Output will be a simple DataFrame because no Geometries are read
+        with lzma.open(cls.path, "rb") as archive:
+            areas = pgr.read_dataframe(
+                archive,
+                layer="admin_areas",
+                columns=["regkey", "level"],
+                read_geometry=False,
+            )
+
+        # The leading non-zero part of the regkey identifies the enclosing area
+        # (2 digits for a Bundesland, 5 digits for a Kreis, nothing for the whole country)
+        prefix = regkey[:5] if regkey[2:5] != "000" else regkey[:2]
+        if prefix == "00":
+            prefix = ""
+
+        kreise = areas[
+            (areas["level"] == "kreis") & areas["regkey"].str.startswith(prefix)
+        ]
+
+        return sorted(kreise["regkey"].unique().tolist())
+
 
 class GeometryHandler:
     """Abstract Class for handling the project's geometry data."""
@@ -215,6 +264,12 @@ class GeometryHandler:
     # Source of the geometry data
     path = res.files(__package__).joinpath("sources")
 
+    # The most recently filtered geometries per (class, regkey), shared by all subclasses.
+    # Areas that are used repeatedly (e.g. several seeds) are not decompressed again.
+    _cache = OrderedDict()
+    _cache_size = 4
+    _cache_lock = threading.Lock()
+
     @classmethod
     def get_within_area(cls, filter_area: area.Area) -> gpd.GeoDataFrame:
         """Get all geometries within the given bounds.
@@ -227,6 +282,27 @@ class GeometryHandler:
         if not isinstance(filter_area, area.Area):
             raise TypeError("filter_area must be an instance of area.Area")
 
+        key = (cls.__name__, filter_area.regkey)
+
+        with cls._cache_lock:
+            if key in cls._cache:
+                cls._cache.move_to_end(key)
+                return cls._cache[key].copy()
+
+        geometries = cls._read_within_area(filter_area)
+
+        with cls._cache_lock:
+            cls._cache[key] = geometries
+            while len(cls._cache) > cls._cache_size:
+                cls._cache.popitem(last=False)
+
+        # Callers may modify the returned geometries, the cached ones stay untouched
+        return geometries.copy()
+
+    @classmethod
+    def _read_within_area(cls, filter_area: area.Area) -> gpd.GeoDataFrame:
+        """Read all geometries within the given area from the compressed source files."""
+
         # Filter RuntimeWarnings from pyogrio. The GDAL driver for GeoPackage expects a .gpkg filename,
         # but the virtual file it receives from lzma cannot comply with the file standard in this regard.
         warnings.filterwarnings("ignore", category=RuntimeWarning, module="pyogrio")
@@ -304,35 +380,119 @@ class PopulationGrids(GeometryHandler):
 
 
 class Pharmacies:
+    """Class for handling data about German pharmacies.
+
+    All pharmacies are decompressed only once per process and kept in a spatial index
+    in the metric CRS, which serves area, nearest-neighbour and radius queries.
+
+    Methods:
+        get_index:          Get the loaded-once spatial index over all pharmacies.
+        get_within_area:    Get all pharmacies within the given area.
+        get_within_areas:   Get all pharmacies within each of the given areas.
+        get_all_pharmacies: Get all pharmacies.
+    """
 
     path = res.files(__package__).joinpath("sources", "pharmacies.gpkg.xz")
 
+    # Spatial index over all pharmacies, populated on first use by get_index
+    _index = None
+
+    @classmethod
+    def get_index(cls) -> spatial.PointIndex:
+        """Get the loaded-once spatial index over all pharmacies.
+
+        The point ids of the index are the row positions in get_all_pharmacies.
+
+        Parameters:
+            None
+
+        Returns:
+            index (spatial.PointIndex): The spatial index over all pharmacies.
+
+        Raises:
+            None
+        """
+
+        if cls._index is None:
+            cls._index = spatial.PointIndex(cls.get_all_pharmacies())
+
+        return cls._index
+
     @classmethod
     def get_within_area(cls, filter_area: area.Area) -> gpd.GeoDataFrame:
-        """Get all pharmacies within the given bounds."""
+        """Get all pharmacies within the given bounds.
+
+        Parameters:
+            filter_area (area.Area): The Area to filter the pharmacies by.
+
+        Returns:
+            pharmacies (gpd.GeoDataFrame): The pharmacies within the area, indexed by their point id.
+
+        Raises:
+            TypeError: If filter_area is not an instance of area.Area.
+        """
 
         # Check if area is valid
         if not isinstance(filter_area, area.Area):
             raise TypeError("filter_area must be an instance of area.Area")
 
-        # Filter RuntimeWarnings from pyogrio. The GDAL driver for GeoPackage expects a .gpkg filename,
-        # but the virtual file it receives from lzma cannot comply with the file standard in this regard.
-        warnings.filterwarnings("ignore", category=RuntimeWarning, module="pyogrio")
+        return cls.get_within_areas([filter_area])[filter_area.regkey]
+
+    @classmethod
+    def get_within_areas(cls, filter_areas: List[area.Area]) -> dict:
+        """Get all pharmacies within each of the given areas with a single bulk query.
 
-        mask = filter_area.geometry
+        Parameters:
+            filter_areas (List[area.Area]): The Areas to filter the pharmacies by.
 
-        # Decompress with lzma, then access with geopandas.
-        # Output is a GeoDataFrame
-        with lzma.open(cls.path, "rb") as archive:
-            pharmacies = gpd.read_file(archive, mask=mask)
+        Returns:
+            pharmacies (dict): A dict mapping each area's regkey to a GeoDataFrame of its pharmacies.
 
-        pharmacies.rename(columns={"geometry": "location"}, inplace=True)
-        pharmacies.set_geometry("location", inplace=True)
+        Raises:
+            TypeError: If any element of filter_areas is not an instance of area.Area.
+        """
+
+        # Check if all areas are valid
+        if not all(isinstance(a, area.Area) for a in filter_areas):
+            raise TypeError("filter_areas must only contain instances of area.Area")
+
+        index = cls.get_index()
+
+        # Collect the underlying shapely geometries of all areas in the metric CRS
+        geometries = gpd.GeoSeries(
+            [
+                a.geometry.to_crs(epsg=spatial.PROJECTED_CRS).geometry.iloc[0]
+                for a in filter_areas
+            ],
+            crs=spatial.PROJECTED_CRS,
+        )
+
+        area_ids, point_ids = index.within_areas(geometries)
+
+        pharmacies = {}
+        for position, filter_area in enumerate(filter_areas):
+            matches = np.sort(point_ids[area_ids == position])
+            pharmacies[filter_area.regkey] = index.data.iloc[matches]
 
         return pharmacies
 
     @classmethod
     def get_all_pharmacies(cls) -> gpd.GeoDataFrame:
+        """Get all pharmacies.
+
+        Parameters:
+            None
+
+        Returns:
+            pharmacies (gpd.GeoDataFrame): A GeoDataFrame containing all pharmacies.
+
+        Raises:
+            None
+        """
+
+        # Reuse the already decompressed data if the index has been built
+        if cls._index is not None:
+            return cls._index.data.copy()
 
         # Filter RuntimeWarnings from pyogrio. The GDAL driver for GeoPackage expects a .gpkg filename,
         # but the virtual file it receives from lzma cannot comply with the file standard in this regard.
@@ -353,6 +513,30 @@ class DistributionCenters:
 
     path = res.files(__package__).joinpath("sources", "distribution_centers.gpkg.xz")
 
+    # Spatial index over all distribution centers, populated on first use by get_index
+    _index = None
+
+    @classmethod
+    def get_index(cls) -> spatial.PointIndex:
+        """Get the loaded-once spatial index over all distribution centers.
+
+        The point ids of the index are the row positions in get_all_dist_centers.
+
+        Parameters:
+            None
+
+        Returns:
+            index (spatial.PointIndex): The spatial index over all distribution centers.
+
+        Raises:
+            None
+        """
+
+        if cls._index is None:
+            cls._index = spatial.PointIndex(cls.get_all_dist_centers())
+
+        return cls._index
+
     @classmethod
     def get_closest_dist_centers(
         cls, area: area.Area, num_centers: int = 3
@@ -408,6 +592,10 @@ class DistributionCenters:
     @classmethod
     def get_all_dist_centers(cls) -> gpd.GeoDataFrame:
 
+        # Reuse the already decompressed data if the index has been built
+        if cls._index is not None:
+            return cls._index.data.copy()
+
         # Filter RuntimeWarnings from pyogrio. The GDAL driver for GeoPackage expects a .gpkg filename,
         # but the virtual file it receives from lzma cannot comply with the file standard in this regard.
         warnings.filterwarnings("ignore", category=RuntimeWarning, module="pyogrio")
@@ -423,18 +611,14 @@ class DistributionCenters:
         return distribution_centers
 
 
-def evaluate_mode_of_transport(distance: int, choices: List[str]) -> str:
-    """Return a suitable mode of transportation for a given distance.
-
-    Returns either "auto", "bicycle" or "pedestrian" with probabilities
-    based on the given distance.
+@lru_cache(maxsize=1)
+def load_transport_modes() -> pd.DataFrame:
+    """Load the usage probabilities of the modes of transportation by trip length.
 
-    Args:
-        distance (float): The distance.
-        choices (List[str]): The modes of transportation to choose from.
+    The table is read only once per process and must not be modified.
 
     Returns:
-        str: The mode of transportation.
+        pd.DataFrame: The probabilities per mode (columns) and trip length interval in km (index).
     """
 
     # Source is a json file with interval breaks and cell values describing
@@ -448,7 +632,24 @@ def evaluate_mode_of_transport(distance: int, choices: List[str]) -> str:
         json_table["breaks"], closed="left", name="distance"
     )
 
-    mot_table = pd.DataFrame(json_table["data"], index=index)
+    return pd.DataFrame(json_table["data"], index=index)
+
+
+def evaluate_mode_of_transport(distance: int, choices: List[str]) -> str:
+    """Return a suitable mode of transportation for a given distance.
+
+    Returns either "auto", "bicycle" or "pedestrian" with probabilities
+    based on the given distance.
+
+    Args:
+        distance (float): The distance.
+        choices (List[str]): The modes of transportation to choose from.
+
+    Returns:
+        str: The mode of transportation.
+    """
+
+    mot_table = load_transport_modes()
 
     # Find the row with the interval that contains the given distance
     row = mot_table.loc[distance]
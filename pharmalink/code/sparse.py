@@ -0,0 +1,468 @@
+"""Module for sparse travel-time matrices of large routing instances.
+
+A dense float64 duration matrix for a Kreis with 30k daily customers needs about 7 GB, although almost all
+of its entries are irrelevant for assignment and vehicle routing. The SparseMatrix keeps only the K nearest
+neighbours of every node plus all pairs involving a depot, in compressed sparse row (CSR) layout.
+
+Durations are stored as uint16 seconds (saturating at about 18 hours) or float32, distances as float32 kilometres.
+Matrices can be stored as a directory of .npy files and memory-mapped on load, so worker processes share
+the same pages instead of copying the matrix.
+
+Classes:
+    SparseMatrix: A travel-time matrix in compressed sparse row layout.
+"""
+
+from __future__ import annotations
+from typing import Any, Tuple
+import json
+import pathlib as path
+import numpy as np
+import pharmalink.code.matrix as matrix
+
+# Largest duration representable as uint16 seconds, used for saturation and as "unknown" marker
+UINT16_MAX = np.iinfo(np.uint16).max
+
+
+class SparseMatrix:
+    """A travel-time matrix in compressed sparse row layout.
+
+    The targets of row i are indices[indptr[i]:indptr[i + 1]] (sorted ascending),
+    with durations and distances at the same positions. Pairs that are not stored are unknown.
+
+    Attributes:
+        shape (Tuple[int, int]): The number of rows and columns.
+        indptr (np.ndarray): Row offsets into indices, shape (rows + 1,).
+        indices (np.ndarray): Column ids of the stored pairs.
+        durations (np.ndarray): Travel times in seconds (uint16 or float32) of the stored pairs.
+        distances (np.ndarray): Travel distances in kilometres (float32) of the stored pairs.
+
+    Methods:
+        from_dense:         Sparsify a dense matrix to the K nearest neighbours plus depots.
+        from_candidates:    Build a matrix by exactly routing candidate pairs.
+        row:                Get the stored columns and durations of a row.
+        get:                Look up durations for arbitrary pairs.
+        row_min:            Get the column with the shortest duration of every row.
+        to_dense:           Expand to a dense duration matrix.
+        save:               Store the matrix as a directory of .npy files.
+        load:               Load a matrix from a directory, optionally memory-mapped.
+    """
+
+    __slots__ = ["shape", "indptr", "indices", "durations", "distances"]
+
+    def __init__(
+        self,
+        shape: Tuple[int, int],
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        durations: np.ndarray,
+        distances: np.ndarray,
+    ) -> None:
+        """Initialize a SparseMatrix from its CSR arrays.
+
+        Parameters:
+            shape (Tuple[int, int]): The number of rows and columns.
+            indptr (np.ndarray): Row offsets into indices.
+            indices (np.ndarray): Column ids of the stored pairs, sorted within every row.
+            durations (np.ndarray): Travel times in seconds of the stored pairs.
+            distances (np.ndarray): Travel distances in kilometres of the stored pairs.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: If the arrays do not fit together.
+        """
+
+        if len(indptr) != shape[0] + 1 or not (
+            len(indices) == len(durations) == len(distances) == indptr[-1]
+        ):
+            raise ValueError("CSR arrays do not match the matrix shape.")
+
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.indptr = indptr
+        self.indices = indices
+        self.durations = durations
+        self.distances = distances
+
+    def __repr__(self) -> str:
+        """Return all information about the SparseMatrix object."""
+
+        return (
+            f"SparseMatrix (Shape: {self.shape}, Stored pairs: {self.nnz}, "
+            f"Durations: {self.durations.dtype})"
+        )
+
+    def __len__(self) -> int:
+        """Return the number of rows."""
+
+        return self.shape[0]
+
+    @property
+    def nnz(self) -> int:
+        """The number of stored pairs."""
+
+        return int(self.indptr[-1])
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the CSR arrays in bytes."""
+
+        return sum(
+            a.nbytes
+            for a in (self.indptr, self.indices, self.durations, self.distances)
+        )
+
+    @staticmethod
+    def _encode_durations(durations: np.ndarray, dtype: Any) -> np.ndarray:
+        """Convert float seconds to the storage dtype. Unknown (NaN) and too long durations saturate."""
+
+        if np.dtype(dtype) == np.uint16:
+            seconds = np.nan_to_num(np.rint(durations), nan=UINT16_MAX)
+            return np.minimum(seconds, UINT16_MAX).astype(np.uint16)
+
+        return durations.astype(dtype)
+
+    @classmethod
+    def _from_rows(
+        cls,
+        shape: Tuple[int, int],
+        rows: np.ndarray,
+        cols: np.ndarray,
+        durations: np.ndarray,
+        distances: np.ndarray,
+        dtype: Any,
+    ) -> SparseMatrix:
+        """Build a SparseMatrix from unordered (row, col) pairs, dropping duplicates."""
+
+        order = np.lexsort((cols, rows))
+        rows, cols = rows[order], cols[order]
+
+        # Drop duplicate pairs, e.g. a depot that is also one of the nearest neighbours
+        keep = np.r_[True, (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])]
+        order, rows, cols = order[keep], rows[keep], cols[keep]
+
+        indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=shape[0]), out=indptr[1:])
+
+        return cls(
+            shape,
+            indptr,
+            cols.astype(np.int32),
+            cls._encode_durations(durations[order], dtype),
+            distances[order].astype(np.float32),
+        )
+
+    @classmethod
+    def from_dense(
+        cls,
+        result: matrix.MatrixResult,
+        k: int = 20,
+        depots: np.ndarray | list = (),
+        dtype: Any = np.uint16,
+    ) -> SparseMatrix:
+        """Sparsify a dense matrix to the K nearest neighbours of every row plus depots.
+
+        Parameters:
+            result (matrix.MatrixResult): The dense matrix.
+            k (int): The number of nearest (by duration) columns kept per row.
+            depots (np.ndarray | list): Node ids of depots. Their full rows and columns are kept.
+            dtype (Any): The storage dtype of the durations, np.uint16 or np.float32.
+
+        Returns:
+            sparse (SparseMatrix): The sparse matrix.
+
+        Raises:
+            None
+        """
+
+        num_rows, num_cols = result.durations.shape
+        k = min(k, num_cols)
+        depots = np.asarray(depots, dtype=np.int64)
+
+        # Unreachable pairs sort last
+        durations = np.where(result.reachable, result.durations, np.inf)
+        nearest = np.argpartition(durations, k - 1, axis=1)[:, :k]
+
+        rows = [np.repeat(np.arange(num_rows), k)]
+        cols = [nearest.ravel()]
+
+        # All pairs from and to the depots
+        if len(depots):
+            rows += [
+                np.repeat(depots, num_cols),
+                np.tile(np.arange(num_rows), len(depots)),
+            ]
+            cols += [
+                np.tile(np.arange(num_cols), len(depots)),
+                np.repeat(depots, num_rows),
+            ]
+
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+        return cls._from_rows(
+            (num_rows, num_cols),
+            rows,
+            cols,
+            result.durations[rows, cols],
+            result.distances[rows, cols],
+            dtype,
+        )
+
+    @classmethod
+    def from_candidates(
+        cls,
+        backend: Any,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        candidates: np.ndarray,
+        costing: str = "auto",
+        dtype: Any = np.uint16,
+        max_pairs: int = matrix.MAX_LOCATION_PAIRS,
+    ) -> SparseMatrix:
+        """Build a matrix by exactly routing only candidate pairs.
+
+        Candidates typically come from estimator.DetourModel.prune. Nearby sources share most of their
+        candidates, so sources are ordered along a coarse grid and grouped into blocks whose rows times the
+        union of their candidate targets stay within max_pairs. Every block is routed as one matrix request,
+        then the candidate pairs of each row are gathered from it.
+
+        Parameters:
+            backend (Any): A backends.RoutingBackend.
+            sources (np.ndarray): Source (longitude, latitude) pairs, shape (n, 2).
+            targets (np.ndarray): Target (longitude, latitude) pairs, shape (m, 2).
+            candidates (np.ndarray): Target ids per source, shape (n, k).
+            costing (str): The costing model.
+            dtype (Any): The storage dtype of the durations, np.uint16 or np.float32.
+            max_pairs (int): The maximum number of location pairs per block.
+
+        Returns:
+            sparse (SparseMatrix): The sparse matrix with the candidate pairs.
+
+        Raises:
+            None
+        """
+
+        sources = np.asarray(sources, dtype=float).reshape(-1, 2)
+        targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+        candidates = np.asarray(candidates, dtype=np.int64)
+        num_rows, k = candidates.shape
+
+        durations = np.empty((num_rows, k), dtype=np.float32)
+        distances = np.empty((num_rows, k), dtype=np.float32)
+
+        # Order sources by grid cells of about 2 km, so consecutive rows share candidate targets
+        cells = np.floor(sources / 0.02).astype(np.int64)
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+
+        def route_block(rows: np.ndarray, columns: np.ndarray) -> None:
+            """Route a block of rows against the union of their candidates and gather the candidate pairs."""
+
+            routed = backend.matrix(sources[rows], targets[columns], costing)
+            positions = np.searchsorted(columns, candidates[rows])
+            local = np.arange(len(rows))[:, None]
+
+            durations[rows] = routed.durations[local, positions]
+            distances[rows] = routed.distances[local, positions]
+
+        start, columns = 0, np.empty(0, dtype=np.int64)
+
+        for position, row in enumerate(order.tolist()):
+            union = np.union1d(columns, candidates[row])
+
+            # Close the block if the next row would exceed the pair limit
+            if position > start and (position - start + 1) * len(union) > max_pairs:
+                route_block(order[start:position], columns)
+                start, union = position, np.unique(candidates[row])
+
+            columns = union
+
+        if num_rows:
+            route_block(order[start:], columns)
+
+        return cls._from_rows(
+            (num_rows, len(targets)),
+            np.repeat(np.arange(num_rows), k),
+            candidates.ravel(),
+            durations.ravel(),
+            distances.ravel(),
+            dtype,
+        )
+
+    def row(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the stored columns and durations of a row.
+
+        Parameters:
+            i (int): The row id.
+
+        Returns:
+            columns (np.ndarray): The stored column ids, sorted ascending.
+            durations (np.ndarray): The durations in seconds of the stored columns.
+
+        Raises:
+            None
+        """
+
+        start, stop = self.indptr[i], self.indptr[i + 1]
+
+        return self.indices[start:stop], self.durations[start:stop]
+
+    def get(
+        self, rows: np.ndarray, cols: np.ndarray, default: float = np.inf
+    ) -> np.ndarray:
+        """Look up durations for arbitrary pairs.
+
+        Parameters:
+            rows (np.ndarray): The row ids.
+            cols (np.ndarray): The column ids, broadcast against rows.
+            default (float): The value for pairs that are not stored or unreachable.
+
+        Returns:
+            durations (np.ndarray): The durations in seconds as float64.
+
+        Raises:
+            None
+        """
+
+        rows, cols = np.broadcast_arrays(np.asarray(rows), np.asarray(cols))
+        shape = rows.shape
+        rows, cols = rows.ravel(), cols.ravel()
+
+        values = np.full(len(rows), default, dtype=float)
+
+        if self.nnz == 0:
+            return values.reshape(shape)
+
+        # Binary search of the column within each row's sorted slice
+        starts, stops = self.indptr[rows], self.indptr[rows + 1]
+        positions = starts.copy()
+        lengths = stops - starts
+        while np.any(lengths > 0):
+            half = lengths // 2
+            middle = positions + half
+            go_right = (lengths > 0) & (
+                self.indices[np.minimum(middle, len(self.indices) - 1)] < cols
+            )
+            positions = np.where(go_right, middle + 1, positions)
+            lengths = np.where(go_right, lengths - half - 1, half)
+
+        found = positions < stops
+        found[found] = self.indices[positions[found]] == cols[found]
+
+        durations = self.durations[positions[found]].astype(float)
+        if self.durations.dtype == np.uint16:
+            durations[durations == UINT16_MAX] = default
+        else:
+            durations[np.isnan(durations)] = default
+
+        values[found] = durations
+
+        return values.reshape(shape)
+
+    def row_min(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the column with the shortest stored duration of every row.
+
+        Parameters:
+            None
+
+        Returns:
+            columns (np.ndarray): The column id per row, -1 for rows without reachable pairs.
+            durations (np.ndarray): The shortest duration in seconds per row, inf for rows without reachable pairs.
+
+        Raises:
+            None
+        """
+
+        durations = self.durations.astype(float)
+        if self.durations.dtype == np.uint16:
+            durations[durations == UINT16_MAX] = np.inf
+        else:
+            durations[np.isnan(durations)] = np.inf
+
+        columns = np.full(self.shape[0], -1, dtype=np.int64)
+        minima = np.full(self.shape[0], np.inf)
+
+        if self.nnz == 0:
+            return columns, minima
+
+        # Sort by row, then duration, so the first entry of each row is its minimum
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        order = np.lexsort((durations, rows))
+        first = np.r_[True, rows[order][1:] != rows[order][:-1]]
+        winners = order[first]
+
+        reachable = np.isfinite(durations[winners])
+        winners = winners[reachable]
+
+        columns[rows[winners]] = self.indices[winners]
+        minima[rows[winners]] = durations[winners]
+
+        return columns, minima
+
+    def to_dense(self, default: float = np.inf) -> np.ndarray:
+        """Expand to a dense float32 duration matrix.
+
+        Parameters:
+            default (float): The value for pairs that are not stored or unreachable.
+
+        Returns:
+            durations (np.ndarray): The dense duration matrix.
+
+        Raises:
+            None
+        """
+
+        dense = np.full(self.shape, default, dtype=np.float32)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        dense[rows, self.indices] = self.get(rows, self.indices, default)
+
+        return dense
+
+    def save(self, directory: path.Path | str) -> None:
+        """Store the matrix as a directory of .npy files.
+
+        Parameters:
+            directory (path.Path | str): The target directory, created if missing.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+
+        directory = path.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        for name in ("indptr", "indices", "durations", "distances"):
+            np.save(directory.joinpath(f"{name}.npy"), getattr(self, name))
+
+        with open(directory.joinpath("shape.json"), "w") as file:
+            json.dump(self.shape, file)
+
+    @classmethod
+    def load(cls, directory: path.Path | str, mmap: bool = True) -> SparseMatrix:
+        """Load a matrix from a directory of .npy files.
+
+        Parameters:
+            directory (path.Path | str): The source directory.
+            mmap (bool): Memory-map the arrays read-only instead of reading them into memory.
+
+        Returns:
+            sparse (SparseMatrix): The loaded matrix.
+
+        Raises:
+            FileNotFoundError: If the directory does not contain a stored matrix.
+        """
+
+        directory = path.Path(directory)
+        mmap_mode = "r" if mmap else None
+
+        with open(directory.joinpath("shape.json"), "r") as file:
+            shape = tuple(json.load(file))
+
+        arrays = {
+            name: np.load(directory.joinpath(f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ("indptr", "indices", "durations", "distances")
+        }
+
+        return cls(shape, **arrays)
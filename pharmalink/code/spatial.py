@@ -0,0 +1,299 @@
+"""Module for fast spatial lookups on the point datasets used in the pharmalink model.
+
+Point sources such as pharmacies or distribution centers are loaded once, projected to a metric CRS
+(ETRS89 / UTM zone 32N, EPSG:25832) and packed into a KD-tree for nearest-neighbour and radius queries
+and into a shapely STRtree for bulk containment queries against administrative areas.
+
+All query methods take raw coordinate arrays of shape (n, 2) in the projected CRS, so millions of
+customer points can be handled without creating a shapely geometry for every single one of them.
+
+Classes:
+    PointIndex: A loaded-once spatial index over a set of points.
+
+Functions:
+    project:         Project longitude/latitude arrays to the metric CRS.
+    get_coordinates: Get projected coordinates for the geometries of a GeoDataFrame or GeoSeries.
+"""
+
+from __future__ import annotations
+from typing import Tuple
+from functools import lru_cache
+import numpy as np
+import geopandas as gpd
+import shapely
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+# Metric CRS used for all distance calculations (ETRS89 / UTM zone 32N)
+PROJECTED_CRS = 25832
+
+# Default number of points handled per query chunk. Keeps memory bounded for millions of points.
+CHUNK_SIZE = 500_000
+
+
+@lru_cache(maxsize=None)
+def _transformer(source_crs: int, target_crs: int) -> Transformer:
+    """Get a cached pyproj Transformer between two EPSG codes."""
+
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def project(
+    x: np.ndarray, y: np.ndarray, crs: int = 4326, inverse: bool = False
+) -> np.ndarray:
+    """Project coordinate arrays to the metric CRS.
+
+    Parameters:
+        x (np.ndarray): The x coordinates (longitudes for EPSG:4326).
+        y (np.ndarray): The y coordinates (latitudes for EPSG:4326).
+        crs (int): The EPSG code of the input coordinates.
+        inverse (bool): Project from the metric CRS to the given crs instead.
+
+    Returns:
+        coordinates (np.ndarray): An array of shape (n, 2) with the projected coordinates.
+
+    Raises:
+        None
+    """
+
+    if inverse:
+        transformer = _transformer(PROJECTED_CRS, crs)
+    else:
+        transformer = _transformer(crs, PROJECTED_CRS)
+
+    x, y = transformer.transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+
+    return np.column_stack([x, y])
+
+
+def get_coordinates(geometries: gpd.GeoDataFrame | gpd.GeoSeries) -> np.ndarray:
+    """Get projected coordinates for point geometries.
+
+    Parameters:
+        geometries (gpd.GeoDataFrame | gpd.GeoSeries): Point geometries with a set CRS.
+
+    Returns:
+        coordinates (np.ndarray): An array of shape (n, 2) in the metric CRS.
+
+    Raises:
+        ValueError: If the geometries have no CRS set.
+    """
+
+    if geometries.crs is None:
+        raise ValueError("Geometries must have a CRS set.")
+
+    geometries = geometries.geometry.to_crs(epsg=PROJECTED_CRS)
+
+    return shapely.get_coordinates(geometries.values)
+
+
+class PointIndex:
+    """A loaded-once spatial index over a set of points.
+
+    Attributes:
+        data (gpd.GeoDataFrame): The indexed points with their original attributes.
+        coordinates (np.ndarray): The projected coordinates of the points, shape (n, 2).
+
+    Methods:
+        nearest:        Find the k nearest points for many query points.
+        within_radius:  Find all points within a radius for many query points.
+        count_within:   Count the points within a radius for many query points.
+        within_areas:   Find all points within many areas at once.
+    """
+
+    __slots__ = ["data", "coordinates", "_kdtree", "_strtree"]
+
+    def __init__(self, data: gpd.GeoDataFrame) -> None:
+        """Initialize a PointIndex.
+
+        Parameters:
+            data (gpd.GeoDataFrame): The points to index. The row order defines the point ids.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: If the data has no CRS set.
+        """
+
+        self.data = data
+        self.coordinates = get_coordinates(data)
+
+        # The compact, unbalanced build is considerably faster and produces a smaller (packed) tree
+        self._kdtree = cKDTree(
+            self.coordinates, leafsize=16, compact_nodes=True, balanced_tree=False
+        )
+
+        # The STRtree only serves containment queries, so it is built lazily
+        self._strtree = None
+
+    def __len__(self) -> int:
+        """Return the number of indexed points."""
+
+        return len(self.coordinates)
+
+    def __repr__(self) -> str:
+        """Return information about the PointIndex object."""
+
+        return f"PointIndex (Points: {len(self)})"
+
+    def nearest(
+        self,
+        points: np.ndarray,
+        k: int = 1,
+        max_distance: float = np.inf,
+        chunk_size: int = CHUNK_SIZE,
+        workers: int = -1,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k nearest indexed points for many query points.
+
+        Parameters:
+            points (np.ndarray): Query coordinates in the metric CRS, shape (n, 2).
+            k (int): The number of neighbours to return per query point.
+            max_distance (float): Only return neighbours within this distance (in metres).
+            chunk_size (int): The number of query points handled at once.
+            workers (int): The number of threads used by the KD-tree (-1 = all cores).
+
+        Returns:
+            distances (np.ndarray): The distances in metres, shape (n, k). Missing neighbours are inf.
+            indices (np.ndarray): The point ids, shape (n, k). Missing neighbours are -1.
+
+        Raises:
+            None
+        """
+
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+        distances = np.empty((len(points), k), dtype=float)
+        indices = np.empty((len(points), k), dtype=np.int64)
+
+        for start in range(0, len(points), chunk_size):
+            stop = start + chunk_size
+            chunk_distances, chunk_indices = self._kdtree.query(
+                points[start:stop],
+                k=k,
+                distance_upper_bound=max_distance,
+                workers=workers,
+            )
+            distances[start:stop] = chunk_distances.reshape(-1, k)
+            indices[start:stop] = chunk_indices.reshape(-1, k)
+
+        # scipy marks missing neighbours with the number of points as index
+        indices[indices == len(self)] = -1
+
+        return distances, indices
+
+    def within_radius(
+        self,
+        points: np.ndarray,
+        radius: float,
+        chunk_size: int = CHUNK_SIZE,
+        workers: int = -1,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find all indexed points within a radius for many query points.
+
+        The result is returned in compressed sparse row layout:
+        the ids of the points around query point i are indices[offsets[i]:offsets[i + 1]].
+
+        Parameters:
+            points (np.ndarray): Query coordinates in the metric CRS, shape (n, 2).
+            radius (float): The search radius in metres.
+            chunk_size (int): The number of query points handled at once.
+            workers (int): The number of threads used by the KD-tree (-1 = all cores).
+
+        Returns:
+            offsets (np.ndarray): Row offsets, shape (n + 1,).
+            indices (np.ndarray): The point ids within the radius, concatenated for all query points.
+
+        Raises:
+            None
+        """
+
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+        counts = np.empty(len(points), dtype=np.int64)
+        chunks = []
+
+        for start in range(0, len(points), chunk_size):
+            stop = start + chunk_size
+            neighbours = self._kdtree.query_ball_point(
+                points[start:stop], r=radius, workers=workers, return_sorted=False
+            )
+            counts[start:stop] = [len(n) for n in neighbours]
+            chunks.extend(neighbours)
+
+        offsets = np.zeros(len(points) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        if offsets[-1] == 0:
+            return offsets, np.empty(0, dtype=np.int64)
+
+        indices = np.fromiter(
+            (i for neighbours in chunks for i in neighbours),
+            dtype=np.int64,
+            count=offsets[-1],
+        )
+
+        return offsets, indices
+
+    def count_within(
+        self,
+        points: np.ndarray,
+        radius: float,
+        chunk_size: int = CHUNK_SIZE,
+        workers: int = -1,
+    ) -> np.ndarray:
+        """Count the indexed points within a radius for many query points.
+
+        Parameters:
+            points (np.ndarray): Query coordinates in the metric CRS, shape (n, 2).
+            radius (float): The search radius in metres.
+            chunk_size (int): The number of query points handled at once.
+            workers (int): The number of threads used by the KD-tree (-1 = all cores).
+
+        Returns:
+            counts (np.ndarray): The number of points within the radius, shape (n,).
+
+        Raises:
+            None
+        """
+
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+        counts = np.empty(len(points), dtype=np.int64)
+
+        for start in range(0, len(points), chunk_size):
+            stop = start + chunk_size
+            counts[start:stop] = self._kdtree.query_ball_point(
+                points[start:stop], r=radius, workers=workers, return_length=True
+            )
+
+        return counts
+
+    def within_areas(self, areas: gpd.GeoSeries) -> Tuple[np.ndarray, np.ndarray]:
+        """Find all indexed points within many areas at once.
+
+        Parameters:
+            areas (gpd.GeoSeries): The area geometries with a set CRS.
+
+        Returns:
+            area_ids (np.ndarray): The position of the area in the input for every match.
+            point_ids (np.ndarray): The id of the matched point for every match.
+
+        Raises:
+            ValueError: If the areas have no CRS set.
+        """
+
+        if areas.crs is None:
+            raise ValueError("Areas must have a CRS set.")
+
+        if self._strtree is None:
+            self._strtree = shapely.STRtree(shapely.points(self.coordinates))
+
+        geometries = areas.to_crs(epsg=PROJECTED_CRS).values
+
+        # Bulk query of all areas at once, the predicate is evaluated as area.intersects(point)
+        # which matches the behaviour of a mask read including points on the boundary
+        area_ids, point_ids = self._strtree.query(geometries, predicate="intersects")
+
+        return area_ids, point_ids
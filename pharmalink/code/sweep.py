@@ -0,0 +1,367 @@
+"""Module for running batch scenario sweeps over many areas, seeds and parameters.
+
+A sweep is described by a job spec, e.g. as JSON:
+
+    {
+        "areas": ["09162", "09184", "Landkreis Görlitz"],
+        "seeds": 10,
+        "params": {"capacity": [10, 20], "courier_fraction": [0.08, 0.15]}
+    }
+
+Every combination of area, seed (a list of seeds or a number of seeds 0, 1, ...) and parameter values
+is one job. The params are passed to the evaluation function (replication.compute_kpis by default).
+
+The jobs run as a pipeline of three stages connected by bounded queues:
+
+1. prefetch (thread): create the Area of the next area and decompress its source datasets, which are
+   passed along with the Area, while
+2. compute (calling thread): generates the customers of the current job and evaluates them, and
+3. checkpoint (thread): appends every finished job as one JSON line to the checkpoint file.
+
+Jobs are ordered by area, so the sources of an area are loaded once for all its seeds and parameters.
+A crashed or interrupted sweep resumes where it stopped: jobs already in the checkpoint are skipped.
+
+Classes:
+    Job: A single scenario run.
+
+Functions:
+    expand_spec:    Expand a job spec into all its jobs.
+    load_spec:      Load a job spec from a JSON file.
+    read_checkpoint: Read all records of a checkpoint file.
+    run_sweep:      Run all jobs of a sweep that are not yet in the checkpoint.
+    main:           Run a sweep from the command line.
+"""
+
+from __future__ import annotations
+from typing import Any, Callable, Dict, Iterator, List
+from dataclasses import dataclass, field
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import pathlib as path
+import queue
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pharmalink.code.area as area
+import pharmalink.code.backends as backends
+import pharmalink.code.customers as cust
+import pharmalink.code.replication as replication
+import pharmalink.code.sources as src
+
+# Marks the end of the stream in the pipeline queues
+_DONE = object()
+
+
+@dataclass
+class Job:
+    """A single scenario run.
+
+    Attributes:
+        area (str): The regkey or name of the area.
+        seed (int): The seed of the customer generation and evaluation.
+        params (Dict[str, Any]): The keyword arguments of the evaluation function.
+        job_id (str): A stable identifier of the job, derived from all of the above.
+    """
+
+    area: str
+    seed: int
+    params: Dict[str, Any] = field(default_factory=dict)
+    job_id: str = ""
+
+    def __post_init__(self) -> None:
+        if not self.job_id:
+            params = json.dumps(self.params, sort_keys=True)
+            digest = hashlib.sha1(params.encode()).hexdigest()[:8]
+            self.job_id = f"{self.area}-{self.seed}-{digest}"
+
+
+def expand_spec(spec: Dict[str, Any]) -> List[Job]:
+    """Expand a job spec into all its jobs.
+
+    Parameters:
+        spec (Dict[str, Any]): The job spec with "areas" (list), optional "seeds" (list of seeds or a number
+            of seeds, default 1) and optional "params" (lists of values per parameter name).
+
+    Returns:
+        jobs (List[Job]): One job per area, seed and parameter combination, ordered by area.
+
+    Raises:
+        ValueError: If the spec has no areas.
+    """
+
+    if not spec.get("areas"):
+        raise ValueError("The job spec must list at least one area.")
+
+    seeds = spec.get("seeds", 1)
+    seeds = list(range(seeds)) if isinstance(seeds, int) else list(seeds)
+
+    params = spec.get("params", {})
+    names = list(params)
+    combinations = [
+        dict(zip(names, values))
+        for values in itertools.product(*(params[name] for name in names))
+    ]
+
+    return [
+        Job(area=str(job_area), seed=int(seed), params=combination)
+        for job_area in spec["areas"]
+        for seed in seeds
+        for combination in combinations
+    ]
+
+
+def load_spec(file: path.Path | str) -> Dict[str, Any]:
+    """Load a job spec from a JSON file."""
+
+    with open(file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_checkpoint(checkpoint: path.Path | str) -> List[Dict[str, Any]]:
+    """Read all records of a checkpoint file.
+
+    A line cut off by a crash while writing is ignored.
+
+    Parameters:
+        checkpoint (path.Path | str): The JSON lines checkpoint file.
+
+    Returns:
+        records (List[Dict[str, Any]]): The records of all finished (or failed) jobs.
+
+    Raises:
+        None
+    """
+
+    checkpoint = path.Path(checkpoint)
+    if not checkpoint.exists():
+        return []
+
+    records = []
+    with open(checkpoint, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+    return records
+
+
+def _prefetch(jobs: List[Job], output: queue.Queue) -> None:
+    """Load the Area and sources of one area after another (pipeline stage 1)."""
+
+    for job_area, group in itertools.groupby(jobs, key=lambda job: job.area):
+        group = list(group)
+
+        try:
+            loaded = area.Area(job_area)
+
+            # The sources travel with the Area, so they are decompressed exactly once per area
+            # no matter how far the loader runs ahead
+            sources = {
+                "residential_areas": src.ResidentialAreas.get_within_area(loaded),
+                "population_grid": src.PopulationGrids.get_within_area(loaded),
+            }
+            src.Pharmacies.get_index()
+
+        except Exception as error:
+            loaded, sources = error, {}
+
+        output.put((loaded, sources, group))
+
+    output.put(_DONE)
+
+
+def _write_checkpoint(checkpoint: path.Path, records: queue.Queue) -> None:
+    """Append finished jobs to the checkpoint file (pipeline stage 3)."""
+
+    with open(checkpoint, "a", encoding="utf-8") as f:
+        while (record := records.get()) is not _DONE:
+            f.write(json.dumps(record, default=float) + "\n")
+
+            # Every finished job survives a crash of the sweep
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def run_sweep(
+    jobs: List[Job] | Dict[str, Any],
+    checkpoint: path.Path | str,
+    evaluate: Callable[..., Dict[str, float]] = replication.compute_kpis,
+    backend: str = "haversine",
+    prefetch: int = 1,
+) -> pd.DataFrame:
+    """Run all jobs of a sweep that are not yet in the checkpoint.
+
+    Parameters:
+        jobs (List[Job] | Dict[str, Any]): The jobs or a job spec, see expand_spec.
+        checkpoint (path.Path | str): The JSON lines file finished jobs are appended to.
+        evaluate (Callable[..., Dict[str, float]]): The evaluation function with the signature of
+            replication.compute_kpis, called with the params of every job as keyword arguments.
+        backend (str): The name of the routing backend, see backends.create_backend.
+        prefetch (int): The number of areas loaded ahead of the one being computed.
+
+    Returns:
+        results (pd.DataFrame): One row per successful job in the checkpoint (including earlier runs),
+            with the job, its params and its KPIs.
+
+    Raises:
+        None
+    """
+
+    if isinstance(jobs, dict):
+        jobs = expand_spec(jobs)
+
+    checkpoint = path.Path(checkpoint)
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+
+    # Failed jobs are retried, successful ones skipped
+    done = {
+        record["job_id"]
+        for record in read_checkpoint(checkpoint)
+        if "error" not in record
+    }
+    remaining = sorted(
+        (job for job in jobs if job.job_id not in done), key=lambda job: job.area
+    )
+
+    print(f"Running {len(remaining)} of {len(jobs)} jobs ({len(done)} already done).")
+
+    if remaining:
+        routing_backend = backends.create_backend(backend)
+
+        areas = queue.Queue(maxsize=prefetch)
+        records = queue.Queue(maxsize=64)
+
+        loader = threading.Thread(
+            target=_prefetch, args=(remaining, areas), daemon=True
+        )
+        writer = threading.Thread(
+            target=_write_checkpoint, args=(checkpoint, records), daemon=True
+        )
+        loader.start()
+        writer.start()
+
+        try:
+            for loaded, sources, group in iter(areas.get, _DONE):
+                for job in group:
+                    records.put(
+                        _run_job(job, loaded, sources, evaluate, routing_backend)
+                    )
+        finally:
+            records.put(_DONE)
+            writer.join()
+
+    rows = [
+        {
+            "job_id": record["job_id"],
+            "area": record["area"],
+            "seed": record["seed"],
+            **record["params"],
+            **record["kpis"],
+        }
+        for record in read_checkpoint(checkpoint)
+        if "error" not in record
+    ]
+
+    return pd.DataFrame(rows)
+
+
+def _run_job(
+    job: Job,
+    loaded: area.Area | Exception,
+    sources: Dict[str, Any],
+    evaluate: Callable[..., Dict[str, float]],
+    routing_backend: backends.RoutingBackend,
+) -> Dict[str, Any]:
+    """Run a single job (pipeline stage 2) and build its checkpoint record."""
+
+    record = {
+        "job_id": job.job_id,
+        "area": job.area,
+        "seed": job.seed,
+        "params": job.params,
+    }
+    start = time.perf_counter()
+
+    try:
+        if isinstance(loaded, Exception):
+            raise loaded
+
+        # Customer generation and evaluation get independent streams of the job seed
+        customer_seed, evaluation_seed = np.random.SeedSequence(job.seed).spawn(2)
+        customers = cust.Customers(
+            loaded, seed=int(customer_seed.generate_state(1)[0]), **sources
+        )
+
+        record["kpis"] = evaluate(
+            loaded,
+            customers,
+            routing_backend,
+            np.random.default_rng(evaluation_seed),
+            **job.params,
+        )
+        print(f"Finished job {job.job_id}.")
+
+    except Exception as error:
+        record["error"] = f"{type(error).__name__}: {error}"
+        print(f"Job {job.job_id} failed: {record['error']}")
+
+    record["elapsed"] = time.perf_counter() - start
+
+    return record
+
+
+def _iter_areas(values: List[str]) -> Iterator[str]:
+    """Split comma-separated command line values."""
+
+    for value in values:
+        yield from (item.strip() for item in value.split(",") if item.strip())
+
+
+def main(argv: List[str] | None = None) -> None:
+    """Run a sweep from the command line.
+
+    Examples:
+        python -m pharmalink.code.sweep --spec sweep.json --checkpoint results.jsonl
+        python -m pharmalink.code.sweep --areas 09162,09184 --seeds 5 --checkpoint results.jsonl
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pharmalink.code.sweep",
+        description="Run a batch scenario sweep over areas, seeds and parameters.",
+    )
+    parser.add_argument("--spec", help="JSON job spec file.")
+    parser.add_argument("--areas", nargs="*", default=[], help="Regkeys or names.")
+    parser.add_argument("--seeds", type=int, default=1, help="Number of seeds.")
+    parser.add_argument(
+        "--checkpoint", required=True, help="JSON lines file of finished jobs."
+    )
+    parser.add_argument("--backend", default="haversine", help="Routing backend.")
+    parser.add_argument(
+        "--prefetch", type=int, default=1, help="Areas loaded ahead of time."
+    )
+    parser.add_argument("--output", help="CSV file for the results of all jobs.")
+    args = parser.parse_args(argv)
+
+    if args.spec:
+        spec = load_spec(args.spec)
+    else:
+        spec = {"areas": list(_iter_areas(args.areas)), "seeds": args.seeds}
+
+    results = run_sweep(
+        spec, args.checkpoint, backend=args.backend, prefetch=args.prefetch
+    )
+
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+    print(f"{len(results)} jobs finished successfully.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,833 @@
+"""Module for solving the vehicle routing problem (VRP) of courier deliveries from pharmacies and depots.
+
+The column-generation prototype (archive/tests/vrpy-test.ipynb) does not scale to the thousands of daily
+courier deliveries of a Kreis. This module solves capacitated VRPs with optional time windows and a maximum
+route duration heuristically on dense or sparse (SparseMatrix) travel-time matrices:
+
+1. Construction: Clarke-Wright savings, restricted to the K nearest neighbours of every stop,
+   so only O(n * K) savings are computed and sorted.
+2. Improvement: local search with relocate, exchange, 2-opt (within a route) and 2-opt* (between routes)
+   moves, again restricted to neighbour lists, until no move improves or the time budget is used up.
+
+Time windows are checked in constant time per move by concatenating precomputed route segments
+(duration, earliest and latest start, time warp) as described by Vidal et al. (2013). Time warp is
+not tolerated, so every route of a solution is feasible.
+
+Node ids are rows/columns of the travel-time matrix. The depot is one of them, all other nodes are stops.
+
+Classes:
+    VrpProblem:     A capacitated vehicle routing problem with optional time windows.
+    VrpSolution:    The routes of a VRP solution.
+
+Functions:
+    clarke_wright:  Construct routes with the Clarke-Wright savings heuristic.
+    improve:        Improve routes by local search.
+    solve:          Solve a VRP by construction and local search.
+"""
+
+from __future__ import annotations
+from typing import List, Tuple
+from dataclasses import dataclass, field
+import bisect
+import time
+import numpy as np
+import pharmalink.code.sparse as sparse
+
+# Tolerance of the floating point comparisons of costs and time warp
+EPSILON = 1e-6
+
+
+class VrpProblem:
+    """A capacitated vehicle routing problem with optional time windows.
+
+    Attributes:
+        num_nodes (int): The number of nodes including the depot.
+        depot (int): The node id of the depot.
+        demands (np.ndarray): The demand per node (0 for the depot).
+        capacity (float): The capacity of every vehicle.
+        service_times (np.ndarray): The service time in seconds per node.
+        time_windows (np.ndarray | None): The earliest and latest service start in seconds per node, shape (n, 2).
+            The window of the depot bounds the start and end of every route.
+        max_duration (float): The maximum duration of a route in seconds, including waiting and service.
+        neighbours (np.ndarray): The nearest stops of every node, shape (n, k), padded with -1.
+
+    Methods:
+        travel:     Get the travel time between two nodes.
+        stops:      Get the node ids of all stops.
+    """
+
+    __slots__ = [
+        "num_nodes",
+        "depot",
+        "demands",
+        "capacity",
+        "service_times",
+        "time_windows",
+        "max_duration",
+        "neighbours",
+        "timed",
+        "_dense",
+        "_indptr",
+        "_indices",
+        "_values",
+        "_from_depot",
+        "_to_depot",
+    ]
+
+    def __init__(
+        self,
+        durations: np.ndarray | sparse.SparseMatrix,
+        demands: np.ndarray | None = None,
+        capacity: float = np.inf,
+        depot: int = 0,
+        service_times: np.ndarray | float = 0.0,
+        time_windows: np.ndarray | None = None,
+        max_duration: float = np.inf,
+        neighbours: int | np.ndarray = 20,
+    ) -> None:
+        """Initialize a VrpProblem.
+
+        Parameters:
+            durations (np.ndarray | sparse.SparseMatrix): Travel times in seconds between all nodes,
+                dense (NaN = unreachable) or sparse (pairs not stored = unreachable). A sparse matrix
+                must hold all pairs from and to the depot.
+            demands (np.ndarray | None): The demand per node. Defaults to 1 per stop.
+            capacity (float): The capacity of every vehicle.
+            depot (int): The node id of the depot.
+            service_times (np.ndarray | float): The service time in seconds for all or per node.
+            time_windows (np.ndarray | None): The earliest and latest service start per node, shape (n, 2).
+            max_duration (float): The maximum duration of a route in seconds.
+            neighbours (int | np.ndarray): The number of nearest stops considered per node by all heuristics,
+                or precomputed neighbour lists of shape (n, k), padded with -1.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: If the matrix is not square or the inputs do not match its size.
+        """
+
+        num_nodes, num_cols = durations.shape
+        if num_nodes != num_cols:
+            raise ValueError("The travel-time matrix must be square.")
+
+        self.num_nodes = num_nodes
+        self.depot = depot
+        self.capacity = float(capacity)
+        self.max_duration = float(max_duration)
+
+        if demands is None:
+            demands = np.ones(num_nodes)
+        self.demands = np.asarray(demands, dtype=float).copy()
+        self.demands[depot] = 0.0
+
+        self.service_times = np.broadcast_to(
+            np.asarray(service_times, dtype=float), (num_nodes,)
+        ).copy()
+        self.service_times[depot] = 0.0
+
+        self.time_windows = (
+            None if time_windows is None else np.asarray(time_windows, dtype=float)
+        )
+
+        if len(self.demands) != num_nodes or (
+            self.time_windows is not None and self.time_windows.shape != (num_nodes, 2)
+        ):
+            raise ValueError("Demands and time windows must match the matrix size.")
+
+        # Schedules only need to be checked if they can become infeasible
+        self.timed = self.time_windows is not None or np.isfinite(self.max_duration)
+
+        if isinstance(durations, sparse.SparseMatrix):
+            self._dense = None
+
+            # Lookups binary search the CSR arrays directly. Memoryviews index faster than numpy arrays
+            # and keep memory-mapped matrices shared instead of copying them into every process.
+            self._indptr = memoryview(np.ascontiguousarray(durations.indptr))
+            self._indices = memoryview(np.ascontiguousarray(durations.indices))
+            self._values = memoryview(np.ascontiguousarray(durations.durations))
+
+            nodes = np.arange(num_nodes)
+            self._from_depot = durations.get(depot, nodes)
+            self._to_depot = durations.get(nodes, depot)
+
+        else:
+            # Matrices without unreachable pairs are used as they are, so memory-mapped matrices are not copied
+            self._dense = np.asarray(durations, dtype=float)
+            if np.isnan(self._dense).any():
+                self._dense = np.where(np.isnan(self._dense), np.inf, self._dense)
+
+            self._indptr = self._indices = self._values = None
+            self._from_depot = self._dense[depot]
+            self._to_depot = self._dense[:, depot]
+
+        if np.ndim(neighbours) > 0:
+            self.neighbours = np.asarray(neighbours, dtype=np.int64)
+
+        elif self._dense is None:
+            k = min(neighbours, num_nodes - 2)
+
+            self.neighbours = np.full((num_nodes, max(k, 0)), -1, dtype=np.int64)
+            for node in range(num_nodes):
+                columns, _ = durations.row(node)
+                times = durations.get(node, columns)
+                keep = (columns != node) & (columns != depot) & np.isfinite(times)
+                columns, times = columns[keep], times[keep]
+                nearest = columns[np.argsort(times, kind="stable")[:k]]
+                self.neighbours[node, : len(nearest)] = nearest
+
+        else:
+            k = min(neighbours, num_nodes - 2)
+
+            # The depot and the node itself are excluded by making them the farthest columns
+            candidates = self._dense.copy()
+            candidates[:, depot] = np.inf
+            np.fill_diagonal(candidates, np.inf)
+
+            self.neighbours = np.full((num_nodes, max(k, 0)), -1, dtype=np.int64)
+            if k > 0:
+                nearest = np.argpartition(candidates, k - 1, axis=1)[:, :k]
+                order = np.argsort(
+                    np.take_along_axis(candidates, nearest, axis=1), axis=1
+                )
+                nearest = np.take_along_axis(nearest, order, axis=1)
+                reachable = np.isfinite(np.take_along_axis(candidates, nearest, axis=1))
+                self.neighbours = np.where(reachable, nearest, -1)
+
+    def __repr__(self) -> str:
+        """Return all information about the VrpProblem object."""
+
+        return (
+            f"VrpProblem (Stops: {self.num_nodes - 1}, Capacity: {self.capacity}, "
+            f"Time windows: {self.time_windows is not None})"
+        )
+
+    def travel(self, i: int, j: int) -> float:
+        """Get the travel time in seconds between two nodes, inf if unknown or unreachable."""
+
+        if self._dense is not None:
+            return self._dense[i, j]
+
+        start, stop = self._indptr[i], self._indptr[i + 1]
+        position = bisect.bisect_left(self._indices, j, start, stop)
+
+        if position == stop or self._indices[position] != j:
+            return np.inf
+
+        value = self._values[position]
+
+        # NaN (float32) or the saturated maximum (uint16) mark unreachable pairs
+        if value != value or (
+            value == sparse.UINT16_MAX and self._values.format == "H"
+        ):
+            return np.inf
+
+        return float(value)
+
+    def stops(self) -> np.ndarray:
+        """Get the node ids of all stops."""
+
+        return np.delete(np.arange(self.num_nodes), self.depot)
+
+    def _segment(self, node: int) -> Tuple[float, float, float, float]:
+        """Get the schedule segment of a single node."""
+
+        if self.time_windows is None:
+            return (self.service_times[node], 0.0, np.inf, 0.0)
+
+        earliest, latest = self.time_windows[node]
+
+        return (self.service_times[node], earliest, latest, 0.0)
+
+
+def _concat(
+    first: Tuple[float, float, float, float],
+    second: Tuple[float, float, float, float],
+    travel: float,
+) -> Tuple[float, float, float, float]:
+    """Concatenate two schedule segments connected by a travel time.
+
+    A segment is (duration, earliest start, latest start, time warp).
+    """
+
+    duration1, earliest1, latest1, warp1 = first
+    duration2, earliest2, latest2, warp2 = second
+
+    delta = duration1 - warp1 + travel
+    wait = max(earliest2 - delta - latest1, 0.0)
+    warp = max(earliest1 + delta - latest2, 0.0)
+
+    return (
+        duration1 + duration2 + travel + wait,
+        max(earliest2 - delta, earliest1) - wait,
+        min(latest2 - delta, latest1) + warp,
+        warp1 + warp2 + warp,
+    )
+
+
+@dataclass
+class VrpSolution:
+    """The routes of a VRP solution.
+
+    Attributes:
+        routes (List[np.ndarray]): The stops of every route in visiting order, without the depot.
+        cost (float): The total travel time of all routes in seconds.
+        route_costs (np.ndarray): The travel time of every route in seconds.
+        loads (np.ndarray): The total demand of every route.
+        unserved (np.ndarray): The stops that cannot be served by any feasible route.
+        trace (List[Tuple[float, float]]): The (elapsed seconds, cost) after construction and every improvement.
+    """
+
+    routes: List[np.ndarray]
+    cost: float
+    route_costs: np.ndarray
+    loads: np.ndarray
+    unserved: np.ndarray
+    trace: List[Tuple[float, float]] = field(default_factory=list)
+
+    def get_vehicles(self, num_nodes: int) -> np.ndarray:
+        """Get the route id serving every node, -1 for the depot and unserved stops."""
+
+        vehicles = np.full(num_nodes, -1, dtype=np.int64)
+        for vehicle, route in enumerate(self.routes):
+            vehicles[route] = vehicle
+
+        return vehicles
+
+
+def clarke_wright(
+    problem: VrpProblem,
+    noise: float = 0.0,
+    seed: int | np.random.Generator | None = None,
+) -> Tuple[List[List[int]], List[int]]:
+    """Construct routes with the Clarke-Wright savings heuristic.
+
+    Every stop starts on its own route. Routes are merged along the neighbour pairs (i, j) with the
+    largest savings d(i, depot) + d(depot, j) - d(i, j), if i ends one route, j starts another one and
+    the merged route is feasible. Routes are not reversed, so asymmetric travel times are respected.
+
+    Parameters:
+        problem (VrpProblem): The problem.
+        noise (float): The relative random perturbation of the savings, for randomized multi-starts.
+        seed (int | np.random.Generator | None): The seed or generator of the perturbation.
+
+    Returns:
+        routes (List[List[int]]): The stops of every route in visiting order.
+        unserved (List[int]): The stops that cannot be served on their own route.
+
+    Raises:
+        None
+    """
+
+    rng = np.random.default_rng(seed)
+    depot = problem.depot
+    depot_segment = problem._segment(depot)
+    stops = problem.stops()
+
+    route_of = np.full(problem.num_nodes, -1, dtype=np.int64)
+    routes = {}
+    loads = {}
+    segments = {}
+    unserved = []
+
+    # Every servable stop starts on its own route
+    for stop in stops.tolist():
+        segment = problem._segment(stop)
+        outward = problem._from_depot[stop]
+        back = problem._to_depot[stop]
+        full = _concat(_concat(depot_segment, segment, outward), depot_segment, back)
+
+        if (
+            not np.isfinite(outward + back)
+            or problem.demands[stop] > problem.capacity
+            or full[3] > EPSILON
+            or full[0] > problem.max_duration
+        ):
+            unserved.append(stop)
+            continue
+
+        route_of[stop] = stop
+        routes[stop] = [stop]
+        loads[stop] = problem.demands[stop]
+        segments[stop] = segment
+
+    # Savings of all neighbour pairs, largest first
+    firsts = np.repeat(np.arange(problem.num_nodes), problem.neighbours.shape[1])
+    seconds = problem.neighbours.ravel()
+    valid = (seconds >= 0) & (firsts != depot)
+    firsts, seconds = firsts[valid], seconds[valid]
+
+    if problem._dense is not None:
+        between = problem._dense[firsts, seconds]
+    else:
+        between = np.array(
+            [problem.travel(i, j) for i, j in zip(firsts.tolist(), seconds.tolist())]
+        )
+
+    savings = problem._to_depot[firsts] + problem._from_depot[seconds] - between
+    if noise > 0:
+        savings = savings * (1 + noise * rng.random(len(savings)))
+
+    order = np.argsort(-savings, kind="stable")
+    order = order[np.isfinite(savings[order]) & (savings[order] > 0)]
+
+    for i, j, travel in zip(
+        firsts[order].tolist(), seconds[order].tolist(), between[order].tolist()
+    ):
+        first, second = route_of[i], route_of[j]
+
+        if first < 0 or second < 0 or first == second:
+            continue
+
+        # i must end its route and j must start the other one
+        if routes[first][-1] != i or routes[second][0] != j:
+            continue
+
+        load = loads[first] + loads[second]
+        if load > problem.capacity:
+            continue
+
+        segment = _concat(segments[first], segments[second], travel)
+
+        if problem.timed:
+            full = _concat(
+                _concat(depot_segment, segment, problem._from_depot[routes[first][0]]),
+                depot_segment,
+                problem._to_depot[routes[second][-1]],
+            )
+            if full[3] > EPSILON or full[0] > problem.max_duration:
+                continue
+
+        for stop in routes[second]:
+            route_of[stop] = first
+
+        routes[first] += routes.pop(second)
+        loads[first] = load
+        segments[first] = segment
+        del loads[second], segments[second]
+
+    return list(routes.values()), unserved
+
+
+class _LocalSearch:
+    """The state of a local search over the routes of a solution.
+
+    Every route is kept as a sequence starting and ending at the depot, with the schedule segments
+    of all its prefixes and suffixes, its cumulative loads and its travel time.
+    """
+
+    __slots__ = [
+        "problem",
+        "sequences",
+        "prefixes",
+        "suffixes",
+        "cumulative_loads",
+        "costs",
+        "route_of",
+        "position",
+    ]
+
+    def __init__(self, problem: VrpProblem, routes: List[List[int]]) -> None:
+        self.problem = problem
+        self.sequences = []
+        self.prefixes = []
+        self.suffixes = []
+        self.cumulative_loads = []
+        self.costs = []
+        self.route_of = np.full(problem.num_nodes, -1, dtype=np.int64)
+        self.position = np.full(problem.num_nodes, -1, dtype=np.int64)
+
+        for route in routes:
+            self.sequences.append([problem.depot, *route, problem.depot])
+            self.prefixes.append(None)
+            self.suffixes.append(None)
+            self.cumulative_loads.append(None)
+            self.costs.append(0.0)
+            self._update(len(self.sequences) - 1)
+
+    def _update(self, r: int) -> None:
+        """Recompute the positions, segments, loads and travel time of a route."""
+
+        problem = self.problem
+        sequence = self.sequences[r]
+        travel = [problem.travel(a, b) for a, b in zip(sequence[:-1], sequence[1:])]
+
+        for position, node in enumerate(sequence[1:-1], start=1):
+            self.route_of[node] = r
+            self.position[node] = position
+
+        self.costs[r] = sum(travel)
+        self.cumulative_loads[r] = np.cumsum(problem.demands[sequence]).tolist()
+
+        if problem.timed:
+            segments = [problem._segment(node) for node in sequence]
+
+            prefixes = [segments[0]]
+            for segment, t in zip(segments[1:], travel):
+                prefixes.append(_concat(prefixes[-1], segment, t))
+
+            suffixes = [segments[-1]]
+            for segment, t in zip(segments[-2::-1], travel[::-1]):
+                suffixes.append(_concat(segment, suffixes[-1], t))
+
+            self.prefixes[r] = prefixes
+            self.suffixes[r] = suffixes[::-1]
+
+    def _feasible(self, *parts: Tuple) -> bool:
+        """Check whether segments and connecting travel times (alternating) form a feasible route."""
+
+        if not self.problem.timed:
+            return True
+
+        segment = parts[0]
+        for travel, following in zip(parts[1::2], parts[2::2]):
+            segment = _concat(segment, following, travel)
+
+        return segment[3] <= EPSILON and segment[0] <= self.problem.max_duration
+
+    def _sequence_feasible(self, sequence: List[int]) -> Tuple[bool, float]:
+        """Check a complete route sequence and compute its travel time."""
+
+        problem = self.problem
+        travel = [problem.travel(a, b) for a, b in zip(sequence[:-1], sequence[1:])]
+        cost = sum(travel)
+
+        if not np.isfinite(cost):
+            return False, cost
+
+        if problem.timed:
+            segment = problem._segment(sequence[0])
+            for node, t in zip(sequence[1:], travel):
+                segment = _concat(segment, problem._segment(node), t)
+
+            if segment[3] > EPSILON or segment[0] > problem.max_duration:
+                return False, cost
+
+        return True, cost
+
+    def load(self, r: int, start: int, stop: int) -> float:
+        """Get the demand of the positions start to stop (inclusive) of a route."""
+
+        loads = self.cumulative_loads[r]
+
+        return loads[stop] - (loads[start - 1] if start > 0 else 0.0)
+
+    def relocate(self, u: int, v: int) -> bool:
+        """Move stop u directly after or before its neighbour v, if this improves the solution."""
+
+        problem = self.problem
+        t = problem.travel
+        ru, rv = self.route_of[u], self.route_of[v]
+        pu, pv = self.position[u], self.position[v]
+        su, sv = self.sequences[ru], self.sequences[rv]
+
+        removal = t(su[pu - 1], su[pu + 1]) - t(su[pu - 1], u) - t(u, su[pu + 1])
+
+        if ru == rv:
+            # Within a route, the changed sequence is checked as a whole
+            for target in (pv, pv + 1):
+                if target in (pu, pu + 1):
+                    continue
+                sequence = su[:pu] + su[pu + 1 :]
+                sequence.insert(target if target < pu else target - 1, u)
+                feasible, cost = self._sequence_feasible(sequence)
+                if feasible and cost < self.costs[ru] - EPSILON:
+                    self.sequences[ru] = sequence
+                    self._update(ru)
+                    return True
+            return False
+
+        if self.cumulative_loads[rv][-1] + problem.demands[u] > problem.capacity:
+            return False
+
+        segment = problem._segment(u)
+
+        # Insert between (previous, next) in route v: after v or before v
+        for previous, following in ((pv, pv + 1), (pv - 1, pv)):
+            a, b = sv[previous], sv[following]
+            insertion = t(a, u) + t(u, b) - t(a, b)
+
+            if not removal + insertion < -EPSILON:
+                continue
+
+            if problem.timed and not (
+                self._feasible(
+                    self.prefixes[ru][pu - 1],
+                    t(su[pu - 1], su[pu + 1]),
+                    self.suffixes[ru][pu + 1],
+                )
+                and self._feasible(
+                    self.prefixes[rv][previous],
+                    t(a, u),
+                    segment,
+                    t(u, b),
+                    self.suffixes[rv][following],
+                )
+            ):
+                continue
+
+            self.sequences[ru] = su[:pu] + su[pu + 1 :]
+            self.sequences[rv] = sv[:following] + [u] + sv[following:]
+            self._update(ru)
+            self._update(rv)
+            return True
+
+        return False
+
+    def exchange(self, u: int, v: int) -> bool:
+        """Swap stops u and v of different routes, if this improves the solution."""
+
+        problem = self.problem
+        t = problem.travel
+        ru, rv = self.route_of[u], self.route_of[v]
+
+        if ru == rv:
+            return False
+
+        pu, pv = self.position[u], self.position[v]
+        su, sv = self.sequences[ru], self.sequences[rv]
+        du, dv = problem.demands[u], problem.demands[v]
+
+        if (
+            self.cumulative_loads[ru][-1] - du + dv > problem.capacity
+            or self.cumulative_loads[rv][-1] - dv + du > problem.capacity
+        ):
+            return False
+
+        au, bu, av, bv = su[pu - 1], su[pu + 1], sv[pv - 1], sv[pv + 1]
+        delta = (
+            t(au, v)
+            + t(v, bu)
+            - t(au, u)
+            - t(u, bu)
+            + t(av, u)
+            + t(u, bv)
+            - t(av, v)
+            - t(v, bv)
+        )
+
+        if not delta < -EPSILON:
+            return False
+
+        if problem.timed and not (
+            self._feasible(
+                self.prefixes[ru][pu - 1],
+                t(au, v),
+                problem._segment(v),
+                t(v, bu),
+                self.suffixes[ru][pu + 1],
+            )
+            and self._feasible(
+                self.prefixes[rv][pv - 1],
+                t(av, u),
+                problem._segment(u),
+                t(u, bv),
+                self.suffixes[rv][pv + 1],
+            )
+        ):
+            return False
+
+        su[pu], sv[pv] = v, u
+        self._update(ru)
+        self._update(rv)
+
+        return True
+
+    def two_opt(self, u: int, v: int) -> bool:
+        """Connect stop u to its neighbour v by a 2-opt (same route) or 2-opt* (different routes) move."""
+
+        problem = self.problem
+        t = problem.travel
+        ru, rv = self.route_of[u], self.route_of[v]
+        pu, pv = self.position[u], self.position[v]
+        su, sv = self.sequences[ru], self.sequences[rv]
+
+        if ru == rv:
+            # Reverse the part between u and v, so u is followed by v
+            if pv <= pu + 1:
+                return False
+
+            sequence = su[: pu + 1] + su[pu + 1 : pv + 1][::-1] + su[pv + 1 :]
+            feasible, cost = self._sequence_feasible(sequence)
+
+            if feasible and cost < self.costs[ru] - EPSILON:
+                self.sequences[ru] = sequence
+                self._update(ru)
+                return True
+
+            return False
+
+        # Exchange the tails: u continues with v and the rest of its route, v's predecessor with u's successor
+        delta = (
+            t(u, v) + t(sv[pv - 1], su[pu + 1]) - t(u, su[pu + 1]) - t(sv[pv - 1], v)
+        )
+
+        if not delta < -EPSILON:
+            return False
+
+        last_u, last_v = len(su) - 2, len(sv) - 2
+        load_u = self.load(ru, 0, pu) + self.load(rv, pv, last_v)
+        load_v = self.load(rv, 0, pv - 1) + (
+            self.load(ru, pu + 1, last_u) if pu < last_u else 0.0
+        )
+
+        if load_u > problem.capacity or load_v > problem.capacity:
+            return False
+
+        if problem.timed and not (
+            self._feasible(self.prefixes[ru][pu], t(u, v), self.suffixes[rv][pv])
+            and self._feasible(
+                self.prefixes[rv][pv - 1],
+                t(sv[pv - 1], su[pu + 1]),
+                self.suffixes[ru][pu + 1],
+            )
+        ):
+            return False
+
+        self.sequences[ru], self.sequences[rv] = (
+            su[: pu + 1] + sv[pv:],
+            sv[:pv] + su[pu + 1 :],
+        )
+        self._update(ru)
+        self._update(rv)
+
+        return True
+
+    def routes(self) -> List[List[int]]:
+        """Get the stops of all non-empty routes."""
+
+        return [sequence[1:-1] for sequence in self.sequences if len(sequence) > 2]
+
+
+def improve(
+    problem: VrpProblem,
+    routes: List[List[int]],
+    time_limit: float = 10.0,
+    seed: int | np.random.Generator | None = None,
+    trace: List[Tuple[float, float]] | None = None,
+) -> List[List[int]]:
+    """Improve routes by local search.
+
+    Stops are visited in random order. For every stop and each of its neighbours, relocate, exchange
+    and 2-opt moves are tried and the first improving feasible move is applied. The search stops at a
+    local optimum or when the time budget is used up.
+
+    Parameters:
+        problem (VrpProblem): The problem.
+        routes (List[List[int]]): The feasible routes to improve.
+        time_limit (float): The time budget in seconds.
+        seed (int | np.random.Generator | None): The seed or generator of the visiting order.
+        trace (List[Tuple[float, float]] | None): An optional list the (elapsed seconds, cost) of every
+            pass is appended to, including the one cut off by the time limit.
+
+    Returns:
+        routes (List[List[int]]): The improved routes.
+
+    Raises:
+        None
+    """
+
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    search = _LocalSearch(problem, routes)
+    moves = (search.relocate, search.exchange, search.two_opt)
+
+    stops = np.array([stop for route in routes for stop in route], dtype=np.int64)
+    improved = True
+
+    while improved:
+        improved = False
+
+        for u in rng.permutation(stops).tolist():
+            # The clock is cheap compared to the moves tried per stop, so small problems stop in time too
+            if time.perf_counter() - start > time_limit:
+                if trace is not None:
+                    trace.append((time.perf_counter() - start, sum(search.costs)))
+
+                return search.routes()
+
+            for v in problem.neighbours[u].tolist():
+                if v < 0:
+                    break
+                if search.route_of[v] < 0:
+                    continue
+
+                if any(move(u, v) for move in moves):
+                    improved = True
+                    break
+
+        if trace is not None:
+            trace.append((time.perf_counter() - start, sum(search.costs)))
+
+    return search.routes()
+
+
+def _evaluate(
+    problem: VrpProblem, routes: List[List[int]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute the travel time and load of every route."""
+
+    costs = np.array(
+        [
+            sum(
+                problem.travel(a, b)
+                for a, b in zip([problem.depot, *route], [*route, problem.depot])
+            )
+            for route in routes
+        ],
+        dtype=float,
+    )
+    loads = np.array([problem.demands[route].sum() for route in routes], dtype=float)
+
+    return costs, loads
+
+
+def solve(
+    problem: VrpProblem,
+    time_limit: float = 10.0,
+    seed: int | None = None,
+    noise: float = 0.0,
+    routes: List[List[int]] | None = None,
+) -> VrpSolution:
+    """Solve a VRP by construction and local search.
+
+    Parameters:
+        problem (VrpProblem): The problem.
+        time_limit (float): The time budget of the local search in seconds.
+        seed (int | None): The seed of all random decisions.
+        noise (float): The relative random perturbation of the savings, for randomized multi-starts.
+        routes (List[List[int]] | None): Feasible routes to start the local search from instead of
+            constructing them. Stops not on any of them are unserved.
+
+    Returns:
+        solution (VrpSolution): The best found routes.
+
+    Raises:
+        None
+    """
+
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+
+    if routes is None:
+        routes, unserved = clarke_wright(problem, noise=noise, seed=rng)
+    else:
+        routes = [list(route) for route in routes]
+        unserved = np.setdiff1d(
+            problem.stops(), np.concatenate([np.zeros(0, dtype=np.int64), *routes])
+        ).tolist()
+
+    costs, _ = _evaluate(problem, routes)
+    trace = [(time.perf_counter() - start, float(costs.sum()))]
+
+    routes = improve(problem, routes, time_limit=time_limit, seed=rng, trace=trace)
+    costs, loads = _evaluate(problem, routes)
+
+    return VrpSolution(
+        routes=[np.array(route, dtype=np.int64) for route in routes],
+        cost=float(costs.sum()),
+        route_costs=costs,
+        loads=loads,
+        unserved=np.array(unserved, dtype=np.int64),
+        trace=trace,
+    )